@@ -0,0 +1,215 @@
+from concurrent.futures import ProcessPoolExecutor
+from contract_control import table_transaction_hash, recover_signer
+from highcard_state import State, is_valid_state_fast_forward
+from deck import reveal, point_bytes, high_card_index
+import os, sys, json, binascii
+
+gamedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gamestate")
+
+# Replays saved games (gamestate/*.pkr journals) and checks them the way the contracts would:
+# both signatures on every fully signed state, every step with the isValidStateTransition rules,
+# and at each showdown that the pot went to the high card, rebuilt from the revealed keys. Files
+# are read a line at a time and only the previous state is held, so a journal of any length
+# audits in constant memory; many files are spread over worker processes.
+#
+# Journals drop the states before a checkpoint when they are compacted, and a player only keeps
+# the states it saw fully signed (the forced moves the opponent completed are skipped), so
+# consecutive states are not always one step apart. Such gaps are checked with the
+# isValidStateFastForward rules instead and counted in the report.
+
+def read_records(path):
+    # Yields the JSON records of a journal in order. A torn last line (a crash mid-write) is
+    # ignored; whole-file backups in the old format are unpacked into the same records.
+    torn = None
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if torn is not None:
+                raise ValueError("unreadable record in the middle of the journal")
+            try:
+                record = json.loads(line)
+            except ValueError:
+                torn = line
+                continue
+            if 'states' in record:
+                yield {'game': record['game']}
+                for signed_state in record['states']:
+                    yield {'state': signed_state}
+                if record.get('unfinished', '') != '':
+                    yield {'unfinished': record['unfinished']}
+                continue
+            yield record
+
+def showdown(state):
+    # Both cards of a hand once all four keys are in the state, else None.
+    ck = state.cards_keys
+    if 0 in (ck[2], ck[3], ck[6], ck[7]):
+        return None
+    return reveal(point_bytes(ck[0], ck[1]), [ck[2], ck[3]]), reveal(point_bytes(ck[4], ck[5]), [ck[6], ck[7]])
+
+class GameAudit:
+    def __init__(self, path):
+        self.path = path
+        self.game = None
+        self.players = None
+        self.small_blind = None
+        self.previous = None
+        self.last_commit = None
+        self.states = 0
+        self.gaps = 0
+        self.hands = []
+        self.errors = []
+        self.unfinished = False
+        self.closed = False
+
+    def error(self, state, message):
+        where = f"hand {state.hand} round {state.round}: " if state is not None else ""
+        self.errors.append(where + message)
+
+    def start(self, game):
+        self.game = game
+        self.players = game['players']
+        if 'buy_in' in game:
+            self.small_blind = game['buy_in']//100
+        if 'tableID' in game:
+            self.tableID = binascii.unhexlify(game['tableID'])
+            self.sessionID = binascii.unhexlify(game['sessionID'])
+        else:
+            self.tableID = None
+            self.errors.append("the game basics do not name the table, signatures cannot be checked")
+
+    def signer(self, state, sig):
+        if self.tableID is None:
+            return None
+        return recover_signer(table_transaction_hash(self.tableID, self.sessionID, state.encoded), sig)
+
+    def follows(self, state):
+        previous = self.previous
+        if previous is None:
+            if self.small_blind is None:
+                # Old journals do not record the buy in; every state conserves it.
+                self.small_blind = (sum(state.balances)+state.pot)//200
+            if state.hand == 1 and state.round == 1:
+                previous = State(0, 0, 4, (100*self.small_blind, 100*self.small_blind), 0, 0, (0,)*8)
+            else:
+                self.gaps += 1
+                return
+        elif state == previous:
+            return
+        consecutive = (state.hand == previous.hand and state.round == previous.round+1) or (state.hand == previous.hand+1 and state.round == 1 and previous.action == 4)
+        if not consecutive:
+            self.gaps += 1
+        if not is_valid_state_fast_forward(previous.encoded, state.encoded, self.players, self.small_blind):
+            self.error(state, "invalid transition from the state before" if consecutive else "invalid fast forward from the state before")
+
+    def signed_state(self, signed_state):
+        state = State.from_hex(signed_state['state'])
+        self.states += 1
+        signatures = {address.lower(): sig for address, sig in signed_state['signatures'].items()}
+        for player in self.players:
+            sig = signatures.get(player.lower())
+            if sig is None:
+                self.error(state, f"no signature by {player}")
+            elif self.tableID is not None and (self.signer(state, sig) or '').lower() != player.lower():
+                self.error(state, f"bad signature by {player}")
+        self.follows(state)
+        if state.action == 4 and state != self.previous:
+            self.hand_result(state)
+        self.previous = state
+        self.unfinished = False
+
+    def hand_result(self, state):
+        result = {'hand': state.hand, 'winner': state.winner, 'balances': list(state.balances), 'won': None, 'showdown': None}
+        if self.last_commit is not None and self.last_commit.hand == state.hand-1:
+            winner = [p.lower() for p in self.players].index(state.winner.lower())
+            result['won'] = state.balances[winner]-self.last_commit.balances[winner]
+        try:
+            cards = showdown(state)
+        except (KeyError, ValueError):
+            self.error(state, "revealed keys do not unmask two cards")
+            cards = None
+        if cards is not None:
+            result['showdown'] = list(cards)
+            if self.players[high_card_index(*cards)].lower() != state.winner.lower():
+                self.error(state, f"pot went to {state.winner} without the high card")
+        self.hands.append(result)
+        self.last_commit = state
+
+    def unfinished_state(self, unfinished):
+        state = State.from_hex(unfinished['state'])
+        if self.tableID is not None and (self.signer(state, unfinished['signature']) or '').lower() not in [p.lower() for p in self.players]:
+            self.error(state, "unfinished state is not signed by a player")
+        if self.previous is not None and not is_valid_state_fast_forward(self.previous.encoded, state.encoded, self.players, self.small_blind):
+            self.error(state, "unfinished state does not follow the last signed state")
+        self.unfinished = True
+
+    def run(self):
+        try:
+            for record in read_records(self.path):
+                if 'game' in record:
+                    self.start(record['game'])
+                elif self.game is None:
+                    raise ValueError("journal does not start with the game basics")
+                elif 'state' in record:
+                    self.signed_state(record['state'])
+                elif 'unfinished' in record:
+                    if record['unfinished'] != '':
+                        self.unfinished_state(record['unfinished'])
+                elif 'closed' in record:
+                    self.closed = True
+        except Exception as e:
+            self.errors.append(f"{type(e).__name__}: {e}")
+        return self.report()
+
+    def report(self):
+        return {'file': self.path, 'session': self.game['sessionID'] if self.game else None, 'players': self.players, 'states': self.states, 'gaps': self.gaps,
+                'hands': self.hands, 'unfinished': self.unfinished, 'closed': self.closed, 'errors': self.errors, 'ok': len(self.errors) == 0}
+
+def audit_game(path):
+    return GameAudit(path).run()
+
+def audit_files(paths, processes=None):
+    # Reports in the order of `paths`. processes=0 audits in this process.
+    processes = (os.cpu_count() or 1) if processes is None else processes
+    if processes <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield audit_game(path)
+        return
+    with ProcessPoolExecutor(processes) as pool:
+        yield from pool.map(audit_game, paths, chunksize=max(1, len(paths)//(4*processes)))
+
+def journal_paths(args):
+    paths = []
+    for arg in args or [gamedir]:
+        if os.path.isdir(arg):
+            paths += [os.path.join(arg, name) for name in sorted(os.listdir(arg)) if name.endswith(".pkr")]
+        else:
+            paths.append(arg)
+    return paths
+
+def print_report(report, hands=False):
+    status = "ok" if report['ok'] else f"{len(report['errors'])} errors"
+    print(f"{os.path.basename(report['file'])}: {status}, {report['states']} signed states, {len(report['hands'])} hands, {report['gaps']} gaps{', closed' if report['closed'] else ''}{', unfinished state' if report['unfinished'] else ''}")
+    for e in report['errors']:
+        print("   ", e)
+    if hands:
+        for h in report['hands']:
+            cards = f"showdown {h['showdown'][0]} vs {h['showdown'][1]}" if h['showdown'] else "no showdown"
+            won = f"won {h['won']/10**18}" if h['won'] is not None else "won ?"
+            print(f"    hand {h['hand']}: {h['winner']} {won}, {cards}")
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    processes = [int(a[len("--processes="):]) for a in sys.argv[1:] if a.startswith("--processes=")]
+    paths = journal_paths(args)
+    failed = 0
+    for report in audit_files(paths, processes[-1] if processes else None):
+        failed += not report['ok']
+        if "--json" in sys.argv:
+            print(json.dumps(report))
+        else:
+            print_report(report, "--hands" in sys.argv)
+    if "--json" not in sys.argv:
+        print(f"{len(paths)} games audited, {failed} with errors")
+    sys.exit(1 if failed else 0)
@@ -1,28 +1,65 @@
-from twisted.internet.protocol import Protocol, Factory
-from contract_control import HeadsUpContract, HighCardPokerContract
-from eth_abi import encode_abi, decode_abi
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.internet import reactor, defer, threads, task
+from contract_control import HeadsUpContract, HighCardPokerContract, account_from_key, contract_domain_separator, contract_object, load_abi, nonce_manager, table_id
+from highcard_state import State, cards, is_valid_state_fast_forward
+from strategy import ConsoleStrategy, TableView, FOLD, CALL, RAISE
+from wire import encode_message, decode_message, WIRE_VERSION, MAX_FRAME_LENGTH
+from journal import GameJournal, load_game
+from metrics import timed, count
+from deck import Dealer, NEW_DECK, point_bytes, point_xy, default_engine, high_card_index
+import crypto
 from web3 import Web3
-from ecdsa import ellipticcurve
-import json, random, hashlib, binascii, time, os
-from mentalpoker import *
+import json, random, hashlib, binascii, time, os, string, secrets
 
-cards = ['2c', '2d', '2h', '2s', '3c', '3d', '3h', '3s', '4c', '4d', '4h', '4s', '5c', '5d', '5h', '5s', '6c', '6d', '6h', '6s', '7c', '7d', '7h', '7s', '8c', '8d', '8h', '8s', '9c', '9d', '9h', '9s', 'Tc', 'Td', 'Th', 'Ts', 'Jc', 'Jd', 'Jh', 'Js', 'Qc', 'Qd', 'Qh', 'Qs', 'Kc', 'Kd', 'Kh', 'Ks', 'Ac', 'Ad', 'Ah', 'As']
 empty_address = "0x0000000000000000000000000000000000000000"
 ether = Web3.toWei(1, 'ether')
 gamedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gamestate")
 if not os.path.exists(gamedir):
     os.mkdir(gamedir)
+TABLE_CONTRACT = "0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb"
+POKER_CONTRACT = "0x34cC3183bff750Fb6b2fafA0fcdEFEfb6764873B"
 
-class Player(Protocol):
-    def __init__(self, priv, w3, randomness, buy_in, duration, join_duration, dispute_duration, client):
+def load_domain_separator(w3):
+    # Reads the table contract's DOMAIN_SEPARATOR into the cache before the reactor runs, so
+    # sessions hash table ids without a node request. Raises if it cannot be read.
+    return contract_domain_separator(w3.eth, contract_object(w3.eth, TABLE_CONTRACT, load_abi("headsup.abi")))
+
+def gather(deferreds):
+    # gatherResults that fails with the first error itself instead of a FirstError.
+    return defer.gatherResults(deferreds, consumeErrors=True).addErrback(lambda failure: failure.value.subFailure)
+
+def hand_message_type(state):
+    # Type of the hand message a state travels in: 2 for the commit and for the second reveal
+    # (both reveal keys present), 1 for everything else.
+    ck = state.cards_keys
+    return 2 if state.action == 4 or (state.action == 3 and ck[2] != 0 and ck[7] != 0) else 1
+
+class Player(Int32StringReceiver):
+    MAX_LENGTH = MAX_FRAME_LENGTH
+    gamedir = gamedir
+
+    # msgtype -> (handler, protocol states in which the message is accepted)
+    handlers = {
+        'hello': ('handle_hello', ('INIT', 'READY')),
+        'create': ('handle_create', ('READY',)),
+        'join': ('handle_join', ('READY',)),
+        'shuffle': ('handle_shuffle', ('OPEN', 'SHUFFLE', 'HAND', 'HANDOVER', 'CLOSED')),
+        'hand': ('handle_hand', ('SHUFFLE', 'HAND', 'HANDOVER')),
+        'handover': ('handover', ('HAND', 'HANDOVER')),
+        'resume': ('handle_resume', ('READY', 'RESUME')),
+    }
+
+    def __init__(self, priv, w3, randomness, buy_in, duration, join_duration, dispute_duration, client, strategy=None, nonces=None, pipeline=True, hands_per_deck=26, bundle=True):
         self.state = "INIT"
         self.remote_address = None
         self.players = None
         self.w3 = w3
-        self.account = self.w3.eth.account.privateKeyToAccount(priv)
+        self.account = account_from_key(self.w3.eth, priv)
         self.client = client
-        self.poker_contract = HighCardPokerContract(w3, contract_address="0x34cC3183bff750Fb6b2fafA0fcdEFEfb6764873B")
-        self.table_contract = HeadsUpContract(priv, w3, contract_address="0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb")
+        self.strategy = strategy if strategy is not None else ConsoleStrategy()
+        self.poker_contract = HighCardPokerContract(w3, contract_address=POKER_CONTRACT)
+        self.table_contract = HeadsUpContract(priv, w3, contract_address=TABLE_CONTRACT, nonces=nonces)
         self.randomness = randomness
         self.sessionID = None
         self.buy_in = buy_in
@@ -30,35 +67,64 @@ class Player(Protocol):
         self.join_duration = join_duration
         self.dispute_duration = dispute_duration
         self.default_gas = 3000000
-        self.signed_states = [] 
-        self.dealer = DealerEC(cards=cards)
+        self.signed_states = []
+        self.dealer = Dealer()
+        self.pipeline = pipeline
+        self.dealers = {}
+        self.prepared = {}
+        self.start_when_ready = None
+        self.hands_per_deck = hands_per_deck
+        self.deck_start = None
+        self.card_offset = 0
+        self.hand_cards = None
         self.game_basics = {}
         self.backup_file = None
+        self.journal = None
         self.current_deck = None
-        self.current_state = [0, [0,4], [self.buy_in, self.buy_in, 0, 0], [0, 0, 0, 0, 0, 0, 0, 0], [empty_address, empty_address]]
+        self.current_state = State(0, 0, 4, (self.buy_in, self.buy_in), 0, 0, (0,)*8)
         self.current_state_sigs = {}
-        self.current_recv = b''
-    
-    def dataReceived(self, data):
-        self.current_recv += data
-        if data.decode()[-1] != '\n':
-            return
-        else:
-            line = self.current_recv.strip()
-            self.current_recv = b''
-            msgtype = json.loads(line)['msgtype']
-            if msgtype == "hello":
-                self.handle_hello(line)
-            if msgtype == "create":
-                self.handle_create(line)
-            if msgtype == "join":
-                self.handle_join(line)
-            if msgtype == "shuffle":
-                self.handle_shuffle(line)
-            if msgtype == "hand":
-                self.handle_hand(line)
-            if msgtype == "handover":
-                self.handover(line)
+        self.pending = None
+        self.saved_deck = None
+        self.bundle = bundle
+        self.bundled = []
+        self.events = defer.succeed(None)
+
+    def stringReceived(self, payload):
+        count("messages_received")
+        self.events.addCallback(lambda _: self.dispatch(decode_message(payload)))
+        self.events.addErrback(self.protocol_error)
+
+    def lengthLimitExceeded(self, length):
+        print(f"protocol error: {length} byte frame exceeds the limit (is the peer running an older version?)")
+        self.state = "CLOSED"
+        self.transport.loseConnection()
+
+    def dispatch(self, msg):
+        handler, states = self.handlers[msg['msgtype']]
+        if self.state not in states:
+            raise ValueError(f"unexpected {msg['msgtype']} message in state {self.state}")
+        return getattr(self, handler)(msg)
+
+    def protocol_error(self, failure):
+        print("protocol error:", failure.getErrorMessage())
+        self.state = "CLOSED"
+        self.transport.loseConnection()
+
+    def decide(self, method, *args):
+        # Timed separately so waiting on a strategy (or a human) shows up apart from the protocol.
+        return timed("decide."+method)(defer.maybeDeferred)(getattr(self.strategy, method), self, *args)
+
+    def chain(self, f, *args, **kwargs):
+        return threads.deferToThread(f, *args, **kwargs)
+
+    def sleep(self, seconds):
+        return task.deferLater(reactor, seconds, lambda: None)
+
+    def send(self, msg):
+        data = encode_message(msg)
+        count("messages_sent", msgtype=msg['msgtype'])
+        count("bytes_sent", len(data), msgtype=msg['msgtype'])
+        self.sendString(data)
 
     def connectionMade(self):
         peer = self.transport.getPeer()
@@ -68,26 +134,47 @@ class Player(Protocol):
 
     def connectionLost(self, reason):
         print(self.remote_address, "disconnected")
-        current_encoded = self.poker_contract.encode_state(*self.current_state)
-        if (len(self.current_state_sigs) == 1) and (binascii.hexlify(current_encoded).decode()!=self.signed_states[-1]['state']):
-            unfinished = {'state': binascii.hexlify(current_encoded).decode(), 'signature': self.current_state_sigs[self.account.address]}
-            game = json.dumps({'game': self.game_basics, 'states': self.signed_states, 'unfinished': unfinished})
-            with open(self.backup_file, "w") as f:
-                f.write(game)
+        if isinstance(self.factory, PlayerFactory):
+            self.factory.unregister(self)
+        if self.journal is None:
+            return
+        if (len(self.signed_states) > 0) and (len(self.current_state_sigs) == 1) and (self.current_state.hex!=self.signed_states[-1]['state']):
+            unfinished = {'state': self.current_state.hex, 'signature': self.current_state_sigs[self.account.address]}
+            self.journal.set_unfinished(unfinished)
+        self.journal.close()
+
+    def last_signed(self, state):
+        return len(self.signed_states) > 0 and self.signed_states[-1]['state'] == state.hex
+
+    @timed("journal.append")
+    def record_signed_state(self, state, signatures):
+        # The journal decides how much history is kept: a commit state is a checkpoint, and
+        # what came before it is dropped.
+        self.journal.append_state({'state': state.hex, 'signatures': signatures}, checkpoint=state.action == 4)
+        self.signed_states = self.journal.states
+
+    def start_journal(self):
+        self.game_basics = {'players': self.players, 'start_time': int(time.time()), 'buy_in': self.buy_in, 'duration': self.duration, 'dispute_duration': self.dispute_duration, 'tableID': binascii.hexlify(self.table_contract.tableID).decode(), 'sessionID': binascii.hexlify(self.sessionID).decode()}
+        self.journal = GameJournal(self.backup_file)
+        self.journal.write_game(self.game_basics)
 
     def send_hello(self):
-        msg = {'address': self.account.address, 'sessionID': self.randomness.decode(), 'msgtype': 'hello'}
+        msg = {'version': WIRE_VERSION, 'address': self.account.address, 'sessionID': self.randomness.decode(), 'pipeline': int(self.pipeline), 'hands_per_deck': self.hands_per_deck, 'bundle': int(self.bundle), 'msgtype': 'hello'}
         if not self.client:
             msg['buyin'] = self.buy_in
             msg['duration'] = self.duration
             msg['join_duration'] = self.join_duration
             msg['dispute_duration'] = self.dispute_duration
-        hello = json.dumps(msg)
-        hello = hello + "\n"
-        self.transport.write(str.encode(hello))
-        
+        self.send(msg)
+
     def handle_hello(self, hello):
-        hello = json.loads(hello.decode('utf-8'))
+        if hello['version'] != WIRE_VERSION:
+            raise ValueError(f"peer speaks wire version {hello['version']}, we speak {WIRE_VERSION}")
+        self.pipeline = self.pipeline and hello.get('pipeline', 0) == 1
+        self.hands_per_deck = min(self.hands_per_deck, hello.get('hands_per_deck', 1))
+        self.bundle = self.bundle and hello.get('bundle', 0) == 1
+        if not 1 <= self.hands_per_deck <= len(cards)//2:
+            raise ValueError(f"cannot deal {self.hands_per_deck} hands from one deck")
         address = hello["address"]
         if self.remote_address != None and self.remote_address != address:
             print(f"received hello from {address} while in game with {self.remote_address}")
@@ -104,589 +191,786 @@ class Player(Protocol):
             self.players = [self.account.address, self.remote_address]
             if int(self.players[0][2:], 16) > int(self.players[1][2:], 16):
                 self.players = [self.remote_address, self.account.address]
+            self.table_contract.tableID = table_id(self.table_contract.domain_separator, self.players[0], self.players[1])
+            if isinstance(self.factory, PlayerFactory) and not self.factory.register_table(self):
+                print(f"already playing a table against {address}")
+                self.state = "CLOSED"
+                self.transport.loseConnection()
+                return
             if self.client:
+                saved = self.find_saved_game()
+                if saved is not None:
+                    print("resuming the game saved in", saved[0])
+                    self.restore_game(*saved)
+                    self.send_resume()
+                    return
                 self.sessionID = hashlib.sha256(self.randomness+str.encode(hello['sessionID'])).digest()
-                self.backup_file = os.path.join(gamedir, binascii.hexlify(self.sessionID).decode()+'.pkr')
+                self.backup_file = os.path.join(self.gamedir, binascii.hexlify(self.sessionID).decode()+'.pkr')
                 self.buy_in = hello['buyin']
                 self.duration = hello['duration']
                 self.dispute_duration = hello['dispute_duration']
                 self.join_duration = hello['join_duration']
-                self.current_state[2][0] = self.buy_in
-                self.current_state[2][1] = self.buy_in
-                self.send_create()
+                self.current_state = self.current_state.replace(balances=(self.buy_in, self.buy_in))
+                return self.send_create()
             else:
                 self.sessionID = hashlib.sha256(str.encode(hello['sessionID'])+self.randomness).digest()
-                self.backup_file = os.path.join(gamedir, binascii.hexlify(self.sessionID).decode()+'.pkr')
+                self.backup_file = os.path.join(self.gamedir, binascii.hexlify(self.sessionID).decode()+'.pkr')
                 self.send_hello()
 
+    @timed("send_create")
+    @defer.inlineCallbacks
     def send_create(self):
-        print(f"{self.remote_address} wants to open a table with you. buy in: {self.buy_in/ether} eth; duration: {self.duration}; dispute duration: {self.dispute_duration}")
-        i=input("press enter to accept invitation (type `exit` to reject)")
-        if i=="exit":
+        accepted = yield self.decide('accept_table', self.remote_address, self.buy_in, self.duration, self.dispute_duration)
+        if not accepted:
             raise ValueError("you quit")
         sig = self.table_contract.sign_new_table(self.players, self.buy_in, self.duration, self.join_duration, self.dispute_duration, self.sessionID)
-        create = json.dumps({'v': sig[0], 'r': sig[1], 's': sig[2], 'msgtype': 'create'})
-        create = create + "\n"
-        self.transport.write(str.encode(create))
+        self.send({'v': sig[0], 'r': sig[1], 's': sig[2], 'msgtype': 'create'})
 
+    @timed("handle_create")
+    @defer.inlineCallbacks
     def handle_create(self, create):
-        create = json.loads(create.decode('utf-8'))
         recv_sig = [create['v'], create['r'], create['s']]
         sig = self.table_contract.sign_new_table(self.players, self.buy_in, self.duration, self.join_duration, self.dispute_duration, self.sessionID)
         addr2sig = {self.account.address: sig, self.remote_address: recv_sig}
-        i=input(f"press enter to open a table against {self.remote_address} with a buy in of {self.buy_in/ether} eth")
-        if i == "exit":
+        confirmed = yield self.decide('confirm', f"press enter to open a table against {self.remote_address} with a buy in of {self.buy_in/ether} eth")
+        if not confirmed:
             raise ValueError("you quit")
-        resp = self.table_contract.open_table_tx(addr2sig, self.players, self.buy_in, self.duration, self.join_duration, self.dispute_duration, self.sessionID, self.default_gas)
+        self.state = "OPEN"
+        resp = yield self.chain(self.table_contract.open_table_tx, addr2sig, self.players, self.buy_in, self.duration, self.join_duration, self.dispute_duration, self.sessionID, self.default_gas)
         print("open table tx:", binascii.hexlify(resp))
         print("waiting for opponent confirmation to begin...")
         print()
-        self.game_basics = {'players': self.players, 'start_time': int(time.time()), 'duration': self.duration, 'dispute_duration': self.dispute_duration, 'tableID': binascii.hexlify(self.table_contract.tableID).decode(), 'sessionID': binascii.hexlify(self.sessionID).decode()}
-        join = json.dumps({'tx': binascii.hexlify(resp).decode('utf-8'), 'msgtype':'join', 'buyin': self.buy_in})
-        join = join + "\n"
-        self.transport.write(str.encode(join))
+        self.start_journal()
+        self.send({'tx': binascii.hexlify(resp).decode('utf-8'), 'msgtype':'join', 'buyin': self.buy_in})
 
+    @timed("handle_join")
+    @defer.inlineCallbacks
     def handle_join(self, join):
-        join = json.loads(join.decode('utf-8'))
         print(f"{self.remote_address} opened your table, please wait for game to be confirmed on the blockchain...")
-        wait = True
-        self.game_basics = {'players': self.players, 'start_time': int(time.time()), 'duration': self.duration, 'dispute_duration': self.dispute_duration, 'tableID': binascii.hexlify(self.table_contract.tableID).decode(), 'sessionID': binascii.hexlify(self.sessionID).decode()}
-        while wait:
+        self.state = "OPEN"
+        self.start_journal()
+        while True:
             try:
-                self.table_contract.contract.functions.getTableOverview(self.table_contract.tableID).call()
-                wait = False
-            except:
+                yield self.chain(self.table_contract.table_overview)
+                break
+            except Exception:
                 print("waiting...")
-                time.sleep(5)
-        resp = self.table_contract.join_table_tx(self.players, join['buyin'], self.sessionID, self.default_gas)
+                yield self.sleep(5)
+        resp = yield self.chain(self.table_contract.join_table_tx, self.players, join['buyin'], self.sessionID, self.default_gas)
         print("you joined the game! see tx here:", binascii.hexlify(resp))
         print()
-        self.start_shuffle()
+        yield self.start_shuffle()
+
+    # Resuming after a dropped connection. Instead of opening a new table the client sends a resume
+    # message with the session of its saved game against this opponent, its latest fully signed
+    # state and the half signed state it had sent after that, if any; the host answers the same
+    # from its own journal. Each side checks both signatures on the other's state and that it is
+    # a valid fast forward of its own (isValidStateFastForward, checked locally), and both carry
+    # on from the newer one: whoever holds a half signed successor of it sends that again,
+    # otherwise the player who did not sign it last moves. The saved deck is kept when both
+    # sides saved the same one; pipelined shuffling is off for the rest of a resumed session.
+    def find_saved_game(self, sessionID=None):
+        tableID = binascii.hexlify(self.table_contract.tableID).decode()
+        found = None
+        for name in os.listdir(self.gamedir):
+            if not name.endswith(".pkr"):
+                continue
+            path = os.path.join(self.gamedir, name)
+            try:
+                saved = load_game(path)
+            except Exception:
+                continue
+            game = saved['game']
+            if game is None or game.get('tableID') != tableID or saved['closed']:
+                continue
+            if sessionID is not None and game['sessionID'] != sessionID:
+                continue
+            if found is None or game['start_time'] > found[1]['game']['start_time']:
+                found = (path, saved)
+        return found
+
+    def restore_game(self, path, saved):
+        game = saved['game']
+        states = saved['states']
+        if 'buy_in' in game:
+            self.buy_in = game['buy_in']
+        elif len(states) > 0:
+            last = State.from_hex(states[-1]['state'])
+            self.buy_in = (sum(last.balances)+last.pot)//2
+        else:
+            raise ValueError(f"{path} does not say what the buy in was")
+        self.state = "RESUME"
+        self.backup_file = path
+        self.game_basics = game
+        self.sessionID = binascii.unhexlify(game['sessionID'])
+        self.duration = game['duration']
+        self.dispute_duration = game['dispute_duration']
+        self.table_contract.players = self.players
+        self.table_contract.buy_in_amnt = self.buy_in
+        self.table_contract.sessionID = self.sessionID
+        self.journal = GameJournal(path)
+        self.journal.load(saved)
+        self.signed_states = self.journal.states
+        self.current_state_sigs = {}
+        if len(states) > 0:
+            self.current_state = State.from_hex(states[-1]['state'])
+        else:
+            self.current_state = State(0, 0, 4, (self.buy_in, self.buy_in), 0, 0, (0,)*8)
+        self.pending = None
+        self.bundled = []
+        if saved['unfinished'] != '':
+            self.pending = (State.from_hex(saved['unfinished']['state']), saved['unfinished']['signature'])
+        self.pipeline = False
+        self.dealers = {}
+        self.prepared = {}
+        deck = saved['deck']
+        if deck is not None:
+            self.deck_start = self.saved_deck = deck['start']
+            self.current_deck = [bytes.fromhex(p) for p in deck['deck']]
+            self.dealer = Dealer()
+            self.dealer.keys = [int(k, 16) for k in deck['keys']]
 
+    def send_resume(self):
+        msg = {'msgtype': 'resume', 'sessionID': binascii.hexlify(self.sessionID).decode(), 'deck': self.deck_digest().hex()}
+        if len(self.signed_states) > 0:
+            last = self.signed_states[-1]
+            first, second = (last['signatures'][p] for p in self.players)
+            msg.update({'state': last['state'], 'first_v': first[0], 'first_r': first[1], 'first_s': first[2], 'second_v': second[0], 'second_r': second[1], 'second_s': second[2]})
+        if self.pending is not None:
+            state, sig = self.pending
+            msg.update({'next_state': state.hex, 'next_v': sig[0], 'next_r': sig[1], 'next_s': sig[2]})
+        self.send(msg)
+
+    @timed("handle_resume")
+    def handle_resume(self, resume):
+        if self.state == "READY":
+            if self.client:
+                raise ValueError("unexpected resume message")
+            saved = self.find_saved_game(resume['sessionID'])
+            if saved is None:
+                raise ValueError(f"no saved game {resume['sessionID']} to resume")
+            print("resuming the game saved in", saved[0])
+            self.restore_game(*saved)
+            self.fast_forward(resume)
+            self.send_resume()
+        else:
+            self.fast_forward(resume)
+        return self.continue_game(resume)
+
+    def fast_forward(self, resume):
+        if 'state' not in resume:
+            return
+        mine = self.current_state
+        theirs = State.from_hex(resume['state'])
+        if (theirs.hand, theirs.round) < (mine.hand, mine.round):
+            return
+        if (theirs.hand, theirs.round) == (mine.hand, mine.round):
+            if theirs != mine:
+                raise ValueError("peer holds a different signed state for the same round")
+            return
+        sigs = {self.players[0]: [resume['first_v'], resume['first_r'], resume['first_s']], self.players[1]: [resume['second_v'], resume['second_r'], resume['second_s']]}
+        for player, sig in sigs.items():
+            if not self.table_contract.verify_half_signed_tx(theirs.encoded, sig, player):
+                raise ValueError("received invalid signature on resumed state")
+        if not is_valid_state_fast_forward(mine.encoded, theirs.encoded, self.players, self.buy_in//100):
+            raise ValueError("resumed state is not a valid fast forward of ours")
+        self.current_state = theirs
+        self.record_signed_state(theirs, sigs)
+
+    def follows(self, state, successor, keep_deck):
+        if successor.hand == state.hand:
+            return successor.round == state.round+1
+        return keep_deck and successor.hand == state.hand+1 and successor.round == 1 and state.action == 4
+
+    def continue_game(self, resume):
+        current_state = self.current_state
+        keep_deck = self.deck_start is not None and resume['deck'] == self.deck_digest().hex()
+        if not keep_deck:
+            self.deck_start = self.saved_deck = None
+            self.current_deck = None
+            if current_state.hand > 0 and current_state.action != 4:
+                raise ValueError("cannot resume the hand without its deck")
+        if current_state.hand > 0 and current_state.action != 4:
+            if not self.deck_covers(current_state.hand):
+                raise ValueError("saved deck does not cover the hand being resumed")
+            self.card_offset = 2*(current_state.hand-self.deck_start)
+            self.hand_cards = self.current_deck[self.card_offset:self.card_offset+2]
+        mine = self.pending if self.pending is not None and self.follows(current_state, self.pending[0], keep_deck) else None
+        theirs = 'next_state' in resume and self.follows(current_state, State.from_hex(resume['next_state']), keep_deck)
+        self.pending = None
+        self.state = "HAND"
+        print("resumed at hand", current_state.hand, "round", current_state.round)
+        if mine is not None:
+            state, _ = mine
+            if state.hand != current_state.hand:
+                self.card_offset = 2*(state.hand-self.deck_start)
+                self.hand_cards = self.current_deck[self.card_offset:self.card_offset+2]
+            prev_sig = self.signed_states[-1]['signatures'][self.account.address] if state.hand == current_state.hand else None
+            return self.send_state(hand_message_type(state), current_state, state, prev_sig)
+        elif theirs:
+            return
+        elif len(self.signed_states) == 0:
+            if self.client:
+                return self.start_shuffle()
+        elif current_state.actor != self.account.address:
+            return self.respond(hand_message_type(current_state), current_state, self.signed_states[-1]['signatures'][self.account.address])
+
+    @timed("start_shuffle")
+    @defer.inlineCallbacks
     def start_shuffle(self):
-        self.current_deck = self.dealer.shuffle(self.dealer.new_deck)
-        send_deck = [point2hex(i) for i in self.current_deck]
-        shuffle_1 = json.dumps({'msgtype':'shuffle', 'round': 1, 'deck': send_deck})
-        shuffle_1 = shuffle_1 + "\n"
-        self.transport.write(str.encode(shuffle_1))
+        self.state = "SHUFFLE"
+        self.deck_start = self.current_state.hand+1
+        self.current_deck = yield self.dealer.shuffle(NEW_DECK)
+        self.send({'msgtype':'shuffle', 'round': 1, 'deck': self.current_deck})
 
+    @timed("handle_shuffle")
+    @defer.inlineCallbacks
     def handle_shuffle(self, shuffle):
-        shuffle = json.loads(shuffle.decode('utf-8'))
+        if self.state == "CLOSED":
+            # A background shuffle for a hand that will not be played any more.
+            return
+        if 'hand' in shuffle:
+            yield self.handle_background_shuffle(shuffle)
+            return
+        self.state = "SHUFFLE"
         if shuffle['round'] == 1:
-            recv_deck = [hex2point(i) for i in shuffle['deck']]
-            self.current_deck = self.dealer.shuffle(recv_deck)
-            send_deck = [point2hex(i) for i in self.current_deck[:2]]
-            shuffle_2 = json.dumps({'msgtype':'shuffle', 'round': 2, 'deck': send_deck})
-            shuffle_2 = shuffle_2 + "\n"
-            self.transport.write(str.encode(shuffle_2))
+            self.deck_start = self.current_state.hand+1
+            self.current_deck = yield self.dealer.shuffle(shuffle['deck'])
+            self.send({'msgtype':'shuffle', 'round': 2, 'deck': self.current_deck[:2*self.hands_per_deck]})
         elif shuffle['round'] == 2:
-            recv_deck = [hex2point(i) for i in shuffle['deck']]
-            self.current_deck = self.dealer.deal(recv_deck)
-            send_deck = [point2hex(i) for i in self.current_deck]
+            self.current_deck = yield self.dealer.deal(shuffle['deck'])
             reveal_idx = 1 if self.players[0]==self.account.address else 0
-            shuffle_3 = json.dumps({'msgtype':'shuffle', 'round': 3, 'deck': send_deck, 'key': self.dealer.get_card_key(reveal_idx).alpha})
-            shuffle_3 = shuffle_3 + "\n"
-            self.transport.write(str.encode(shuffle_3))
+            self.send({'msgtype':'shuffle', 'round': 3, 'deck': self.current_deck, 'key': self.dealer.get_card_key(reveal_idx)})
         elif shuffle['round'] == 3:
-            recv_deck = [hex2point(i) for i in shuffle['deck']]
-            self.current_deck = self.dealer.deal(recv_deck)
-            self.start_hand(shuffle['key'])
+            self.current_deck = yield self.dealer.deal(shuffle['deck'])
+            self.send({'msgtype':'shuffle', 'round': 5, 'deck': self.current_deck})
+            yield self.start_hand(shuffle['key'])
         elif shuffle['round'] == 4:
-            recv_deck = [hex2point(i) for i in shuffle['deck']]
-            self.current_deck = recv_deck
-            self.start_hand(shuffle['key'])
+            self.activate_hand(self.current_state.hand+1)
+            yield self.start_hand(shuffle['key'])
+        elif shuffle['round'] == 5:
+            self.current_deck = shuffle['deck']
         else:
             print("bad shuffle message:", shuffle)
             raise ValueError("Unreadable message-- probably go to cash out scenario...")
 
+    # Pipelined mode: the first actor of every hand starts shuffling the next hand's deck right
+    # away. Those shuffle messages carry the hand number they are for and run rounds 1-3 with a
+    # separate dealer, plus a round 5 that hands the final deck and card key back to the
+    # initiator. By the time the hand is over both peers hold the next deck and can start it
+    # without another shuffle exchange.
+    @timed("prepare_next_deck")
+    @defer.inlineCallbacks
+    def prepare_next_deck(self):
+        hand = self.current_state.hand+1
+        dealer = self.dealers[hand] = Dealer()
+        deck = yield dealer.shuffle(NEW_DECK)
+        self.send({'msgtype':'shuffle', 'round': 1, 'deck': deck, 'hand': hand})
+
+    @timed("handle_background_shuffle")
+    @defer.inlineCallbacks
+    def handle_background_shuffle(self, shuffle):
+        hand = shuffle['hand']
+        if not self.pipeline or hand != self.current_state.hand+1:
+            raise ValueError(f"unexpected shuffle for hand {hand}")
+        dealer = self.dealers.setdefault(hand, Dealer())
+        reveal_idx = 1 if self.players[0]==self.account.address else 0
+        if shuffle['round'] == 1:
+            deck = yield dealer.shuffle(shuffle['deck'])
+            self.send({'msgtype':'shuffle', 'round': 2, 'deck': deck[:2*self.hands_per_deck], 'hand': hand})
+        elif shuffle['round'] == 2:
+            deck = yield dealer.deal(shuffle['deck'])
+            self.send({'msgtype':'shuffle', 'round': 3, 'deck': deck, 'key': dealer.get_card_key(reveal_idx), 'hand': hand})
+        elif shuffle['round'] == 3:
+            deck = yield dealer.deal(shuffle['deck'])
+            self.send({'msgtype':'shuffle', 'round': 5, 'deck': deck, 'key': dealer.get_card_key(reveal_idx), 'hand': hand})
+            yield self.deck_prepared(hand, deck, shuffle['key'])
+        elif shuffle['round'] == 5:
+            yield self.deck_prepared(hand, shuffle['deck'], shuffle['key'])
+        else:
+            raise ValueError(f"bad shuffle round {shuffle['round']} for hand {hand}")
+
+    def deck_prepared(self, hand, deck, recv_key):
+        self.prepared[hand] = (deck, recv_key)
+        if self.start_when_ready == hand:
+            self.start_when_ready = None
+            return self.start_prepared_hand()
+
+    def activate_hand(self, hand):
+        # Switch to the dealer and deck prepared in the background for `hand`, if there is one.
+        if hand in self.dealers:
+            self.dealer = self.dealers.pop(hand)
+            self.deck_start = hand
+        prepared = self.prepared.pop(hand, None)
+        if prepared is not None:
+            self.current_deck = prepared[0]
+        return prepared
+
+    # Multi-hand decks: one shuffled deck is dealt over `hands_per_deck` hands without
+    # replacement, hand deck_start+k using cards 2k and 2k+1. Each card has its own key, so
+    # revealing the keys for one hand's cards tells nothing about the others.
+    def deck_covers(self, hand):
+        return self.deck_start is not None and 0 <= hand-self.deck_start < self.hands_per_deck
+
+    def acts_first(self, hand):
+        return (hand%2 != 0) == (self.players[0]==self.account.address)
+
+    def card_key(self, idx):
+        return self.dealer.get_card_key(self.card_offset+idx)
+
+    def save_deck(self):
+        # The journal keeps the deck hands are dealt from (and our keys for it) so a dropped
+        # connection can be resumed in the middle of a hand.
+        if self.saved_deck != self.deck_start:
+            self.saved_deck = self.deck_start
+            self.journal.set_deck({'start': self.deck_start, 'deck': [p.hex() for p in self.current_deck], 'keys': [hex(k) for k in self.dealer.keys]})
+
+    def deck_digest(self):
+        if self.deck_start is None:
+            return b''
+        return hashlib.sha256(self.deck_start.to_bytes(32, 'big') + b''.join(self.current_deck)).digest()
+
+    @defer.inlineCallbacks
+    def start_prepared_hand(self):
+        hand = self.current_state.hand+1
+        if hand not in self.prepared:
+            # The rest of the background shuffle is still in flight; deck_prepared starts the hand.
+            self.start_when_ready = hand
+            return
+        _, recv_key = self.activate_hand(hand)
+        yield self.start_hand(recv_key)
+
+    @timed("sign")
+    def sign_state(self, encoded):
+        return crypto.sign(self.table_contract.state_hash(encoded), self.table_contract.account.privateKey, self.account.address)
+
+    @timed("verify")
+    def verify_state(self, encoded, sig, signer):
+        return crypto.verify(self.table_contract.state_hash(encoded), sig, signer)
+
+    @defer.inlineCallbacks
+    def send_state(self, msg_type, current_state, new_state, prev_sig=None):
+        # With bundling on, the forced moves that follow new_state up to the end of the hand go in
+        # the same message, all signed by us: ours and the opponent's alike (see follow_chain).
+        bundled = []
+        if self.bundle:
+            forced = self.forced_move(new_state)
+            while forced is not None:
+                bundled.append(forced)
+                forced = self.forced_move(forced)
+        my_new_sig, *bundled_sigs = yield gather([self.sign_state(state.encoded) for state in [new_state]+bundled])
+        hand_msg = {'msgtype':'hand', 'type': msg_type, 'previous_state': current_state.hex, 'next_state': new_state.hex, 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2]}
+        if prev_sig is not None:
+            hand_msg.update({'prev_v': prev_sig[0], 'prev_r': prev_sig[1], 'prev_s': prev_sig[2]})
+        if len(bundled) > 0:
+            hand_msg['chain'] = [(state.hex, sig) for state, sig in zip(bundled, bundled_sigs)]
+        self.current_state = new_state
+        self.current_state_sigs = {self.account.address: my_new_sig}
+        self.bundled = list(zip(bundled, bundled_sigs))
+        self.send(hand_msg)
+
+    def forced_move(self, state):
+        # The move that has to follow `state` when there is nothing to decide: the commit after a
+        # fold, and after both reveals the winner's commit or the loser's fold. None when the next
+        # move is a decision or needs a key only its actor knows.
+        if state.action == 3:
+            ck = state.cards_keys
+            if ck[2] == 0 or ck[7] == 0:
+                return None
+        elif state.action != 0:
+            return None
+        actor = 1 if state.actor == self.players[0] else 0
+        new_state = state.replace(round=state.round+1, actor=self.players[actor])
+        if state.action == 3:
+            card1 = self.dealer.reveal_card(self.hand_cards[0], [ck[2], ck[3]])
+            card2 = self.dealer.reveal_card(self.hand_cards[1], [ck[6], ck[7]])
+            if high_card_index(card1, card2) != actor:
+                # Only the actor's balance may change in a transition, so the loser concedes the pot by folding.
+                return new_state.replace(action=0)
+        balances = list(new_state.balances)
+        balances[actor] += new_state.pot
+        return new_state.replace(action=4, balances=balances, pot=0, to_call=0, winner=self.players[actor])
+
+    def check_new_state(self, current_state, new_state):
+        if not self.poker_contract.is_valid_transition(current_state.encoded, new_state.encoded, self.players, self.buy_in):
+            print("last state:", current_state)
+            print("new state:", new_state)
+            raise ValueError(f"invalid new state created here: {current_state.action}")
+
+    def my_index(self):
+        return 0 if self.players[0]==self.account.address else 1
+
+    def with_reveal_key(self, state):
+        cards_keys = list(state.cards_keys)
+        if self.players[0]==self.account.address:
+            cards_keys[2] = self.card_key(0)
+        else:
+            cards_keys[7] = self.card_key(1)
+        return state.replace(action=3, cards_keys=cards_keys)
+
+    def apply_action(self, state, action_type, raise_amnt):
+        me = self.my_index()
+        balances = list(state.balances)
+        if action_type == FOLD:
+            return state.replace(action=0, to_call=0)
+        elif action_type == CALL:
+            balances[me] -= state.to_call
+            return state.replace(action=1, balances=balances, pot=state.pot+state.to_call, to_call=0)
+        elif action_type == RAISE:
+            total_bet = raise_amnt + state.to_call
+            if not (((raise_amnt >= self.buy_in//50) or (total_bet==balances[0]) or (total_bet==balances[1])) and (total_bet<=balances[me])):
+                raise ValueError("invalid raise amount entered")
+            if raise_amnt > balances[(me+1)%2]:
+                raise_amnt = balances[(me+1)%2]
+                total_bet = raise_amnt + state.to_call
+            balances[me] -= total_bet
+            return state.replace(action=2, balances=balances, pot=state.pot+total_bet, to_call=raise_amnt)
+        raise ValueError("bad input try again!")
+
+    def table_view(self, current_state, new_state, card):
+        me = self.my_index()
+        opponent_action = current_state.action if new_state.round > 1 else None
+        return TableView(new_state.hand, new_state.round, card, new_state.balances[me], new_state.balances[1-me], new_state.pot, new_state.to_call, self.buy_in//50, opponent_action)
+
+    @defer.inlineCallbacks
+    def ask_action(self, current_state, new_state, card, max_mistakes=8):
+        for _ in range(max_mistakes):
+            action_type, raise_amnt = yield self.decide('choose_action', self.table_view(current_state, new_state, card))
+            try:
+                candidate = self.apply_action(new_state, action_type, raise_amnt)
+                new_encoded = candidate.encoded
+            except ValueError as e:
+                print(e)
+                continue
+            if self.poker_contract.is_valid_transition(current_state.encoded, new_encoded, self.players, self.buy_in):
+                return candidate
+            print("invalid state transition??")
+        raise ValueError("too many mistakes")
+
+    def print_showdown(self, card1, card2):
+        if self.players[0]==self.account.address:
+            print(f"your card: {card1} opp card: {card2}")
+        else:
+            print(f"your card: {card2} opp card: {card1}")
+        try:
+            winner = high_card_index(card1, card2)
+            won = winner == self.my_index()
+            print(f"high card: {(card1, card2)[winner]}, you {'won' if won else 'lost'}.")
+        except KeyError:
+            pass
+
+    def print_stacks(self, card, state):
+        me = self.my_index()
+        print("your card:", card, "your stack:", state.balances[me]/ether, "opp stack:", state.balances[(me+1)%2]/ether)
+        print("pot:", state.pot/ether, "to call:", state.to_call/ether)
+
+    @timed("start_hand")
+    @defer.inlineCallbacks
     def start_hand(self, recv_key):
-        if (((self.current_state[0]+1)%2 == 0) and (self.players[0]==self.account.address)) or (((self.current_state[0]+1)%2 != 0) and (self.players[0]!=self.account.address)):
+        self.state = "HAND"
+        current_state = self.current_state
+        hand = current_state.hand+1
+        self.card_offset = 2*(hand-self.deck_start)
+        self.hand_cards = self.current_deck[self.card_offset:self.card_offset+2]
+        self.save_deck()
+        if not self.acts_first(hand):
             print("... passing back not my turn to act first...")
             reveal_idx = 1 if self.players[0]==self.account.address else 0
-            pass_msg = json.dumps({'msgtype':'shuffle', 'round': 4, 'deck': [point2hex(i) for i in self.current_deck], 'key': self.dealer.get_card_key(reveal_idx).alpha})
-            pass_msg = pass_msg + "\n"
-            self.transport.write(str.encode(pass_msg))
+            self.send({'msgtype':'shuffle', 'round': 4, 'deck': [], 'key': self.card_key(reveal_idx)})
+            return
+        (x0, y0), (x1, y1) = point_xy(self.hand_cards[0]), point_xy(self.hand_cards[1])
+        small_blind, big_blind = self.buy_in//100, self.buy_in//50
+        if self.players[0]==self.account.address:
+            card = self.dealer.reveal_card(self.hand_cards[0], [self.card_key(0), recv_key])
+            balances = (current_state.balances[0]-small_blind, current_state.balances[1]-big_blind)
+            cards_keys = (x0, y0, 0, recv_key, x1, y1, self.card_key(1), 0)
         else:
-            current_encoded = self.poker_contract.encode_state(*self.current_state)
-            new_state = [self.current_state[0]+1, [1, None], [None, None, 3*(self.buy_in//100), self.buy_in//100], [self.current_deck[0].x(), self.current_deck[0].y(), 0, None, self.current_deck[1].x(), self.current_deck[1].y(), None, 0], [self.account.address, empty_address]]
-            if self.players[0]==self.account.address:
-                card = self.dealer.reveal_card(self.current_deck[0], [self.dealer.get_card_key(0), ECPrivateKey(alpha=recv_key)])
-                new_state[2][0] = self.current_state[2][0]-self.buy_in//100
-                new_state[2][1] = self.current_state[2][1]-self.buy_in//50
-                new_state[3][3] = recv_key
-                new_state[3][6] = self.dealer.get_card_key(1).alpha
-                print("your card:", card, "your stack:", new_state[2][0]/ether, "opp stack:", new_state[2][1]/ether)
-            else:
-                card = self.dealer.reveal_card(self.current_deck[1], [self.dealer.get_card_key(1), ECPrivateKey(alpha=recv_key)])
-                new_state[2][0] = self.current_state[2][0]-self.buy_in//50
-                new_state[2][1] = self.current_state[2][1]-self.buy_in//100
-                new_state[3][3] = self.dealer.get_card_key(0).alpha
-                new_state[3][6] = recv_key
-                print("your card:", card, "your stack:", new_state[2][1]/ether, "opp stack:", new_state[2][0]/ether)
-            print("pot:", new_state[2][2]/ether, "to call:", new_state[2][3]/ether)
-            continue_ = False
-            new_encoded = None
-            i = 0
-            while not continue_:
-                i += 1
-                action_type = input("[fold=0, call=1, raise=2]: ")
-                if i > 8:
-                    raise ValueError("too many mistakes")
-                if action_type=="0":
-                    new_state[1][1] = 0
-                    new_state[2][3] = 0
-                    new_encoded = self.poker_contract.encode_state(*new_state)
-                    valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                    if valid:
-                        continue_ = True
-                    else:
-                        print("invalid state transition??")
-                elif action_type=="1":
-                    new_state[1][1] = 1
-                    new_state[2][3] = 0
-                    new_state[2][2] += self.buy_in//100
-                    if self.players[0]==self.account.address:
-                        new_state[2][0] -= self.buy_in//100
-                    else:
-                        new_state[2][1] -= self.buy_in//100
-                    new_encoded = self.poker_contract.encode_state(*new_state)
-                    valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                    if valid:
-                        continue_ = True
-                    else:
-                        print("invalid state transition??")
-                elif action_type=="2":
-                    raise_str = input(f"call {new_state[2][3]/ether} and raise ({(self.buy_in//50)/ether} min):")
-                    try:
-                        raise_amnt = Web3.toWei(float(raise_str), 'ether')
-                        total_bet = raise_amnt + new_state[2][3]
-                        if ((raise_amnt >= self.buy_in//50) or (total_bet==new_state[2][0]) or (total_bet==new_state[2][1])) and (((total_bet<=new_state[2][0]) and (self.players[0] == self.account.address)) or ((total_bet<=new_state[2][1]) and (self.players[1] == self.account.address))):
-                            if (self.account.address == self.players[0]) and (raise_amnt > new_state[2][1]):
-                                raise_amnt = new_state[2][1]
-                                total_bet = raise_amnt + new_state[2][3]
-                            elif (self.account.address == self.players[1]) and (raise_amnt > new_state[2][0]):
-                                raise_amnt = new_state[2][0]
-                                total_bet = raise_amnt + new_state[2][3]                                
-                            new_state[1][1] = 2
-                            new_state[2][2] += total_bet
-                            new_state[2][3] = raise_amnt
-                        else:
-                            raise ValueError("")
-                        if self.players[0]==self.account.address:
-                            new_state[2][0] -= total_bet
-                        else:
-                            new_state[2][1] -= total_bet
-                        new_encoded = self.poker_contract.encode_state(*new_state)
-                        valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                        if valid:
-                            continue_ = True
-                        else:
-                            print("invalid state transition??")
-                    except:
-                        print("invalid raise amount entered")
-                else:
-                    action_type=None
-                    print("bad input try again!")
-            sig = self.table_contract.sign_table_tx(new_encoded)
-            idx = 0
-            while not self.table_contract.verify_half_signed_tx(new_encoded, sig, self.account.address):
-                idx += 1
-                sig = self.table_contract.sign_table_tx(new_encoded)
-                if idx > 10:
-                    raise ValueError("created invalid signature on state transition")
-            hand_msg = json.dumps({'msgtype':'hand', 'type': 1, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': sig[0], 'next_r': sig[1], 'next_s': sig[2]})
-            hand_msg = hand_msg + "\n"
-            self.current_state = new_state
-            self.current_state_sigs = {self.account.address: sig}
-            self.transport.write(str.encode(hand_msg))
+            card = self.dealer.reveal_card(self.hand_cards[1], [self.card_key(1), recv_key])
+            balances = (current_state.balances[0]-big_blind, current_state.balances[1]-small_blind)
+            cards_keys = (x0, y0, 0, self.card_key(0), x1, y1, recv_key, 0)
+        # The action is filled in by apply_action once the strategy has chosen.
+        new_state = State(hand, 1, None, balances, 3*small_blind, small_blind, cards_keys, self.account.address)
+        self.print_stacks(card, new_state)
+        new_state = yield self.ask_action(current_state, new_state, card)
+        yield self.send_state(1, current_state, new_state)
+        if self.pipeline and not self.deck_covers(hand+1):
+            yield self.prepare_next_deck()
 
+    @timed("handle_hand")
+    @defer.inlineCallbacks
     def handle_hand(self, hand):
-        hand = json.loads(hand.decode('utf-8'))
+        self.state = "HAND"
         player = self.players[0] if self.players[1]==self.account.address else self.players[1]
         new_encoded = binascii.unhexlify(hand['next_state'])
         prev_encoded = binascii.unhexlify(hand['previous_state'])
-        current_encoded = self.poker_contract.encode_state(*self.current_state)
-        new_decoded = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], new_encoded)
-        prev_decoded = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], prev_encoded)
-        if prev_encoded != current_encoded:
+        current_state = self.current_state
+        if prev_encoded != current_state.encoded:
             raise ValueError("received mismatching state")
-        if not self.poker_contract.is_valid_transition(prev_encoded, new_encoded, self.players, self.buy_in):
-            raise ValueError("received invalid state transition")
+        received = State.from_hex(hand['next_state'])
         new_sig = [hand['next_v'], hand['next_r'], hand['next_s']]
-        if not self.table_contract.verify_half_signed_tx(new_encoded, new_sig, player):
-            raise ValueError("received invalid signature on state transition")
-        new_sigs = {self.remote_address: new_sig}
-        my_sig = self.table_contract.sign_table_tx(new_encoded)
-        new_sigs[self.account.address] = my_sig
-        if (new_decoded[0] == self.current_state[0]) and (new_decoded[1][0] != 1):
+        completes_previous = (received.hand == current_state.hand) and (received.round != 1) and not self.last_signed(current_state)
+        # The opponent's signatures are checked on the crypto workers while the transition is
+        # validated here. We only sign the state once both have passed.
+        checks = [self.verify_state(new_encoded, new_sig, player)]
+        if completes_previous:
             prev_sig = [hand['prev_v'], hand['prev_r'], hand['prev_s']]
-            if not self.table_contract.verify_half_signed_tx(prev_encoded, prev_sig, player):
+            checks.append(self.verify_state(prev_encoded, prev_sig, player))
+        checks = gather(checks)
+        valid = self.poker_contract.is_valid_transition(prev_encoded, new_encoded, self.players, self.buy_in)
+        signed_by_peer, *previous_signed = yield checks
+        if not valid:
+            raise ValueError("received invalid state transition")
+        if not signed_by_peer:
+            raise ValueError("received invalid signature on state transition")
+        my_sig = yield self.sign_state(new_encoded)
+        new_sigs = {self.remote_address: new_sig, self.account.address: my_sig}
+        if completes_previous:
+            if not previous_signed[0]:
                 print(prev_sig)
                 raise ValueError("received invalid signature on state transition")
             self.current_state_sigs[self.remote_address] = prev_sig
             if len(self.current_state_sigs) != 2:
                 raise ValueError("Missing own signature on previous state somehow")
-            self.signed_states.append({'state': binascii.hexlify(current_encoded).decode(), 'signatures': self.current_state_sigs})
-        elif new_decoded[0] != self.current_state[0]:
-            self.current_deck = [ellipticcurve.Point(DEFAULT_CURVE.curve, new_decoded[3][0], new_decoded[3][1]), ellipticcurve.Point(DEFAULT_CURVE.curve, new_decoded[3][4], new_decoded[3][5])]
-        self.signed_states.append({'state': binascii.hexlify(new_encoded).decode(), 'signatures': new_sigs})
-        game = json.dumps({'game': self.game_basics, 'states': self.signed_states, 'unfinished':''})
-        with open(self.backup_file, "w") as f:
-            f.write(game)
+            self.record_signed_state(current_state, self.current_state_sigs)
+        elif received.hand != current_state.hand:
+            self.activate_hand(received.hand)
+            self.card_offset = 2*(received.hand-self.deck_start)
+            ck = received.cards_keys
+            self.hand_cards = [point_bytes(ck[0], ck[1]), point_bytes(ck[4], ck[5])]
+            if self.hand_cards != self.current_deck[self.card_offset:self.card_offset+2]:
+                raise ValueError("hand is not dealt from the agreed deck")
+            self.save_deck()
+        self.record_signed_state(received, new_sigs)
         self.current_state_sigs = {}
-        self.current_state = new_decoded
-        new_state = [self.current_state[0],] + [list(self.current_state[i]) for i in range(1, len(self.current_state))]
-        new_state[1][0] += 1
-        new_state[4][0] = self.account.address
-        current_encoded = new_encoded
-        new_encoded = None
-        if hand["type"] == 1:
-            if (self.current_state[1][1] == 2) or (self.current_state[1][1] == 1 and self.current_state[1][0] == 1):
-                if self.players[0]==self.account.address:
-                    card = self.dealer.reveal_card(self.current_deck[0], [self.dealer.get_card_key(0), ECPrivateKey(alpha=new_state[3][3])])
-                    print("your card:", card, "your stack:", new_state[2][0]/ether, "opp stack:", new_state[2][1]/ether)
-                else:
-                    card = self.dealer.reveal_card(self.current_deck[1], [self.dealer.get_card_key(1), ECPrivateKey(alpha=new_state[3][6])])
-                    print("your card:", card, "your stack:", new_state[2][1]/ether, "opp stack:", new_state[2][0]/ether)
-                print("pot:", new_state[2][2]/ether, "to call:", new_state[2][3]/ether)
-                continue_ = False
-                i = 0
-                while not continue_:
-                    i += 1
-                    action_type = input("[fold=0, call=1, raise=2]:")
-                    if i > 8:
-                        raise ValueError("too many mistakes")
-                    if action_type=="0":
-                        new_state[1][1] = 0
-                        new_state[2][3] = 0
-                        new_encoded = self.poker_contract.encode_state(*new_state)
-                        valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                        if valid:
-                            continue_ = True
-                        else:
-                            print("invalid state transition??")
-                    elif action_type=="1":
-                        to_call = new_state[2][3]
-                        new_state[1][1] = 1
-                        new_state[2][3] = 0
-                        new_state[2][2] += to_call
-                        if self.players[0]==self.account.address:
-                            new_state[2][0] -= to_call
-                        else:
-                            new_state[2][1] -= to_call
-                        new_encoded = self.poker_contract.encode_state(*new_state)
-                        valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                        if valid:
-                            continue_ = True
-                        else:
-                            print("invalid state transition??")
-                    elif action_type=="2":
-                        raise_str = input(f"call {new_state[2][3]/ether} and raise ({(self.buy_in//50)/ether} min):")
-                        try:
-                            raise_amnt = Web3.toWei(float(raise_str), 'ether')
-                            total_bet = raise_amnt + new_state[2][3]
-                            if ((raise_amnt >= self.buy_in//50) or (total_bet==new_state[2][0]) or (total_bet==new_state[2][1])) and (((total_bet<=new_state[2][0]) and (self.players[0] == self.account.address)) or ((total_bet<=new_state[2][1]) and (self.players[1] == self.account.address))):
-                                if (self.account.address == self.players[0]) and (raise_amnt > new_state[2][1]):
-                                    raise_amnt = new_state[2][1]
-                                    total_bet = raise_amnt + new_state[2][3]
-                                elif (self.account.address == self.players[1]) and (raise_amnt > new_state[2][0]):
-                                    raise_amnt = new_state[2][0]
-                                    total_bet = raise_amnt + new_state[2][3]
-                                new_state[1][1] = 2
-                                new_state[2][2] += total_bet
-                                new_state[2][3] = raise_amnt
-                            else:
-                                raise ValueError("")
-                            if self.players[0]==self.account.address:
-                                new_state[2][0] -= total_bet
-                            else:
-                                new_state[2][1] -= total_bet
-                            new_encoded = self.poker_contract.encode_state(*new_state)
-                            valid = self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in)
-                            if valid:
-                                continue_ = True
-                            else:
-                                print("invalid state transition??")
-                        except:
-                            print("invalid raise amount entered")
-                    else:
-                        print("bad input try again!")
-                my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                idx = 0
-                while not self.table_contract.verify_half_signed_tx(new_encoded, my_new_sig, self.account.address):
-                    idx += 1
-                    my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                    if idx > 10:
-                        raise ValueError("created invalid signature on state transition")
-                hand_msg = json.dumps({'msgtype':'hand', 'type': 1, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2]})
-                hand_msg = hand_msg + "\n"
-                self.current_state = new_state
-                self.current_state_sigs = {self.account.address: my_new_sig}
-                self.transport.write(str.encode(hand_msg))
-            elif self.current_state[1][1] == 0:
-                new_state[4][1] = self.account.address
-                if self.players[0]==self.account.address:
-                    new_state[2][0] += new_state[2][2]
-                else:
-                    new_state[2][1] += new_state[2][2]
-                new_state[2][2] = 0
-                new_state[2][3] = 0
-                new_state[1][1] = 4
-                new_encoded = self.poker_contract.encode_state(*new_state)
-                if not self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in):
-                    raise ValueError(f"invalid new state created here: {self.current_state[1][1]}")
-                my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                idx = 0
-                while not self.table_contract.verify_half_signed_tx(new_encoded, my_new_sig, self.account.address):
-                    idx += 1
-                    my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                    if idx > 10:
-                        raise ValueError("created invalid signature on state transition")
-                hand_msg = json.dumps({'msgtype':'hand', 'type': 2, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2]})
-                hand_msg = hand_msg + "\n"
-                self.current_state = new_state
-                self.current_state_sigs = {self.account.address: my_new_sig}
-                self.transport.write(str.encode(hand_msg))
-            elif self.current_state[1][1] == 1:
-                if self.players[0]==self.account.address:
-                    new_state[3][2] = self.dealer.get_card_key(0).alpha
-                else:
-                    new_state[3][7] = self.dealer.get_card_key(1).alpha
-                new_state[1][1] = 3
-                new_encoded = self.poker_contract.encode_state(*new_state)
-                if not self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in):
-                    raise ValueError(f"invalid new state created here: {self.current_state[1][1]}")
-                my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                idx = 0
-                while not self.table_contract.verify_half_signed_tx(new_encoded, my_new_sig, self.account.address):
-                    idx += 1
-                    my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                    if idx > 10:
-                        raise ValueError("created invalid signature on state transition")
-                hand_msg = json.dumps({'msgtype':'hand', 'type': 1, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2]})
-                hand_msg = hand_msg + "\n"
-                self.current_state = new_state
-                self.current_state_sigs = {self.account.address: my_new_sig}
-                self.transport.write(str.encode(hand_msg))
-            elif self.current_state[1][1] == 3:
+        self.current_state = received
+        if 'chain' in hand:
+            yield self.follow_chain(received, hand['chain'])
+        else:
+            yield self.respond(hand["type"], received, my_sig)
+
+    @defer.inlineCallbacks
+    def follow_chain(self, state, chain):
+        # Forced moves the opponent bundled after the fully signed `state`. They are checked in
+        # order like single hand messages: each one is a valid transition from the one before and
+        # is exactly the forced move, our own moves included (the opponent signed those ahead, we
+        # make the same ones). The last one commits the hand, so once they all pass we sign them
+        # and hand over.
+        if not self.bundle:
+            raise ValueError("received bundled states without agreeing to bundling")
+        states = [State.from_hex(hexstr) for hexstr, _ in chain]
+        checks = gather([self.verify_state(s.encoded, sig, self.remote_address) for s, (_, sig) in zip(states, chain)])
+        valid = len(states) > 0 and states[-1].action == 4
+        previous = state
+        for s in states:
+            valid = valid and s == self.forced_move(previous) and self.poker_contract.is_valid_transition(previous.encoded, s.encoded, self.players, self.buy_in)
+            previous = s
+        signed_by_peer = yield checks
+        if not valid:
+            raise ValueError("received invalid bundled states")
+        if not all(signed_by_peer):
+            raise ValueError("received invalid signature on bundled states")
+        my_sigs = yield gather([self.sign_state(s.encoded) for s in states])
+        if state.action == 3:
+            ck = state.cards_keys
+            self.print_showdown(self.dealer.reveal_card(self.hand_cards[0], [ck[2], ck[3]]), self.dealer.reveal_card(self.hand_cards[1], [ck[6], ck[7]]))
+            yield self.decide('confirm', "press enter (to continue)")
+        for s, (_, sig), my_sig in zip(states, chain, my_sigs):
+            self.record_signed_state(s, {self.remote_address: sig, self.account.address: my_sig})
+        self.current_state = states[-1]
+        yield self.end_hand(states[-1].hex, my_sigs[-1])
+
+    @defer.inlineCallbacks
+    def respond(self, hand_type, current_state, my_sig):
+        # Our move after the fully signed `current_state`, which came in a hand message of type
+        # `hand_type` (my_sig is our signature on it).
+        new_state = current_state.replace(round=current_state.round+1, actor=self.account.address)
+        ck = current_state.cards_keys
+        if hand_type == 1:
+            if (current_state.action == 2) or (current_state.action == 1 and current_state.round == 1):
                 if self.players[0]==self.account.address:
-                    new_state[3][2] = self.dealer.get_card_key(0).alpha
-                    card1 = self.dealer.reveal_card(self.current_deck[0], [ECPrivateKey(alpha=new_state[3][2]), ECPrivateKey(alpha=new_state[3][3])])
-                    card2 = self.dealer.reveal_card(self.current_deck[1], [ECPrivateKey(alpha=new_state[3][6]), ECPrivateKey(alpha=new_state[3][7])])
-                    print(f"your card: {card1} opp card: {card2}")
+                    card = self.dealer.reveal_card(self.hand_cards[0], [self.card_key(0), ck[3]])
                 else:
-                    new_state[3][7] = self.dealer.get_card_key(1).alpha
-                    card1 = self.dealer.reveal_card(self.current_deck[0], [ECPrivateKey(alpha=new_state[3][2]), ECPrivateKey(alpha=new_state[3][3])])
-                    card2 = self.dealer.reveal_card(self.current_deck[1], [ECPrivateKey(alpha=new_state[3][6]), ECPrivateKey(alpha=new_state[3][7])])
-                    print(f"your card: {card2} opp card: {card1}")
-                try:
-                    if cards.index(card1) < cards.index(card2):
-                        if self.players[0]==self.account.address:
-                            print(f"high card: {card2}, you lost.")
-                        else:
-                            print(f"high card: {card2}, you won.")
-                    else:
-                        if self.players[0]==self.account.address:
-                            print(f"high card: {card1}, you won.")
-                        else:
-                            print(f"high card: {card1}, you lost.")
-                except:
-                    pass
-                input("press enter (to reveal)")
-                new_state[1][1] = 3
-                new_encoded = self.poker_contract.encode_state(*new_state)
-                if not self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in):
-                    raise ValueError(f"invalid new state created here: {self.current_state[1][1]}")
-                my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                idx = 0
-                while not self.table_contract.verify_half_signed_tx(new_encoded, my_new_sig, self.account.address):
-                    idx += 1
-                    my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                    if idx > 10:
-                        raise ValueError("created invalid signature on state transition")
-                hand_msg = json.dumps({'msgtype':'hand', 'type': 2, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2]})
-                hand_msg = hand_msg + "\n"
-                self.current_state = new_state
-                self.current_state_sigs = {self.account.address: my_new_sig}
-                self.transport.write(str.encode(hand_msg))
+                    card = self.dealer.reveal_card(self.hand_cards[1], [self.card_key(1), ck[6]])
+                self.print_stacks(card, new_state)
+                new_state = yield self.ask_action(current_state, new_state, card)
+                yield self.send_state(1, current_state, new_state, my_sig)
+            elif current_state.action == 0:
+                new_state = self.forced_move(current_state)
+                self.check_new_state(current_state, new_state)
+                yield self.send_state(2, current_state, new_state, my_sig)
+            elif current_state.action == 1:
+                new_state = self.with_reveal_key(new_state)
+                self.check_new_state(current_state, new_state)
+                yield self.send_state(1, current_state, new_state, my_sig)
+            elif current_state.action == 3:
+                new_state = self.with_reveal_key(new_state)
+                nk = new_state.cards_keys
+                card1 = self.dealer.reveal_card(self.hand_cards[0], [nk[2], nk[3]])
+                card2 = self.dealer.reveal_card(self.hand_cards[1], [nk[6], nk[7]])
+                self.print_showdown(card1, card2)
+                yield self.decide('confirm', "press enter (to reveal)")
+                self.check_new_state(current_state, new_state)
+                yield self.send_state(2, current_state, new_state, my_sig)
             else:
                 raise ValueError("Hand message round 2 is not properly formatted")
-        if hand["type"] == 2:
-            if self.current_state[1][1] == 3:
-                new_state[1][1] = 4
-                card1 = self.dealer.reveal_card(self.current_deck[0], [ECPrivateKey(alpha=self.current_state[3][2]), ECPrivateKey(alpha=self.current_state[3][3])])
-                card2 = self.dealer.reveal_card(self.current_deck[1], [ECPrivateKey(alpha=self.current_state[3][6]), ECPrivateKey(alpha=self.current_state[3][7])])
-                if self.players[0]==self.account.address:
-                    print(f"your card: {card1} opp card: {card2}")
-                else:
-                    print(f"your card: {card2} opp card: {card1}")
-                try:
-                    if cards.index(card1) < cards.index(card2):
-                        new_state[4][1] = self.players[1]
-                        new_state[2][1] += new_state[2][2]
-                        new_state[2][2] = 0
-                        new_state[2][3] = 0
-                        if self.players[0]==self.account.address:
-                            print(f"high card: {card2}, you lost.")
-                        else:
-                            print(f"high card: {card2}, you won.")
-                    else:
-                        new_state[4][1] = self.players[0]
-                        new_state[2][0] += new_state[2][2]
-                        new_state[2][2] = 0
-                        new_state[2][3] = 0
-                        if self.players[0]==self.account.address:
-                            print(f"high card: {card1}, you won.")
-                        else:
-                            print(f"high card: {card1}, you lost.")
-                except:
-                    pass
-                input("press enter (to continue)")
-                new_encoded = self.poker_contract.encode_state(*new_state)
-                if not self.poker_contract.is_valid_transition(current_encoded, new_encoded, self.players, self.buy_in):
-                    print("last state:", self.current_state)
-                    print("new state:", new_state)
-                    raise ValueError(f"invalid new state created here: {self.current_state[1][1]}")
-                my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                idx = 0
-                while not self.table_contract.verify_half_signed_tx(new_encoded, my_new_sig, self.account.address):
-                    idx += 1
-                    my_new_sig = self.table_contract.sign_table_tx(new_encoded)
-                    if idx > 10:
-                        raise ValueError("created invalid signature on state transition")
-                hand_msg = json.dumps({'msgtype':'hand', 'type': 2, 'previous_state': binascii.hexlify(current_encoded).decode(), 'next_state': binascii.hexlify(new_encoded).decode(), 'next_v': my_new_sig[0], 'next_r': my_new_sig[1], 'next_s': my_new_sig[2], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2]})
-                hand_msg = hand_msg + "\n"
-                self.current_state = new_state
-                self.current_state_sigs = {self.account.address: my_new_sig}
-                self.transport.write(str.encode(hand_msg))
-            elif self.current_state[1][1] == 4:
-                i = 0
-                continue_ = False
-                while not continue_:
-                    i += 1
-                    action_type = None
-                    wait = True
-                    if (self.current_state[2][0] == 0) or (self.current_state[2][1] == 0):
-                        print("game over")
-                        if ((self.players[0] == self.account.address) and (self.current_state[2][0] == 0)) or ((self.players[1] == self.account.address) and (self.current_state[2][1] == 0)):
-                            print("you lost")
-                        else:
-                            print("you won!")
-                        action_type = "2"
-                        wait = False
-                    else:                     
-                        action_type = input("[continue playing=1, cash out=2]:")
-                    if i > 8:
-                        raise ValueError("too many mistakes")
-                    if action_type == "1":
-                        hand_msg = json.dumps({'msgtype':'handover', 'previous_state': hand['next_state'], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], "stop": 0, "tx": ""})
-                        hand_msg = hand_msg + "\n"
-                        continue_ = True
-                        self.transport.write(str.encode(hand_msg))                        
-                    elif action_type == "2":
-                        try:
-                            signed_state = self.signed_states[-1]
-                            tx = self.table_contract.propose_settlement(signed_state["signatures"], binascii.unhexlify(signed_state["state"]), 2*self.default_gas)
-                            print(f"proposed settlement. Tx here: {binascii.hexlify(tx)}")
-                            hand_msg = json.dumps({'msgtype':'handover', 'previous_state': hand['next_state'], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], 'stop': 1, 'tx': binascii.hexlify(tx).decode()})
-                            hand_msg = hand_msg + "\n"
-                            if wait == True:
-                                print(f"{self.dispute_duration} seconds before money can be remitted... RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
-                            else:
-                                print(f"eth should be cashed out!")
-                            continue_ = True
-                            self.transport.write(str.encode(hand_msg))
-                        except:
-                            print(f"RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
-                            return            
-                    else:
-                        print("invalid input try again.")
+        if hand_type == 2:
+            if current_state.action == 3:
+                card1 = self.dealer.reveal_card(self.hand_cards[0], [ck[2], ck[3]])
+                card2 = self.dealer.reveal_card(self.hand_cards[1], [ck[6], ck[7]])
+                self.print_showdown(card1, card2)
+                yield self.decide('confirm', "press enter (to continue)")
+                new_state = self.forced_move(current_state)
+                self.check_new_state(current_state, new_state)
+                yield self.send_state(hand_message_type(new_state), current_state, new_state, my_sig)
+            elif current_state.action == 4:
+                yield self.end_hand(current_state.hex, my_sig)
+
+    @timed("end_hand")
+    @defer.inlineCallbacks
+    def end_hand(self, final_state, my_sig):
+        wait = True
+        if 0 in self.current_state.balances:
+            print("game over")
+            print("you lost" if self.current_state.balances[self.my_index()] == 0 else "you won!")
+            keep_playing = False
+            wait = False
+        else:
+            keep_playing = yield self.decide('continue_playing', self.current_state)
+        if keep_playing:
+            self.state = "HANDOVER"
+            msg = {'msgtype':'handover', 'previous_state': final_state, 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], "stop": 0, "tx": ""}
+            next_hand = self.current_state.hand+1
+            if self.deck_covers(next_hand) and not self.acts_first(next_hand):
+                # The opponent opens the next hand from this deck and needs our key for its card.
+                msg['key'] = self.dealer.get_card_key(2*(next_hand-self.deck_start) + (0 if next_hand%2 != 0 else 1))
+            self.send(msg)
+            return
+        self.state = "CLOSED"
+        self.journal.mark_closed()
+        try:
+            signed_state = self.signed_states[-1]
+            tx = yield self.chain(self.table_contract.propose_settlement, signed_state["signatures"], binascii.unhexlify(signed_state["state"]), 2*self.default_gas)
+        except Exception:
+            print(f"RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
+            return
+        print(f"proposed settlement. Tx here: {binascii.hexlify(tx)}")
+        if wait == True:
+            print(f"{self.dispute_duration} seconds before money can be remitted... RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
+        else:
+            print(f"eth should be cashed out!")
+        self.send({'msgtype':'handover', 'previous_state': final_state, 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], 'stop': 1, 'tx': binascii.hexlify(tx).decode()})
 
+    @timed("handover")
+    @defer.inlineCallbacks
     def handover(self, hand):
-        hand = json.loads(hand.decode('utf-8'))
         player = self.players[0] if self.players[1]==self.account.address else self.players[1]
         prev_encoded = binascii.unhexlify(hand['previous_state'])
-        current_encoded = self.poker_contract.encode_state(*self.current_state)
-        if prev_encoded != current_encoded:
-            print(decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], current_encoded))
-            print(decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], prev_encoded))
+        if len(self.bundled) > 0 and prev_encoded == self.bundled[-1][0].encoded:
+            # The opponent took the moves we bundled and hands over after the last of them.
+            self.current_state, my_sig = self.bundled[-1]
+            self.current_state_sigs = {self.account.address: my_sig}
+        self.bundled = []
+        current_state = self.current_state
+        if prev_encoded != current_state.encoded:
+            print("our state:", current_state)
+            print("received:", hand['previous_state'])
             raise ValueError("received invalid state")
-        sig = [hand["prev_v"], hand["prev_r"], hand["prev_s"]]      
-        if not self.table_contract.verify_half_signed_tx(prev_encoded, sig, player):
+        sig = [hand["prev_v"], hand["prev_r"], hand["prev_s"]]
+        signed_by_peer = yield self.verify_state(prev_encoded, sig, player)
+        if not signed_by_peer:
             raise ValueError("received invalid signature on state")
-        self.current_state_sigs[self.remote_address] = sig
-        if len(self.current_state_sigs) != 2:
-            raise ValueError("Missing own signature on previous state somehow")
-        self.signed_states.append({'state': binascii.hexlify(current_encoded).decode(), 'signatures': self.current_state_sigs})
-        game = json.dumps({'game': self.game_basics, 'states': self.signed_states, 'unfinished': ''})
-        with open(self.backup_file, "w") as f:
-            f.write(game)
+        if not self.last_signed(current_state):
+            self.current_state_sigs[self.remote_address] = sig
+            if len(self.current_state_sigs) != 2:
+                raise ValueError("Missing own signature on previous state somehow")
+            self.record_signed_state(current_state, self.current_state_sigs)
+            self.journal.sync()
         if hand["stop"] == 1:
+            self.state = "CLOSED"
+            self.journal.mark_closed()
             print(f"print opponent {self.remote_address} ended the game.")
             print(f"see here: {hand['tx']}")
-            if (self.current_state[2][0] == 0) or (self.current_state[2][1] == 0):
+            if 0 in current_state.balances:
                 print("eth should be cashed out.")
             else:
                 print(f"{self.dispute_duration} seconds before money will be remitted... either wait without quitting or RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
-                time.sleep(self.dispute_duration+120)
-                tx = self.table_contract.claim_expired_settlement(self.table_contract.tableID, self.default_gas)
+                yield self.sleep(self.dispute_duration+120)
+                tx = yield self.chain(self.table_contract.claim_expired_settlement, self.table_contract.tableID, self.default_gas)
                 print("eth should now be cashed out:", binascii.hexlify(tx))
-            return            
-        else:         
-            i = 0
-            continue_ = False
-            while not continue_:
-                i += 1
-                action_type = None
-                wait = False
-                if self.current_state[2][0] == 0 or self.current_state[2][1] == 0:
-                    print("game over")
-                    if ((self.players[0] == self.account.address) and (self.current_state[2][0] == 0)) or ((self.players[1] == self.account.address) and (self.current_state[2][1] == 0)):
-                        print("you lost")
-                    else:
-                        print("you won!")
-                    wait = True
-                    return
-                else:                     
-                    action_type = input("[continue playing=1, cash out=2]:")
-                if i > 8:
-                    raise ValueError("too many mistakes")
-                if action_type == "1":
-                    continue_ = True
-                    return self.start_shuffle()                  
-                elif action_type == "2":
-                    try:
-                        signed_state = self.signed_states[-1]
-                        tx = self.table_contract.propose_settlement(signed_state["signatures"], binascii.unhexlify(signed_state["state"]), 2*self.default_gas)
-                        print(f"proposed settlement. Tx here: {binascii.hexlify(tx)}")
-                        continue_ = True
-                        hand_msg = json.dumps({'msgtype':'handover', 'previous_state': signed_state["state"], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], "stop": 1, 'tx': binascii.hexlify(tx).decode()})
-                        hand_msg = hand_msg + "\n"
-                        if wait == True:
-                            print(f"{self.dispute_duration} seconds before money can be remitted... RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
-                        else:
-                            print(f"eth should be cashed out!")
-                        self.transport.write(str.encode(hand_msg))
-                    except:
-                        print(f"RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
-                        return      
-                else:
-                    print("invalid input try again.")
+            return
+        self.state = "HANDOVER"
+        if 0 in current_state.balances:
+            print("game over")
+            print("you lost" if current_state.balances[self.my_index()] == 0 else "you won!")
+            return
+        keep_playing = yield self.decide('continue_playing', current_state)
+        if keep_playing:
+            if self.deck_covers(current_state.hand+1):
+                yield self.start_hand(hand.get('key'))
+            elif self.pipeline:
+                yield self.start_prepared_hand()
+            else:
+                yield self.start_shuffle()
+            return
+        self.state = "CLOSED"
+        self.journal.mark_closed()
+        try:
+            signed_state = self.signed_states[-1]
+            my_sig = signed_state["signatures"][self.account.address]
+            tx = yield self.chain(self.table_contract.propose_settlement, signed_state["signatures"], binascii.unhexlify(signed_state["state"]), 2*self.default_gas)
+        except Exception:
+            print(f"RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
+            return
+        print(f"proposed settlement. Tx here: {binascii.hexlify(tx)}")
+        print(f"{self.dispute_duration} seconds before money can be remitted... RUN THIS: python3 settlement.py {binascii.hexlify(self.table_contract.sessionID).decode()}.pkr <infura url> <private key>")
+        self.send({'msgtype':'handover', 'previous_state': signed_state["state"], 'prev_v': my_sig[0], 'prev_r': my_sig[1], 'prev_s': my_sig[2], "stop": 1, 'tx': binascii.hexlify(tx).decode()})
 
 
 class PlayerFactory(Factory):
 
     protocol = Player
 
-    def __init__(self, priv, w3, randomness, buy_in, duration, join_duration, dispute_duration):
+    # One factory hosts any number of concurrent heads up tables. Every session gets fresh
+    # sessionID entropy, live tables are indexed by tableID (one table per opponent), and all
+    # tables share a single nonce allocator for the host account's transactions. `new_strategy`
+    # makes each session its own strategy (a console one when it is None), so bots keep their hand
+    # count and random state per table.
+    def __init__(self, priv, w3, buy_in, duration, join_duration, dispute_duration, new_strategy=None, max_tables=None):
         self.priv = priv
         self.w3 = w3
-        self.randomness = randomness
         self.buy_in = buy_in
         self.duration = duration
         self.join_duration = join_duration
         self.dispute_duration = dispute_duration
+        self.new_strategy = new_strategy
+        self.max_tables = max_tables
+        self.account = account_from_key(w3.eth, priv)
+        self.nonces = nonce_manager(w3.eth, self.account.address)
+        default_engine().start()
+        self.sessions = set()
+        self.tables = {}
 
-    def buildProtocol(self, *args, **kwargs):
-        protocol = Player(self.priv, self.w3, self.randomness, self.buy_in, self.duration, self.join_duration, self.dispute_duration, False)
+    def new_randomness(self):
+        return ''.join([secrets.choice(string.ascii_letters+string.digits) for _ in range(25)]).encode()
+
+    def buildProtocol(self, addr):
+        if self.max_tables is not None and len(self.sessions) >= self.max_tables:
+            print("table limit reached, refusing connection from", addr.host)
+            return None
+        protocol = self.protocol(self.priv, self.w3, self.new_randomness(), self.buy_in, self.duration, self.join_duration, self.dispute_duration, False, self.new_strategy() if self.new_strategy is not None else None, self.nonces)
+        protocol.factory = self
+        self.sessions.add(protocol)
         return protocol
+
+    def register_table(self, player):
+        tableID = player.table_contract.tableID
+        if self.tables.get(tableID, player) is not player:
+            return False
+        self.tables[tableID] = player
+        return True
+
+    def unregister(self, player):
+        self.sessions.discard(player)
+        tableID = player.table_contract.tableID
+        if self.tables.get(tableID) is player:
+            del self.tables[tableID]
@@ -0,0 +1,195 @@
+from deck import NEW_DECK, multiply_points, random_scalar, reveal, point_bytes, point_xy
+from highcard_state import State, ORDER, REVEAL, is_valid_state_transition, generate_hand
+from contract_control import ecsign, recover_signer, table_transaction_hash
+from wire import encode_message, decode_message
+from eth_utils import keccak
+import os, sys, json, time, random, statistics, subprocess, tracemalloc
+
+# Benchmarks of the protocol's hot paths: deck arithmetic, point and state encoding, signatures,
+# the wire codec and state validation, each timed in this process; and whole hands, played by
+# simulation.py on the stub chain in a child process (the reactor only runs once per process).
+# Every run is appended to a history file, and a result more than `threshold` worse than the
+# median of the last runs in the history is flagged as a regression. Time is per operation,
+# allocation is the peak memory traced by tracemalloc while one operation runs.
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_history.jsonl")
+SIMULATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulation.py")
+PLAYERS = ["0x1111111111111111111111111111111111111111", "0x2222222222222222222222222222222222222222"]
+
+# Results where more is better; for everything else less is better.
+HIGHER_IS_BETTER = ('hands_per_second',)
+
+def showdown_hand(small_blind=10**16, seed=1):
+    # The states of a legal hand that ends in a showdown, starting from a table's first state.
+    rng = random.Random(seed)
+    start = State(0, 0, 4, (100*small_blind, 100*small_blind), 0, 0, (0,)*8)
+    while True:
+        states = [State.from_abi(s) for s in generate_hand(rng, start.as_abi(), PLAYERS, small_blind)]
+        if len(states) > 3 and states[-2].action == REVEAL:
+            return [start] + states
+
+def cases():
+    # name -> a function running one operation.
+    key = random_scalar()
+    keys = [random_scalar() for _ in NEW_DECK]
+    shuffled = multiply_points(NEW_DECK, [key]*len(NEW_DECK))
+    masked = multiply_points(NEW_DECK[:1], [key*keys[0] % ORDER])[0]
+    hand = showdown_hand()
+    opened, called = hand[1], hand[2]
+    encoded = called.encoded
+    priv = keccak(b"benchmark")
+    digest = table_transaction_hash(keccak(b"table"), keccak(b"session"), encoded)
+    sig = ecsign(digest, priv)
+    message = {'msgtype': 'hand', 'type': 1, 'previous_state': opened.hex, 'next_state': called.hex, 'next_v': sig[0], 'next_r': sig[1], 'next_s': sig[2], 'prev_v': sig[0], 'prev_r': sig[1], 'prev_s': sig[2]}
+    shuffle = {'msgtype': 'shuffle', 'round': 1, 'deck': shuffled}
+    hand_frame = encode_message(message)
+    shuffle_frame = encode_message(shuffle)
+
+    def validate_hand():
+        for previous, state in zip(hand, hand[1:]):
+            if not is_valid_state_transition(previous.encoded, state.encoded, PLAYERS, 10**16):
+                raise ValueError("benchmark hand is not valid")
+
+    def deck_shuffle():
+        deck = multiply_points(NEW_DECK, [key]*len(NEW_DECK))
+        random.SystemRandom().shuffle(deck)
+
+    return {
+        'deck.shuffle': deck_shuffle,
+        'deck.deal': lambda: multiply_points(shuffled, keys),
+        'deck.reveal': lambda: reveal(masked, [key, keys[0]]),
+        'points.roundtrip': lambda: [point_bytes(*point_xy(p)) for p in shuffled],
+        'state.encode': lambda: called.replace().encoded,
+        'state.decode': lambda: State.decode(encoded),
+        'rules.transition': lambda: is_valid_state_transition(opened.encoded, encoded, PLAYERS, 10**16),
+        'rules.showdown_hand': validate_hand,
+        'sign': lambda: ecsign(digest, priv),
+        'verify': lambda: recover_signer(digest, sig),
+        'wire.hand': lambda: decode_message(encode_message(message)),
+        'wire.shuffle': lambda: decode_message(encode_message(shuffle)),
+        'wire.decode_hand': lambda: decode_message(hand_frame),
+        'wire.decode_shuffle': lambda: decode_message(shuffle_frame),
+    }
+
+def time_per_op(f, repeat=5, min_time=0.05):
+    # Median over `repeat` runs of seconds per call, with enough calls per run to last min_time.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        elapsed = time.perf_counter()-start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time/elapsed)+1)
+    runs = [elapsed/number]
+    for _ in range(repeat-1):
+        start = time.perf_counter()
+        for _ in range(number):
+            f()
+        runs.append((time.perf_counter()-start)/number)
+    return statistics.median(runs)
+
+def peak_allocation(f):
+    f()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        f()
+        return tracemalloc.get_traced_memory()[1]-base
+    finally:
+        tracemalloc.stop()
+
+def run_micro(repeat=5, min_time=0.05):
+    results = {}
+    for name, f in cases().items():
+        results[name] = {'us': time_per_op(f, repeat, min_time)*1e6, 'peak_bytes': peak_allocation(f)}
+    return results
+
+def simulate(hands, seed=1, trace=False):
+    command = [sys.executable, "-W", "ignore"] + (["-X", "tracemalloc"] if trace else []) + [SIMULATION, str(hands), "1", str(seed), "stub", "--json"]
+    done = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if done.returncode != 0:
+        raise RuntimeError(f"simulation failed: {done.stderr.strip().splitlines()[-1:]}")
+    return json.loads(done.stdout.strip().splitlines()[-1])
+
+def run_hands(hands=100, seed=1):
+    timed = simulate(hands, seed)
+    traced = simulate(hands, seed, trace=True)
+    latency = timed['hand_latency_ms']
+    return {
+        'hands': timed['hands'],
+        'hands_per_second': timed['hands_per_second'],
+        'hand_p50_ms': latency['p50'],
+        'hand_p90_ms': latency['p90'],
+        'hand_p99_ms': latency['p99'],
+        'messages_per_hand': timed['messages_per_hand'],
+        'bytes_per_hand': timed['bytes_per_hand'],
+        'peak_traced_kb': traced['peak_traced_kb'],
+    }
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SIMULATION), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def flatten(run):
+    values = {f"{name}.{unit}": value for name, result in run['micro'].items() for unit, value in result.items()}
+    values.update({f"hand.{name}": value for name, value in run.get('hand', {}).items() if name != 'hands'})
+    return values
+
+def regressions(run, history, threshold=0.25, window=5):
+    # (metric, baseline, value) for every metric worse than the median of the last `window` runs.
+    found = []
+    past = [flatten(r) for r in history[-window:]]
+    for metric, value in flatten(run).items():
+        baseline = [p[metric] for p in past if p.get(metric) is not None]
+        if value is None or len(baseline) == 0:
+            continue
+        baseline = statistics.median(baseline)
+        if metric.split('.')[-1] in HIGHER_IS_BETTER:
+            worse = value < baseline*(1-threshold)
+        else:
+            worse = value > baseline*(1+threshold)
+        if worse:
+            found.append((metric, baseline, value))
+    return found
+
+def run_benchmarks(hands=100, quick=False):
+    run = {'time': time.time(), 'revision': revision(), 'python': sys.version.split()[0]}
+    run['micro'] = run_micro(repeat=3 if quick else 5, min_time=0.02 if quick else 0.1)
+    if hands > 0:
+        run['hand'] = run_hands(hands)
+    return run
+
+def print_run(run, flagged):
+    flagged = {metric: baseline for metric, baseline, _ in flagged}
+    def mark(metric):
+        return f"  REGRESSION (was {flagged[metric]:.4g})" if metric in flagged else ""
+    for name, result in run['micro'].items():
+        print(f"{name:22} {result['us']:12.2f} us {result['peak_bytes']/1024:10.1f} KiB{mark(name+'.us')}{mark(name+'.peak_bytes')}")
+    for name, value in run.get('hand', {}).items():
+        print(f"hand.{name:17} {'-' if value is None else format(value, '12.2f'):>12}{mark('hand.'+name)}")
+
+if __name__ == "__main__":
+    args = dict(a[2:].split("=", 1) if "=" in a else (a[2:], True) for a in sys.argv[1:] if a.startswith("--"))
+    path = args.get('history', HISTORY)
+    history = load_history(path)
+    run = run_benchmarks(int(args.get('hands', 100)), quick='quick' in args)
+    flagged = regressions(run, history, float(args.get('threshold', 0.25)))
+    if 'json' in args:
+        print(json.dumps(dict(run, regressions=flagged)))
+    else:
+        print_run(run, flagged)
+        print(f"{len(flagged)} regressions against the last {min(len(history), 5)} runs in {path}" if history else f"first run recorded in {path}")
+    if 'no-save' not in args:
+        with open(path, "a") as f:
+            f.write(json.dumps(run) + "\n")
+    sys.exit(1 if flagged else 0)
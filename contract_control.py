@@ -1,29 +1,72 @@
-from py_eth_sig_utils import signing
 from operator import itemgetter
+from functools import lru_cache
 from eth_abi import encode_abi
-import sys, json, binascii
+from eth_utils import keccak, to_checksum_address
+from highcard_state import is_valid_state_transition
+from metrics import timed, count
+import sys, os, json, binascii, threading, time, coincurve
 
 CHAIN_ID = 3 # Default Ropsten test network id.
-ecsign = signing.utils.ecsign
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+ABI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "abi")
+
+# Signing on libsecp256k1 (coincurve) rather than py_eth_sig_utils, whose import alone pulls in
+# all of py_ecc. Same (v, r, s) convention as its ecsign/ecrecover_to_pub.
+def ecsign(msg_hash, priv):
+	sig = coincurve.PrivateKey(bytes(priv)).sign_recoverable(msg_hash, hasher=None)
+	return sig[64]+27, int.from_bytes(sig[:32], 'big'), int.from_bytes(sig[32:64], 'big')
+
+def ecrecover_to_pub(msg_hash, v, r, s):
+	sig = r.to_bytes(32, 'big') + s.to_bytes(32, 'big') + bytes([v-27])
+	return coincurve.PublicKey.from_signature_and_message(sig, msg_hash, hasher=None).format(compressed=False)[1:]
 
 ###################
-# HIGH CARD POKER #
+# EIP712 HASHING  #
 ###################
 
-with open("abi/highcardpoker.abi", "r") as f:
-	raw_poker_abi = f.read()
-POKER_ABI = json.loads(raw_poker_abi)
+# Same precomputed constants as HeadsUpPoker.sol, so digests can be built without calling the node.
+EIP712DOMAINTYPE_HASH = bytes.fromhex("0eaa6c88c44fbde2113ba7421deef795c18fc5a553a55b2ba4d237269e1c2662")
+NAME_HASH = bytes.fromhex("27a59e84af55de2071cfadf11be6f3ca6437c9e6d2bf408c02566f4d13d28d8a")
+VERSION_HASH = bytes.fromhex("c89efdaa54c0f20c7adf612882df0950f5a951637e0307cdcb4c672f298b8bc6")
+SALT = bytes.fromhex("b1ae92db93da5bd8411028f6531126984a6eb2e7f66b19e5c22d5a7b0fb00bc7")
+
+@lru_cache(maxsize=None)
+def domain_separator(chain_id, contract_address):
+	return keccak(encode_abi(('bytes32', 'bytes32', 'bytes32', 'uint256', 'address', 'bytes32'), (EIP712DOMAINTYPE_HASH, NAME_HASH, VERSION_HASH, chain_id, contract_address, SALT)))
+
+def table_id(domain, participant1, participant2):
+	if int(participant1, 16) >= int(participant2, 16):
+		raise ValueError("participants must be sorted by address")
+	return keccak(domain + bytes.fromhex(participant1[2:]) + bytes.fromhex(participant2[2:]))
+
+def table_transaction_hash(tableID, sessionID, tx_data):
+	return keccak(b'\x19\x01' + tableID + sessionID + keccak(tx_data))
+
+def recover_signer(msg_hash, sig):
+	v, r, s = sig
+	if v not in (27, 28) or not (0 < r < SECP256K1_ORDER) or not (0 < s < SECP256K1_ORDER):
+		return None
+	try:
+		pub = ecrecover_to_pub(msg_hash, v, r, s)
+	except Exception:
+		return None
+	return to_checksum_address(keccak(pub)[12:])
+
+###################
+# HIGH CARD POKER #
+###################
 
 class HighCardPokerContract:
-	def __init__(self, w3_provider, contract_address=None, abi=POKER_ABI):
+	def __init__(self, w3_provider, contract_address=None, abi=None):
 		self.eth = w3_provider.eth
-		self.abi = abi
-		if contract_address is None:
-			self.contract = self.eth.contract(abi=self.abi)
-		else:
-			self.contract = self.eth.contract(address=contract_address, abi=abi)
+		self.abi = abi if abi is not None else load_abi("highcardpoker.abi")
+		self.contract = contract_object(self.eth, contract_address, self.abi)
 
+	@timed("validate")
 	def is_valid_transition(self, last_state, new_state, players, buy_in):
+		return is_valid_state_transition(last_state, new_state, players, buy_in//100)
+
+	def is_valid_transition_onchain(self, last_state, new_state, players, buy_in):
 		return self.contract.functions.isValidStateTransition(last_state, new_state, players, buy_in//100).call()
 
 	def encode_state(self, hand_number, round_action, all_values, cards_keys, actor_winner):
@@ -33,34 +76,225 @@ class HighCardPokerContract:
 # HEADS UP TABLES #
 ###################
 
-with open("abi/headsup.abi", "r") as f:
-	raw_headsup_abi = f.read()
-HEADSUP_ABI = json.loads(raw_headsup_abi)
+class NonceManager:
+	# Hands out transaction nonces for one account, so several tables can send from it concurrently.
+	# The pending count is read from the node once. A nonce whose send failed is handed back: the
+	# top one rolls the counter back, any other is kept as a gap and reused by the next allocation.
+	# The node's pending count does not include nonces that are allocated but not yet broadcast, so
+	# a resync from the node waits until none are outstanding.
+	def __init__(self, eth, address):
+		self.eth = eth
+		self.address = address
+		self.lock = threading.Lock()
+		self.nonce = None
+		self.released = set()
+		self.outstanding = set()
+		self.stale = False
+
+	def allocate(self):
+		with self.lock:
+			if self.stale and len(self.outstanding) == 0:
+				self.nonce = None
+				self.released.clear()
+				self.stale = False
+			if len(self.released) > 0:
+				nonce = min(self.released)
+				self.released.remove(nonce)
+			else:
+				if self.nonce is None:
+					self.nonce = self.eth.getTransactionCount(self.address, 'pending')
+				nonce = self.nonce
+				self.nonce += 1
+			self.outstanding.add(nonce)
+			return nonce
+
+	def sent(self, nonce):
+		with self.lock:
+			self.outstanding.discard(nonce)
+
+	def release(self, nonce):
+		with self.lock:
+			self.outstanding.discard(nonce)
+			if self.nonce is None or nonce >= self.nonce:
+				return
+			self.released.add(nonce)
+			while self.nonce-1 in self.released:
+				self.nonce -= 1
+				self.released.remove(self.nonce)
+
+	def resync(self):
+		with self.lock:
+			self.stale = True
+
+class GasPriceOracle:
+	# Caches eth.gasPrice for `ttl` seconds so sending a transaction does not cost an extra call.
+	def __init__(self, eth, ttl=30):
+		self.eth = eth
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.price = None
+		self.fetched_at = 0
+
+	def gas_price(self):
+		with self.lock:
+			now = time.monotonic()
+			if self.price is None or now-self.fetched_at > self.ttl:
+				self.price = self.eth.gasPrice
+				self.fetched_at = now
+			return self.price
+
+	def invalidate(self):
+		with self.lock:
+			self.price = None
+
+_nonce_managers = {}
+_gas_price_oracles = {}
+_domain_separators = {}
+_chain_ids = {}
+_registry_lock = threading.Lock()
+
+def nonce_manager(eth, address):
+	with _registry_lock:
+		key = (eth, address.lower())
+		if key not in _nonce_managers:
+			_nonce_managers[key] = NonceManager(eth, address)
+		return _nonce_managers[key]
+
+def gas_price_oracle(eth):
+	with _registry_lock:
+		if eth not in _gas_price_oracles:
+			_gas_price_oracles[eth] = GasPriceOracle(eth)
+		return _gas_price_oracles[eth]
+
+def node_chain_id(eth):
+	# Transactions are signed for the chain the node is on; it is asked once.
+	with _registry_lock:
+		if eth in _chain_ids:
+			return _chain_ids[eth]
+	chain_id = eth.chainId
+	with _registry_lock:
+		return _chain_ids.setdefault(eth, chain_id)
+
+def contract_domain_separator(eth, contract):
+	# The contract hashes with the chain id it was deployed with, which need not be the node's, so
+	# its DOMAIN_SEPARATOR is read once per contract. Read it at startup (see
+	# basicpokerp2p.load_domain_separator): table ids are hashed on the reactor thread.
+	key = (eth, contract.address)
+	with _registry_lock:
+		if key in _domain_separators:
+			return _domain_separators[key]
+	try:
+		remote = bytes(contract.functions.DOMAIN_SEPARATOR().call())
+	except Exception as e:
+		raise RuntimeError(f"could not read DOMAIN_SEPARATOR from the table contract at {contract.address}") from e
+	with _registry_lock:
+		return _domain_separators.setdefault(key, remote)
+
+###########################
+# SHARED ABIS AND OBJECTS #
+###########################
+
+# ABIs, web3 contract objects and accounts are built once per process and shared by every
+# session: eth.contract() builds a new contract class each time and derives the account from the
+# key again, which used to dominate the cost of accepting a connection.
+_abis = {}
+_contracts = {}
+_accounts = {}
+
+def load_abi(path):
+	# Relative paths are looked up in the abi folder next to this file, not the working directory.
+	path = os.path.join(ABI_DIR, path)
+	with _registry_lock:
+		if path not in _abis:
+			with open(path, "r") as f:
+				_abis[path] = json.load(f)
+		return _abis[path]
+
+def contract_object(eth, address, abi):
+	if address is None:
+		return eth.contract(abi=abi)
+	with _registry_lock:
+		key = (eth, address, id(abi))
+		if key not in _contracts:
+			_contracts[key] = eth.contract(address=address, abi=abi)
+		return _contracts[key]
+
+def account_from_key(eth, priv):
+	with _registry_lock:
+		if priv not in _accounts:
+			_accounts[priv] = eth.account.privateKeyToAccount(priv)
+		return _accounts[priv]
+
+def __getattr__(name):
+	# HEADSUP_ABI and POKER_ABI are only read from disk when first used.
+	if name == "HEADSUP_ABI":
+		return load_abi("headsup.abi")
+	if name == "POKER_ABI":
+		return load_abi("highcardpoker.abi")
+	raise AttributeError(f"module {__name__} has no attribute {name}")
+
+# contracts/HeadsUpPoker.sol calls a settlement a claim. The deployed table contract
+# (abi/headsup.abi) has the same functions under these names, and HeadsUpContract works with either.
+CLAIM_NAMES = {"proposeSettlement": "proposeClaim", "claimExpiredSettlement": "claimExpiredClaim", "getTableSettlement": "getTableClaim", "verifyUnpackSettlementData": "verifyUnpackClaimData"}
 
 class HeadsUpContract:
-	def __init__(self, priv, w3_provider, contract_address=None, players=[None,None], abi=HEADSUP_ABI, chain_id=CHAIN_ID):
+	def __init__(self, priv, w3_provider, contract_address=None, players=[None,None], abi=None, chain_id=None, nonces=None, gas_prices=None, load_overview=True):
 		self.eth = w3_provider.eth
-		self.account = self.eth.account.privateKeyToAccount(priv)
+		self.account = account_from_key(self.eth, priv)
+		self.nonces = nonces if nonces is not None else nonce_manager(self.eth, self.account.address)
+		self.gas_prices = gas_prices if gas_prices is not None else gas_price_oracle(self.eth)
 		self.chain_id = chain_id
-		self.abi = abi
+		self.abi = abi if abi is not None else load_abi("headsup.abi")
 		self.tableID = None
 		self.players = players
 		self.buy_in_amnt = None
-		if contract_address is None:
-			self.contract = self.eth.contract(abi=self.abi)
-		else:
-			self.contract = self.eth.contract(address=contract_address, abi=abi)
+		self.contract = contract_object(self.eth, contract_address, self.abi)
+		if contract_address is not None:
 			if None not in self.players:
-				self.tableID = self.contract.functions.getTableID(players[0], players[1]).call()
-				res = self.contract.functions.getTableOverview(self.tableID).call()
-				self.buy_in_amnt = (res[1][0]+res[1][1])//2
+				self.tableID = table_id(self.domain_separator, players[0], players[1])
+				if load_overview:
+					self.set_overview(self.table_overview())
+
+	@property
+	def domain_separator(self):
+		if self.contract.address is None:
+			return None
+		return contract_domain_separator(self.eth, self.contract)
+
+	def function(self, name):
+		functions = self.contract.functions
+		if not hasattr(functions, name) and name in CLAIM_NAMES:
+			name = CLAIM_NAMES[name]
+		return getattr(functions, name)
+
+	def table_overview(self):
+		return self.contract.functions.getTableOverview(self.tableID).call()
+
+	def set_overview(self, res):
+		self.buy_in_amnt = (res[1][0]+res[1][1])//2
+
+	@timed("transaction")
+	def _send_tx(self, function, gas, value=0):
+		count("transactions", function=function.fn_name)
+		nonce = self.nonces.allocate()
+		chain_id = self.chain_id if self.chain_id is not None else node_chain_id(self.eth)
+		basetx = {"nonce": nonce, "gasPrice": self.gas_prices.gas_price(), "gas": gas, "from": self.account.address, "value": value, "chainId": chain_id}
+		try:
+			signed = self.account.signTransaction(function.buildTransaction(basetx))
+			txhash = self.eth.sendRawTransaction(signed.rawTransaction)
+		except Exception:
+			# Whatever stopped it, the transaction was not sent and its nonce is free again.
+			self.nonces.release(nonce)
+			raise
+		self.nonces.sent(nonce)
+		return txhash
 
 	def sign_new_table(self, participants, buyIn, duration, join_duration, dispute_duration, sessionID):
 		fee = buyIn//100
 		open_data = encode_abi(('uint256', 'uint256', 'uint256', 'uint256', 'uint256'), (buyIn, fee, duration, join_duration, dispute_duration))
-		self.tableID = self.contract.functions.getTableID(participants[0], participants[1]).call()
+		self.tableID = table_id(self.domain_separator, participants[0], participants[1])
 		self.sessionID = sessionID
-		txhash = self.contract.functions.getTableTransactionHash(self.tableID, self.sessionID, open_data).call()
+		txhash = table_transaction_hash(self.tableID, self.sessionID, open_data)
 		return ecsign(txhash, self.account.privateKey)
 
 	def open_table_tx(self, addr2sig, participants, buyIn, duration, join_duration, dispute_duration, sessionID, gas):
@@ -78,10 +312,7 @@ class HeadsUpContract:
 		r = [i[1].to_bytes((i[1].bit_length()+7)//8, 'big') for i in sigs]
 		s = [i[2].to_bytes((i[2].bit_length()+7)//8, 'big') for i in sigs]		
 		open_table = self.contract.functions.openTable(participants, open_data, v, r, s, sessionID)
-		basetx = {"nonce": self.eth.getTransactionCount(self.account.address), "gasPrice": self.eth.gasPrice, "gas":gas, "from": self.account.address, "value": buyIn+fee}
-		tx = open_table.buildTransaction(basetx)
-		signed = self.account.signTransaction(tx)
-		txhash = self.eth.sendRawTransaction(signed.rawTransaction)
+		txhash = self._send_tx(open_table, gas, buyIn+fee)
 		self.players = participants
 		self.buy_in_amnt = buyIn
 		self.sessionID = sessionID
@@ -90,10 +321,7 @@ class HeadsUpContract:
 	def join_table_tx(self, participants, buyIn, sessionID, gas):
 		fee = buyIn//100
 		join_table = self.contract.functions.joinTable(participants)
-		basetx = {"nonce": self.eth.getTransactionCount(self.account.address), "gasPrice": self.eth.gasPrice, "gas":gas, "from": self.account.address, "value": buyIn+fee}
-		tx = join_table.buildTransaction(basetx)
-		signed = self.account.signTransaction(tx)
-		txhash = self.eth.sendRawTransaction(signed.rawTransaction)
+		txhash = self._send_tx(join_table, gas, buyIn+fee)
 		self.players = participants
 		self.buy_in_amnt = buyIn
 		self.sessionID = sessionID
@@ -102,9 +330,12 @@ class HeadsUpContract:
 	def encode_state(self, hand_number, round_action, all_values, cards_keys, actor_winner):
 		return encode_abi(('uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'), (hand_number, round_action, all_values, cards_keys, actor_winner))
 
+	def state_hash(self, state):
+		return table_transaction_hash(self.tableID, self.sessionID, state)
+
+	@timed("sign")
 	def sign_table_tx(self, state):
-		state_hash = self.contract.functions.getTableTransactionHash(self.tableID, self.sessionID, state).call()
-		return ecsign(state_hash, self.account.privateKey)
+		return ecsign(self.state_hash(state), self.account.privateKey)
 
 	def propose_settlement(self, addr2sig, last_state, gas, dispute_type=0, dispute_data=b''):
 		sigs = [None, None]
@@ -120,15 +351,17 @@ class HeadsUpContract:
 		ss = [i[2].to_bytes((i[2].bit_length()+7)//8, 'big') for i in sigs]
 		encoded_final_state_data = encode_abi(('bytes', 'uint8[2]', 'bytes32[2]', 'bytes32[2]'), (last_state, vs, rs, ss))
 		encoded_settlement = encode_abi(('bytes', 'address', 'uint8', 'bytes'), (encoded_final_state_data, self.account.address, dispute_type, dispute_data))
-		settle_sig = ecsign(self.contract.functions.getTableTransactionHash(self.tableID, self.sessionID, encoded_settlement).call(), self.account.privateKey)
+		settle_sig = ecsign(table_transaction_hash(self.tableID, self.sessionID, encoded_settlement), self.account.privateKey)
 		settle_v, settle_r, settle_s = settle_sig[0], settle_sig[1].to_bytes((settle_sig[1].bit_length()+7)//8, 'big'), settle_sig[2].to_bytes((settle_sig[2].bit_length()+7)//8, 'big')
-		proposal = self.contract.functions.proposeSettlement(self.tableID, encoded_settlement, settle_v, settle_r, settle_s)
-		basetx = {"nonce": self.eth.getTransactionCount(self.account.address), "gasPrice": self.eth.gasPrice, "gas":gas, "from": self.account.address}
-		tx = proposal.buildTransaction(basetx)
-		signed = self.account.signTransaction(tx)
-		return self.eth.sendRawTransaction(signed.rawTransaction)
+		proposal = self.function("proposeSettlement")(self.tableID, encoded_settlement, settle_v, settle_r, settle_s)
+		return self._send_tx(proposal, gas)
 
+	@timed("verify")
 	def verify_half_signed_tx(self, state, sig, signer):
+		recovered = recover_signer(self.state_hash(state), sig)
+		return recovered is not None and recovered.lower() == signer.lower()
+
+	def verify_half_signed_tx_onchain(self, state, sig, signer):
 		v = sig[0]
 		r = sig[1].to_bytes((sig[1].bit_length()+7)//8, 'big')
 		s = sig[2].to_bytes((sig[2].bit_length()+7)//8, 'big')
@@ -141,14 +374,8 @@ class HeadsUpContract:
 
 	def claim_expired_table(self, tableID, gas):
 		claim = self.contract.functions.claimExpiredTable(tableID)
-		basetx = {"nonce": self.eth.getTransactionCount(self.account.address), "gasPrice": self.eth.gasPrice, "gas":gas, "from": self.account.address}
-		tx = claim.buildTransaction(basetx)
-		signed = self.account.signTransaction(tx)
-		return self.eth.sendRawTransaction(signed.rawTransaction)
+		return self._send_tx(claim, gas)
 
 	def claim_expired_settlement(self, tableID, gas):
-		claim = self.contract.functions.claimExpiredSettlement(tableID)
-		basetx = {"nonce": self.eth.getTransactionCount(self.account.address), "gasPrice": self.eth.gasPrice, "gas":gas, "from": self.account.address}
-		tx = claim.buildTransaction(basetx)
-		signed = self.account.signTransaction(tx)
-		return self.eth.sendRawTransaction(signed.rawTransaction)
+		claim = self.function("claimExpiredSettlement")(tableID)
+		return self._send_tx(claim, gas)
@@ -0,0 +1,25 @@
+from contract_control import ecsign, recover_signer
+from deck import default_engine
+
+# Signing and checking state signatures off the reactor thread, on the deck engine's workers:
+# a process pool when there are spare cores, otherwise the reactor's thread pool (libsecp256k1
+# releases the GIL, so those overlap with the protocol code too). A Player starts the checks for
+# a hand message, validates the transition while they run and only then waits for them.
+
+def sign_checked(msg_hash, priv, signer):
+    sig = ecsign(msg_hash, priv)
+    if recover_signer(msg_hash, sig) != signer:
+        raise ValueError("created invalid signature on state transition")
+    return sig
+
+def signed_by(msg_hash, sig, signer):
+    recovered = recover_signer(msg_hash, sig)
+    return recovered is not None and recovered.lower() == signer.lower()
+
+def sign(msg_hash, priv, signer, engine=None):
+    engine = engine if engine is not None else default_engine()
+    return engine.call(sign_checked, msg_hash, bytes(priv), signer)
+
+def verify(msg_hash, sig, signer, engine=None):
+    engine = engine if engine is not None else default_engine()
+    return engine.call(signed_by, msg_hash, tuple(sig), signer)
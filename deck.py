@@ -0,0 +1,131 @@
+from twisted.internet import defer, reactor, threads
+from concurrent.futures import ProcessPoolExecutor
+from highcard_state import cards, card_rank, ORDER
+from metrics import timed
+import coincurve, secrets, random, os
+
+# Mental poker deck operations (same scheme as mentalpoker.DealerEC) on libsecp256k1 through
+# coincurve. Points are 64 byte x||y strings, which is also how they travel on the wire, and
+# keys are plain ints. The new deck i*G is built once with the library's precomputed fixed-base
+# tables; masking a deck is a batch of variable-base multiplications that runs in a process pool.
+
+POINT_LENGTH = 64
+
+def point_bytes(x, y):
+    return x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+def point_xy(point):
+    return int.from_bytes(point[:32], 'big'), int.from_bytes(point[32:], 'big')
+
+def multiply(point, scalar):
+    return coincurve.PublicKey(b'\x04' + point).multiply(scalar.to_bytes(32, 'big')).format(compressed=False)[1:]
+
+def multiply_points(points, scalars):
+    return [multiply(p, k) for p, k in zip(points, scalars)]
+
+def random_scalar():
+    return 2 + secrets.randbelow(ORDER-2)
+
+NEW_DECK = [coincurve.PublicKey.from_secret((i+1).to_bytes(32, 'big')).format(compressed=False)[1:] for i in range(len(cards))]
+CARD_BY_X = {p[:32]: cards[i] for i, p in enumerate(NEW_DECK)}
+
+def reveal(card, keys):
+    # One inversion of the product of the keys and one multiplication, then the x coordinate is
+    # looked up among the unmasked deck's (KeyError if the point is no card). That matches the
+    # contract's unmasking one key at a time only on the curve; libsecp256k1 refuses any other
+    # point with a ValueError.
+    product = 1
+    for key in keys:
+        product = product*key % ORDER
+    return CARD_BY_X[multiply(card, pow(product, ORDER-2, ORDER))[:32]]
+
+def high_card_index(card1, card2):
+    return 0 if card_rank[card1] > card_rank[card2] else 1
+
+class DeckEngine:
+    # Runs batches of point multiplications in worker processes, split into `chunk_size` chunks
+    # so one deck is spread over several cores. With processes=0 (the default on a single core
+    # machine) batches run in the reactor's thread pool instead; libsecp256k1 releases the GIL.
+    def __init__(self, processes=None, chunk_size=13):
+        self.processes = (os.cpu_count() or 1)-1 if processes is None else processes
+        self.chunk_size = chunk_size
+        self.pool = None
+
+    def start(self):
+        if self.pool is None and self.processes > 0:
+            self.pool = ProcessPoolExecutor(self.processes)
+            # Fork the workers now rather than on the first deck of the first hand.
+            for _ in range(self.processes):
+                self.pool.submit(multiply_points, [], [])
+            reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        return self
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def call(self, f, *args):
+        # Any other job for the same workers (f must be picklable, see crypto.py).
+        if self.processes == 0:
+            return threads.deferToThread(f, *args)
+        self.start()
+        return future_to_deferred(self.pool.submit(f, *args))
+
+    def multiply_points(self, points, scalars):
+        if self.processes == 0:
+            return threads.deferToThread(multiply_points, points, scalars)
+        self.start()
+        chunks = [self.pool.submit(multiply_points, points[i:i+self.chunk_size], scalars[i:i+self.chunk_size]) for i in range(0, len(points), self.chunk_size)]
+        d = defer.gatherResults([future_to_deferred(f) for f in chunks], consumeErrors=True)
+        d.addCallback(lambda results: [p for chunk in results for p in chunk])
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+def future_to_deferred(future):
+    d = defer.Deferred()
+    def done(f):
+        if f.exception() is not None:
+            reactor.callFromThread(d.errback, f.exception())
+        else:
+            reactor.callFromThread(d.callback, f.result())
+    future.add_done_callback(done)
+    return d
+
+_engine = None
+
+def default_engine():
+    global _engine
+    if _engine is None:
+        _engine = DeckEngine()
+    return _engine
+
+class Dealer:
+    # Drop-in for the DealerEC calls Player makes, returning Deferreds for the deck-wide steps.
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else default_engine()
+        self.new_deck = NEW_DECK
+        self.shuffle_key = None
+        self.keys = None
+
+    @timed("deck.shuffle")
+    @defer.inlineCallbacks
+    def shuffle(self, deck):
+        self.shuffle_key = random_scalar()
+        encrypted = yield self.engine.multiply_points(deck, [self.shuffle_key]*len(deck))
+        random.SystemRandom().shuffle(encrypted)
+        return encrypted
+
+    @timed("deck.deal")
+    def deal(self, deck, shuffle_locked=True):
+        # Removing the shuffle lock and applying the card key is a single multiplication per card.
+        self.keys = [random_scalar() for _ in range(len(deck))]
+        unlock = pow(self.shuffle_key, ORDER-2, ORDER) if shuffle_locked else 1
+        return self.engine.multiply_points(deck, [unlock*k % ORDER for k in self.keys])
+
+    def get_card_key(self, index):
+        return self.keys[index]
+
+    @timed("deck.reveal")
+    def reveal_card(self, card, keys):
+        return reveal(card, keys)
@@ -0,0 +1,585 @@
+from collections import namedtuple
+from functools import lru_cache
+from eth_utils import to_checksum_address
+import sys, random
+
+# Local port of contracts/HighCardGameState.sol (and the parts of contracts/MentalPoker.sol
+# it depends on) so that state transitions can be checked in-process instead of with an
+# eth_call. Arithmetic follows solidity 0.5 semantics (uint256 wraps, reverts mean invalid).
+
+cards = ['2c', '2d', '2h', '2s', '3c', '3d', '3h', '3s', '4c', '4d', '4h', '4s', '5c', '5d', '5h', '5s', '6c', '6d', '6h', '6s', '7c', '7d', '7h', '7s', '8c', '8d', '8h', '8s', '9c', '9d', '9h', '9s', 'Tc', 'Td', 'Th', 'Ts', 'Jc', 'Jd', 'Jh', 'Js', 'Qc', 'Qd', 'Qh', 'Qs', 'Kc', 'Kd', 'Kh', 'Ks', 'Ac', 'Ad', 'Ah', 'As']
+card_rank = {card: i for i, card in enumerate(cards)}
+empty_address = "0x0000000000000000000000000000000000000000"
+
+# Action types
+FOLD = 0
+CALL = 1
+RAISE = 2
+REVEAL = 3
+COMMIT = 4
+
+UINT256 = 2**256
+UINT8 = 2**8
+
+GX = 0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798
+GY = 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8
+PP = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+AA = 0
+BB = 7
+ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+STATE_TYPES = ['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]']
+ENCODED_STATE_LENGTH = 17*32
+
+class Revert(Exception):
+    pass
+
+# Mirrors `struct State` in HighCardGameState.sol (note the keys ordering differs from the abi layout).
+RuleState = namedtuple('RuleState', ['handNumber', 'handRound', 'handWinner', 'lastActor', 'lastActionType', 'currentBalances', 'pot', 'toCall', 'cardX', 'cardY', 'keys'])
+
+def _word(encoded, i):
+    return int.from_bytes(encoded[32*i:32*(i+1)], 'big')
+
+def _address(encoded, i):
+    return '0x' + encoded[32*i+12:32*(i+1)].hex()
+
+def decode_state(encoded):
+    if len(encoded) < ENCODED_STATE_LENGTH:
+        raise Revert("bad state encoding")
+    if any(_word(encoded, i) >= UINT8 for i in (1, 2)) or any(_word(encoded, i) >> 160 for i in (15, 16)):
+        raise Revert("bad state encoding")
+    ck = [_word(encoded, i) for i in range(7, 15)]
+    return RuleState(
+        handNumber=_word(encoded, 0),
+        handRound=_word(encoded, 1),
+        lastActionType=_word(encoded, 2),
+        currentBalances=(_word(encoded, 3), _word(encoded, 4)),
+        pot=_word(encoded, 5),
+        toCall=_word(encoded, 6),
+        cardX=(ck[0], ck[4]),
+        cardY=(ck[1], ck[5]),
+        keys=(ck[2], ck[6], ck[3], ck[7]),
+        lastActor=_address(encoded, 15),
+        handWinner=_address(encoded, 16),
+    )
+
+# A table only ever sees a handful of addresses, so their checksummed forms are memoized.
+_checksum = lru_cache(maxsize=256)(to_checksum_address)
+
+class State:
+    # Immutable table state in the abi layout of STATE_TYPES: (hand, [round, action],
+    # [balance0, balance1, pot, to_call], cards_keys, [actor, winner]). The abi encoding and its hex
+    # form are computed on first use and cached, and states compare by their encoding.
+    __slots__ = ('hand', 'round', 'action', 'balances', 'pot', 'to_call', 'cards_keys', 'actor', 'winner', '_encoded', '_hex')
+    fields = __slots__[:-2]
+
+    def __init__(self, hand, round, action, balances, pot, to_call, cards_keys, actor=empty_address, winner=empty_address):
+        for name, value in zip(self.fields, (hand, round, action, tuple(balances), pot, to_call, tuple(cards_keys), actor, winner)):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_encoded', None)
+        object.__setattr__(self, '_hex', None)
+        if len(self.balances) != 2 or len(self.cards_keys) != 8:
+            raise ValueError("bad state layout")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("State is immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("State is immutable")
+
+    @classmethod
+    def decode(cls, encoded):
+        encoded = bytes(encoded)
+        if len(encoded) != ENCODED_STATE_LENGTH:
+            raise ValueError("bad state encoding")
+        if any(_word(encoded, i) >= UINT8 for i in (1, 2)) or any(_word(encoded, i) >> 160 for i in (15, 16)):
+            raise ValueError("bad state encoding")
+        words = [_word(encoded, i) for i in range(15)]
+        state = cls(words[0], words[1], words[2], words[3:5], words[5], words[6], words[7:15], _checksum(_address(encoded, 15)), _checksum(_address(encoded, 16)))
+        object.__setattr__(state, '_encoded', encoded)
+        return state
+
+    @classmethod
+    def from_hex(cls, hexstr):
+        state = cls.decode(bytes.fromhex(hexstr))
+        object.__setattr__(state, '_hex', hexstr)
+        return state
+
+    @classmethod
+    def from_abi(cls, values):
+        # From the nested list form eth_abi and HighCardPokerContract.encode_state use.
+        hand, (rnd, action), (b0, b1, pot, to_call), cards_keys, (actor, winner) = values
+        return cls(hand, rnd, action, (b0, b1), pot, to_call, cards_keys, actor, winner)
+
+    def as_abi(self):
+        return (self.hand, [self.round, self.action], [self.balances[0], self.balances[1], self.pot, self.to_call], list(self.cards_keys), [self.actor, self.winner])
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            words = (self.hand, self.round, self.action) + self.balances + (self.pot, self.to_call) + self.cards_keys
+            if self.round >= UINT8 or self.action >= UINT8 or any(w < 0 or w >= UINT256 for w in words):
+                raise ValueError("state value out of range")
+            addresses = [bytes.fromhex(a[2:]) for a in (self.actor, self.winner)]
+            if any(len(a) != 20 for a in addresses):
+                raise ValueError("bad address in state")
+            encoded = b''.join([w.to_bytes(32, 'big') for w in words] + [bytes(12)+a for a in addresses])
+            object.__setattr__(self, '_encoded', encoded)
+        return self._encoded
+
+    @property
+    def hex(self):
+        if self._hex is None:
+            object.__setattr__(self, '_hex', self.encoded.hex())
+        return self._hex
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.fields}
+        values.update(changes)
+        return State(**values)
+
+    def __eq__(self, other):
+        if not isinstance(other, State):
+            return NotImplemented
+        return self.encoded == other.encoded
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.encoded)
+
+    def __repr__(self):
+        return "State(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self.fields) + ")"
+
+def _participant_index(address, participants):
+    if address == participants[0].lower():
+        return 0
+    elif address == participants[1].lower():
+        return 1
+    return None
+
+###########################
+# STATE TRANSITION RULES #
+###########################
+
+def is_valid_state_transition(encoded_previous_state, encoded_new_state, participants, small_blind):
+    try:
+        return _is_valid_state_transition(decode_state(encoded_previous_state), decode_state(encoded_new_state), participants, small_blind)
+    except Revert:
+        return False
+
+def _is_valid_state_transition(old, new, participants, small_blind):
+    actor = _participant_index(new.lastActor, participants)
+    if actor is None:
+        return False
+    other = (actor+1)%2
+    if (new.currentBalances[0] + new.currentBalances[1] + new.pot) % UINT256 != (200*small_blind) % UINT256:
+        return False
+    is_even_hand = new.handNumber%2 == 0
+    is_even_round = new.handRound%2 == 0
+    if actor == 1 and is_even_hand == is_even_round:
+        return False
+    elif actor == 0 and is_even_hand != is_even_round:
+        return False
+    if new.handNumber == old.handNumber and new.handRound == (old.handRound+1) % UINT8:
+        if new.cardX != old.cardX or new.cardY != old.cardY:
+            return False
+        if new.currentBalances[other] != old.currentBalances[other]:
+            return False
+        if new.keys[1] != old.keys[1] or new.keys[2] != old.keys[2]:
+            return False
+        if new.lastActionType != REVEAL:
+            if new.keys[0] != old.keys[0] or new.keys[3] != old.keys[3]:
+                return False
+        elif actor == 0:
+            if new.keys[3] != old.keys[3] or old.keys[0] == new.keys[0] or old.keys[0] != 0:
+                return False
+            if old.lastActionType == REVEAL and new.keys[3] == 0:
+                return False
+        else:
+            if new.keys[0] != old.keys[0] or old.keys[3] == new.keys[3] or old.keys[3] != 0:
+                return False
+            if old.lastActionType == REVEAL and new.keys[0] == 0:
+                return False
+        paid = (old.currentBalances[actor] - new.currentBalances[actor]) % UINT256
+        if new.lastActionType == CALL:
+            if new.toCall != 0 or paid != old.toCall:
+                return False
+            if new.pot != (old.pot+old.toCall) % UINT256:
+                return False
+        elif new.lastActionType == RAISE:
+            if new.toCall == 0 or paid != (new.toCall+old.toCall) % UINT256:
+                return False
+            if new.pot != (new.toCall+old.toCall+old.pot) % UINT256:
+                return False
+        elif new.lastActionType == COMMIT:
+            winner = _participant_index(new.handWinner, participants)
+            if winner is None:
+                return False
+            if old.lastActionType == FOLD:
+                if actor != winner or old.pot != (new.currentBalances[actor] - old.currentBalances[actor]) % UINT256:
+                    return False
+            if old.lastActionType == REVEAL:
+                if old.pot != (new.currentBalances[winner] - old.currentBalances[winner]) % UINT256:
+                    return False
+                if not is_valid_hand_result(new.cardX, new.cardY, new.keys[0:2], new.keys[2:4], winner):
+                    return False
+        elif new.lastActionType == FOLD:
+            if new.toCall != 0 or new.pot != old.pot or old.currentBalances[actor] != new.currentBalances[actor]:
+                return False
+        elif new.lastActionType == REVEAL:
+            if old.lastActionType != REVEAL and old.lastActionType != CALL:
+                return False
+            if old.toCall != 0 or new.pot != old.pot or old.currentBalances[actor] != new.currentBalances[actor]:
+                return False
+        else:
+            return False
+    elif new.handNumber == (old.handNumber+1) % UINT256 and new.handRound == 1 and old.lastActionType == COMMIT:
+        paid = (old.currentBalances[actor] - new.currentBalances[actor]) % UINT256
+        if (old.currentBalances[other] - new.currentBalances[other]) % UINT256 != (2*small_blind) % UINT256:
+            return False
+        if new.lastActionType == CALL:
+            if new.pot != (4*small_blind) % UINT256 or new.toCall != 0:
+                return False
+            if paid != (2*small_blind) % UINT256:
+                return False
+        elif new.lastActionType == RAISE:
+            if new.pot != (paid + 2*small_blind) % UINT256:
+                return False
+            if new.toCall != (paid - 2*small_blind) % UINT256:
+                return False
+        elif new.lastActionType == FOLD:
+            if new.pot != (3*small_blind) % UINT256 or new.toCall != 0:
+                return False
+            if paid != small_blind % UINT256:
+                return False
+        else:
+            return False
+    else:
+        return False
+    return True
+
+def is_valid_state_fast_forward(encoded_previous_state, encoded_new_state, participants, small_blind):
+    try:
+        return _is_valid_state_fast_forward(decode_state(encoded_previous_state), decode_state(encoded_new_state), participants, small_blind)
+    except Revert:
+        return False
+
+def _is_valid_state_fast_forward(old, new, participants, small_blind):
+    if new.handNumber == old.handNumber and new.handRound == (old.handRound+1) % UINT8:
+        return _is_valid_state_transition(old, new, participants, small_blind)
+    elif new.handNumber == (old.handNumber+1) % UINT256 and new.handRound == 1 and old.lastActionType == COMMIT:
+        return _is_valid_state_transition(old, new, participants, small_blind)
+    if new.handNumber < old.handNumber or (new.handNumber == old.handNumber and new.handRound <= old.handRound):
+        return False
+    if (new.currentBalances[0] + new.currentBalances[1] + new.pot) % UINT256 != (200*small_blind) % UINT256:
+        return False
+    if 0 in new.cardX or 0 in new.cardY or new.keys[1] == 0 or new.keys[2] == 0:
+        return False
+    is_even_hand = new.handNumber%2 == 0
+    is_even_round = new.handRound%2 == 0
+    actor = _participant_index(new.lastActor, participants)
+    if actor is None:
+        return False
+    elif actor == 1 and is_even_hand == is_even_round:
+        return False
+    elif actor == 0 and is_even_hand != is_even_round:
+        return False
+    if new.lastActionType == COMMIT:
+        if new.toCall != 0 or new.pot != 0:
+            return False
+        if _participant_index(new.handWinner, participants) is None:
+            return False
+    if new.lastActionType == CALL and new.toCall != 0:
+        return False
+    if new.lastActionType == FOLD and new.toCall != 0:
+        return False
+    if new.lastActionType == REVEAL:
+        if new.toCall != 0:
+            return False
+        if actor == 0 and new.keys[0] == 0:
+            return False
+        if actor == 1 and new.keys[3] == 0:
+            return False
+    if new.lastActionType == RAISE and new.toCall == 0:
+        return False
+    return True
+
+#####################
+# HAND RESULT RULES #
+#####################
+
+def is_valid_hand_result(card_x, card_y, keys_p1, keys_p2, winner_index):
+    try:
+        card0 = reveal_card(card_x[0], card_y[0], keys_p1[0], keys_p2[0])
+        card1 = reveal_card(card_x[1], card_y[1], keys_p1[1], keys_p2[1])
+    except Revert:
+        return False
+    if card0 is None or card1 is None:
+        return False
+    win_card = high_card(card0, card1)
+    if win_card is None:
+        return False
+    if card0 == win_card and winner_index == 1:
+        return False
+    if card1 == win_card and winner_index == 0:
+        return False
+    return True
+
+def reveal_card(x, y, key1, key2):
+    # MentalPoker.revealCard unmasks with one key after the other. For a point on the curve that
+    # is the same as one multiplication by the inverse of the product of the keys; anything else
+    # goes through the contract's two steps. The zero checks keep its reverts either way.
+    v1 = inv_mod(key1, ORDER)
+    v2 = inv_mod(key2, ORDER)
+    if is_on_curve(x, y):
+        x2, _ = point_multiply(x, y, inv_mod(key1*key2 % ORDER, ORDER))
+    else:
+        x2, y2 = point_multiply(x, y, v1)
+        x2, y2 = point_multiply(x2, y2, v2)
+    return encoded_cards.get(x2)
+
+def high_card(card1, card2):
+    if card1 == card2:
+        return None
+    if card_rank[card1] > card_rank[card2]:
+        return card1
+    return card2
+
+#########################
+# MENTAL POKER EC MATH #
+#########################
+
+def inv_mod(x, pp):
+    if x == 0 or x == pp or pp == 0:
+        raise Revert("Invalid number")
+    return pow(x, pp-2, pp)
+
+def is_on_curve(x, y):
+    return 0 < x < PP and 0 < y < PP and (y*y - x*x*x - AA*x - BB) % PP == 0
+
+def point_multiply(x, y, scalar):
+    return _to_affine(*_jac_mul(scalar, x, y, 1, AA, PP), PP)
+
+def _to_affine(x, y, z, pp):
+    z_inv = inv_mod(z, pp)
+    z_inv2 = z_inv*z_inv % pp
+    return x*z_inv2 % pp, y*(z_inv*z_inv2 % pp) % pp
+
+def _jac_add(x1, y1, z1, x2, y2, z2, pp):
+    if x1 == 0 and y1 == 0:
+        return x2, y2, z2
+    if x2 == 0 and y2 == 0:
+        return x1, y1, z1
+    z1_2 = z1*z1 % pp
+    z2_2 = z2*z2 % pp
+    u1 = x1*z2_2 % pp
+    s1 = y1*(z2*z2_2 % pp) % pp
+    u2 = x2*z1_2 % pp
+    s2 = y2*(z1*z1_2 % pp) % pp
+    if u1 == u2:
+        raise Revert("Wrong data" if s1 != s2 else "Use double instead")
+    h = (u2 - u1) % pp
+    r = (s2 - s1) % pp
+    h2 = h*h % pp
+    h3 = h2*h % pp
+    qx = (r*r - h3) % pp
+    qx = (qx - 2*(u1*h2 % pp)) % pp
+    qy = r*((u1*h2 - qx) % pp) % pp
+    qy = (qy - s1*h3) % pp
+    qz = h*(z1*z2 % pp) % pp
+    return qx, qy, qz
+
+def _jac_double(x, y, z, aa, pp):
+    if z == 0:
+        return x, y, z
+    x2 = x*x % pp
+    y2 = y*y % pp
+    z2 = z*z % pp
+    s = 4*(x*y2 % pp) % pp
+    m = (3*x2 + aa*(z2*z2 % pp)) % pp
+    qx = (m*m - 2*s) % pp
+    qy = (m*((s - qx) % pp) - 8*(y2*y2 % pp)) % pp
+    qz = 2*(y*z % pp) % pp
+    return qx, qy, qz
+
+def _jac_mul(d, x, y, z, aa, pp):
+    qx, qy, qz = 0, 0, 1
+    if d == 0:
+        return qx, qy, qz
+    while d != 0:
+        if d & 1:
+            qx, qy, qz = _jac_add(qx, qy, qz, x, y, z, pp)
+        d >>= 1
+        x, y, z = _jac_double(x, y, z, aa, pp)
+    return qx, qy, qz
+
+# `encodedCards` in MentalPoker.sol: x coordinate of i*G (the mentalpoker DealerEC deck) -> card
+encoded_cards = {point_multiply(GX, GY, i+1)[0]: cards[i] for i in range(len(cards))}
+
+#######################################
+# DIFFERENTIAL CHECK AGAINST A LOCAL EVM #
+#######################################
+
+def deploy_local_rules(w3, contracts_dir="contracts", solc_version="0.5.0"):
+    import solcx, os
+    solcx.install_solc(solc_version)
+    compiled = {}
+    for name in ("MentalPoker.sol", "HighCardGameState.sol"):
+        out = solcx.compile_files([os.path.join(contracts_dir, name)], output_values=["abi", "bin"], solc_version=solc_version)
+        compiled.update({k.split(':')[-1]+"@"+name: v for k,v in out.items()})
+    w3.eth.defaultAccount = w3.eth.accounts[0]
+    mp = compiled["MentalPoker@MentalPoker.sol"]
+    xvalues = [point_multiply(GX, GY, i+1)[0] for i in range(len(cards))]
+    tx = w3.eth.contract(abi=mp["abi"], bytecode=mp["bin"]).constructor(xvalues).transact({'gas': 8000000})
+    mp_address = w3.eth.waitForTransactionReceipt(tx).contractAddress
+    gs = compiled["HighCardGameState@HighCardGameState.sol"]
+    tx = w3.eth.contract(abi=gs["abi"], bytecode=gs["bin"]).constructor(mp_address).transact({'gas': 8000000})
+    gs_address = w3.eth.waitForTransactionReceipt(tx).contractAddress
+    return w3.eth.contract(address=gs_address, abi=gs["abi"])
+
+def _encode(state):
+    from eth_abi import encode_abi
+    return encode_abi(STATE_TYPES, state)
+
+def _random_key(rng):
+    return rng.randrange(2, ORDER)
+
+def generate_hand(rng, last_state, participants, small_blind):
+    # Plays one random (legal) hand from `last_state` and returns the list of states.
+    hand, balances = last_state[0]+1, list(last_state[2][:2])
+    actor = 0 if hand%2 == 1 else 1
+    other = (actor+1)%2
+    picks = rng.sample(range(1, len(cards)+1), 2)
+    k = [[_random_key(rng), _random_key(rng)], [_random_key(rng), _random_key(rng)]]
+    locked = [point_multiply(GX, GY, picks[i]*k[0][i]*k[1][i] % ORDER) for i in range(2)]
+    ck = [locked[0][0], locked[0][1], 0, k[1][0], locked[1][0], locked[1][1], k[0][1], 0]
+    balances[other] -= 2*small_blind
+    choice = rng.choice([FOLD, CALL, RAISE, RAISE])
+    if choice == FOLD or balances[actor] < 3*small_blind:
+        choice = FOLD
+        balances[actor] -= small_blind
+        pot, to_call = 3*small_blind, 0
+    elif choice == CALL:
+        balances[actor] -= 2*small_blind
+        pot, to_call = 4*small_blind, 0
+    else:
+        bet = rng.randrange(3*small_blind, min(balances[actor], balances[other]+2*small_blind)+1)
+        balances[actor] -= bet
+        pot, to_call = bet+2*small_blind, bet-2*small_blind
+    states = [[hand, [1, choice], balances+[pot, to_call], ck, [participants[actor], empty_address]]]
+    rnd = 1
+    while True:
+        prev = states[-1]
+        actor, other = other, actor
+        rnd += 1
+        balances = list(prev[2][:2])
+        pot, to_call = prev[2][2], prev[2][3]
+        ck = list(prev[3])
+        winner = empty_address
+        if prev[1][1] == FOLD:
+            action = COMMIT
+            balances[actor] += pot
+            pot, to_call = 0, 0
+            winner = participants[actor]
+        elif prev[1][1] == REVEAL and (ck[2] == 0 or ck[7] == 0) or (prev[1][1] == CALL and to_call == 0 and prev[1][0] > 1):
+            action = REVEAL
+            if actor == 0:
+                ck[2] = k[0][0]
+            else:
+                ck[7] = k[1][1]
+        elif prev[1][1] == REVEAL:
+            # Only the winner can commit a showdown; the loser's move is to fold to it.
+            winner_index = 0 if high_card(cards[picks[0]-1], cards[picks[1]-1]) == cards[picks[0]-1] else 1
+            if actor != winner_index:
+                action = FOLD
+            else:
+                action = COMMIT
+                balances[actor] += pot
+                pot, to_call = 0, 0
+                winner = participants[actor]
+        else:
+            action = rng.choice([FOLD, CALL, CALL, RAISE])
+            if action == RAISE and min(balances[actor] - to_call, balances[other]) >= 2*small_blind:
+                bet = rng.randrange(2*small_blind, min(balances[actor]-to_call, balances[other])+1)
+                balances[actor] -= to_call+bet
+                pot += to_call+bet
+                to_call = bet
+            elif action == FOLD and to_call > 0:
+                to_call = 0
+            else:
+                action = CALL
+                balances[actor] -= to_call
+                pot += to_call
+                to_call = 0
+        states.append([hand, [rnd, action], balances+[pot, to_call], ck, [participants[actor], winner]])
+        if action == COMMIT:
+            return states
+
+def mutate_state(rng, state, participants):
+    state = [state[0], list(state[1]), list(state[2]), list(state[3]), list(state[4])]
+    field = rng.randrange(6)
+    if field == 0:
+        state[0] = max(0, state[0] + rng.choice([-1, 1]))
+    elif field == 1:
+        i = rng.randrange(2)
+        state[1][i] = rng.randrange(6) if i else max(0, state[1][0] + rng.choice([-1, 1]))
+    elif field == 2:
+        i = rng.randrange(4)
+        state[2][i] = max(0, state[2][i] + rng.choice([-2, -1, 1, 2])*rng.randrange(1, 3))
+    elif field == 3:
+        i = rng.randrange(8)
+        state[3][i] = rng.choice([0, state[3][i]+1, _random_key(rng)])
+    elif field == 4:
+        i = rng.randrange(2)
+        state[4][i] = rng.choice(list(participants) + [empty_address])
+    else:
+        state[4][0], state[4][1] = state[4][1], state[4][0]
+    return state
+
+def differential_check(contract, iterations=1000, seed=None, small_blind=10**16):
+    rng = random.Random(seed)
+    participants = sorted(["0x" + "%040x" % rng.getrandbits(160) for _ in range(2)], key=lambda a: int(a, 16))
+    from web3 import Web3
+    participants = [Web3.toChecksumAddress(p) for p in participants]
+    last = [0, [0, COMMIT], [100*small_blind, 100*small_blind, 0, 0], [0]*8, [empty_address, empty_address]]
+    mismatches = []
+    checked = 0
+    while checked < iterations:
+        hand = generate_hand(rng, last, participants, small_blind)
+        previous = last
+        for state in hand:
+            pairs = [(previous, state), (previous, mutate_state(rng, state, participants)), (mutate_state(rng, previous, participants), state)]
+            for old, new in pairs:
+                encoded_old, encoded_new = _encode(old), _encode(new)
+                for local_check, method in ((is_valid_state_transition, contract.functions.isValidStateTransition), (is_valid_state_fast_forward, contract.functions.isValidStateFastForward)):
+                    local = local_check(encoded_old, encoded_new, participants, small_blind)
+                    try:
+                        remote = method(encoded_old, encoded_new, participants, small_blind).call()
+                    except Exception:
+                        remote = False
+                    checked += 1
+                    if local != remote:
+                        mismatches.append((method.fn_name, old, new, local, remote))
+            previous = state
+        last = hand[-1]
+        if min(last[2][:2]) < 3*small_blind or last[2][2] != 0:
+            last = [0, [0, COMMIT], [100*small_blind, 100*small_blind, 0, 0], [0]*8, [empty_address, empty_address]]
+    return checked, mismatches
+
+if __name__ == "__main__":
+    from web3 import Web3, EthereumTesterProvider
+    args = sys.argv[1:]
+    iterations = int(args[0]) if len(args) > 0 else 1000
+    seed = int(args[1]) if len(args) > 1 else None
+    import os
+    w3 = Web3(EthereumTesterProvider())
+    contract = deploy_local_rules(w3, os.path.join(os.path.dirname(os.path.abspath(__file__)), "contracts"))
+    checked, mismatches = differential_check(contract, iterations, seed)
+    for m in mismatches[:20]:
+        print("MISMATCH", m)
+    print(f"checked {checked} state pairs against the local evm: {len(mismatches)} mismatches")
+    if len(mismatches) > 0:
+        sys.exit(1)
@@ -0,0 +1,183 @@
+from metrics import timed
+import os, json, time
+
+# Append-only journal of a session's signed states (gamestate/<sessionID>.pkr). Each line is one
+# JSON record: the game basics, a fully signed state, the current half signed (unfinished)
+# state, the deck (points and own card keys) hands are being dealt from, or a marker that the
+# session was closed. Lines are flushed as they are written and fsync is batched.
+#
+# Every hand ends in a commit state signed by both players, which serves as a checkpoint: once it
+# is appended, everything but the `keep`-1 states before it is dropped, and the file is compacted
+# at the first checkpoint after `compact_every` appends. So memory and file size stay bounded by
+# one hand however long the session runs, and what settlement needs (the last fully signed states,
+# for an unresponsive dispute the one before, and the unfinished state) is always kept, along with
+# the game basics and the deck.
+
+class GameJournal:
+    def __init__(self, path, keep=3, compact_every=64, sync_every=8, sync_interval=1.0):
+        self.path = path
+        self.keep = keep
+        self.compact_every = compact_every
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.game = None
+        self.states = []
+        self.unfinished = ''
+        self.deck = None
+        self.closed = False
+        self.appended = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.f = None
+
+    def open(self):
+        if self.f is None:
+            self.drop_torn_tail()
+            self.f = open(self.path, "a")
+        return self.f
+
+    def drop_torn_tail(self):
+        # A crash mid-write can leave a partial last line. Appending after it would glue the next
+        # record onto it and turn it into an unreadable middle line, so cut it off first. A complete
+        # record that only lacks its newline (an old whole-file backup) is kept and terminated.
+        try:
+            f = open(self.path, "rb+")
+        except FileNotFoundError:
+            return
+        with f:
+            data = f.read()
+            if data == b'' or data.endswith(b"\n"):
+                return
+            end = data.rfind(b"\n")+1
+            try:
+                json.loads(data[end:].decode())
+            except ValueError:
+                f.truncate(end)
+            else:
+                f.write(b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write(self, record):
+        f = self.open()
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.monotonic()-self.last_sync > self.sync_interval:
+            self.sync()
+
+    @timed("journal.sync")
+    def sync(self):
+        if self.f is not None and self.unsynced > 0:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def write_game(self, game):
+        self.game = game
+        self.write({'game': game})
+
+    def append_state(self, signed_state, checkpoint=False):
+        if checkpoint:
+            self.states = self.states[max(0, len(self.states)-(self.keep-1)):] if self.keep > 1 else []
+        self.states.append(signed_state)
+        self.unfinished = ''
+        self.write({'state': signed_state})
+        self.appended += 1
+        # A hand that never ends (255 rounds at most) still gets compacted eventually.
+        if (checkpoint and self.appended >= self.compact_every) or self.appended >= 4*self.compact_every:
+            self.compact()
+
+    def set_unfinished(self, unfinished):
+        self.unfinished = unfinished
+        self.write({'unfinished': unfinished})
+
+    def set_deck(self, deck):
+        self.deck = deck
+        self.write({'deck': deck})
+
+    def mark_closed(self):
+        self.closed = True
+        self.write({'closed': True})
+        self.sync()
+
+    def load(self, saved):
+        # Carry on writing to an existing journal, given what load_game read from it.
+        self.game = saved['game']
+        self.states = list(saved['states'])
+        self.unfinished = saved['unfinished']
+        self.deck = saved['deck']
+        self.closed = saved['closed']
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            if self.game is not None:
+                f.write(json.dumps({'game': self.game}) + "\n")
+            for signed_state in self.states:
+                f.write(json.dumps({'state': signed_state}) + "\n")
+            if self.deck is not None:
+                f.write(json.dumps({'deck': self.deck}) + "\n")
+            if self.unfinished != '':
+                f.write(json.dumps({'unfinished': self.unfinished}) + "\n")
+            if self.closed:
+                f.write(json.dumps({'closed': True}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        os.replace(tmp, self.path)
+        dirfd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self.appended = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+def load_game(path):
+    # Returns {'game': ..., 'states': [...], 'unfinished': ..., 'deck': ..., 'closed': ...}, the
+    # layout of the old whole-file backups (which are still accepted, and may be followed by
+    # records appended after a resume) plus what resuming needs. A torn last line from a crash
+    # mid-write is ignored.
+    game = None
+    states = []
+    unfinished = ''
+    deck = None
+    closed = False
+    with open(path, "r") as f:
+        lines = f.read().split("\n")
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if i == len(lines)-1:
+                break
+            raise
+        if 'states' in record:
+            game = record['game']
+            states = list(record['states'])
+            unfinished = record.get('unfinished', '')
+        elif 'game' in record:
+            game = record['game']
+        elif 'state' in record:
+            states.append(record['state'])
+            unfinished = ''
+        elif 'unfinished' in record:
+            unfinished = record['unfinished']
+        elif 'deck' in record:
+            deck = record['deck']
+        elif 'closed' in record:
+            closed = True
+    return {'game': game, 'states': states, 'unfinished': unfinished, 'deck': deck, 'closed': closed}
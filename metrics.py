@@ -0,0 +1,178 @@
+from collections import defaultdict
+import os, json, time, bisect, functools, threading
+
+# Timing spans and counters for the Player protocol. Phases of a hand are timed with the `timed`
+# decorator (a function returning a Deferred is timed until the Deferred fires) and node requests
+# are counted per RPC method and per contract function. Spans nest: handle_hand includes the
+# validate, verify, sign and journal spans it runs. Everything goes to one process wide REGISTRY
+# that can be served as Prometheus text (serve_metrics) or appended to a JSON lines log
+# (log_metrics); POKER_METRICS_PORT and POKER_METRICS_LOG turn those on from the environment.
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': dict(zip([str(b) for b in self.buckets]+['+Inf'], self.counts))}
+
+class Registry:
+    # Spans are histograms of seconds keyed by a dotted phase name; counters are keyed by name and
+    # a sorted tuple of labels. Observations come from reactor pool threads too, hence the lock.
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = defaultdict(int)
+        self.started = time.time()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.spans:
+                self.spans[name] = Histogram(self.buckets)
+            self.spans[name].observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def reset(self):
+        with self.lock:
+            self.spans = {}
+            self.counters = defaultdict(int)
+            self.started = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'since': self.started,
+                'spans': {name: h.snapshot() for name, h in sorted(self.spans.items())},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+            }
+
+    def prometheus(self):
+        lines = ["# TYPE poker_phase_seconds histogram"]
+        with self.lock:
+            for name, h in sorted(self.spans.items()):
+                cumulative = 0
+                for le, n in zip([repr(b) for b in h.buckets]+['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append(f'poker_phase_seconds_bucket{{phase="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'poker_phase_seconds_sum{{phase="{name}"}} {h.sum!r}')
+                lines.append(f'poker_phase_seconds_count{{phase="{name}"}} {h.count}')
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append(f"# TYPE poker_{name}_total counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"poker_{name}_total{{{label_text}}} {value}" if labels else f"poker_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def observe_since(result, name, start, registry):
+    registry.observe(name, time.perf_counter()-start)
+    return result
+
+def timed(name, registry=None):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            reg = registry if registry is not None else REGISTRY
+            if not reg.enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = f(*args, **kwargs)
+            except BaseException:
+                reg.observe(name, time.perf_counter()-start)
+                raise
+            if hasattr(result, 'addBoth'):
+                # A Deferred: the phase lasts until it fires, errors included.
+                result.addBoth(observe_since, name, start, reg)
+            else:
+                reg.observe(name, time.perf_counter()-start)
+            return result
+        return wrapper
+    return decorator
+
+def count(name, amount=1, **labels):
+    REGISTRY.count(name, amount, **labels)
+
+def contract_functions():
+    from contract_control import HEADSUP_ABI, POKER_ABI
+    from eth_utils import function_abi_to_4byte_selector
+    return {'0x'+function_abi_to_4byte_selector(f).hex(): f['name'] for abi in (HEADSUP_ABI, POKER_ABI) for f in abi if f.get('type') == 'function'}
+
+def rpc_metrics_middleware(registry=None):
+    # Counts and times every node request; eth_call is broken down by the contract function called.
+    functions = contract_functions()
+    def middleware(make_request, w3):
+        def middleware_fn(method, params):
+            reg = registry if registry is not None else REGISTRY
+            labels = {'method': method}
+            if method == 'eth_call' and len(params) > 0:
+                data = params[0].get('data') or ''
+                data = data if isinstance(data, str) else '0x' + bytes(data).hex()
+                labels['function'] = functions.get(data[:10].lower(), 'unknown')
+            reg.count('rpc_requests', **labels)
+            start = time.perf_counter()
+            try:
+                return make_request(method, params)
+            finally:
+                reg.observe('rpc.' + labels.get('function', method), time.perf_counter()-start)
+        return middleware_fn
+    return middleware
+
+def serve_metrics(port, registry=None, interface=''):
+    # GET /metrics for Prometheus, /metrics.json for the same numbers as JSON.
+    from twisted.web import server, resource
+    from twisted.internet import reactor
+    reg = registry if registry is not None else REGISTRY
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+        def render_GET(self, request):
+            if request.path.endswith(b'.json'):
+                request.setHeader(b'content-type', b'application/json')
+                return json.dumps(reg.snapshot()).encode()
+            request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+            return reg.prometheus().encode()
+
+    return reactor.listenTCP(port, server.Site(MetricsResource()), interface=interface)
+
+def log_metrics(path, interval=60, registry=None):
+    # Appends a snapshot to `path` as one JSON line every `interval` seconds and at shutdown.
+    from twisted.internet import reactor, task
+    reg = registry if registry is not None else REGISTRY
+    def write():
+        with open(path, "a") as f:
+            f.write(json.dumps(reg.snapshot()) + "\n")
+    loop = task.LoopingCall(write)
+    loop.start(interval, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', write)
+    return loop
+
+def export_from_env():
+    if os.environ.get('POKER_METRICS_PORT'):
+        serve_metrics(int(os.environ['POKER_METRICS_PORT']))
+    if os.environ.get('POKER_METRICS_LOG'):
+        log_metrics(os.environ['POKER_METRICS_LOG'], int(os.environ.get('POKER_METRICS_INTERVAL', 60)))
@@ -1,27 +1,33 @@
 from twisted.internet import reactor
 from twisted.internet.endpoints import connectProtocol, TCP4ClientEndpoint
-from basicpokerp2p import Player
-from web3 import Web3, HTTPProvider
+from basicpokerp2p import Player, load_domain_separator
+from web3 import Web3
+from rpc import shared_web3
+from metrics import export_from_env
+from strategy import from_name
 import sys, string, random
 
-def runclient(priv, w3, randomness, connect_host, connect_port):
+def runclient(priv, w3, randomness, connect_host, connect_port, strategy=None):
+    load_domain_separator(w3)
     point = TCP4ClientEndpoint(reactor, connect_host, connect_port)
-    d = connectProtocol(point, Player(priv, w3, randomness, 0, 0, 0, 0, True))
+    d = connectProtocol(point, Player(priv, w3, randomness, 0, 0, 0, 0, True, strategy))
+    export_from_env()
     reactor.run()
 
 if __name__ == "__main__":
-	if len(sys.argv) < 4:
-		raise ValueError("Must provide command line arguments: <ip:port> <infura url> <private key>")
+	if len([a for a in sys.argv if not a.startswith("--")]) < 4:
+		raise ValueError("Must provide command line arguments: <ip:port> <infura url> <private key> [--bot=<name>[:<hands>]]")
 	print()
 	print("Welcome to pokerP2P (beta)")
 	print("peer to peer one card poker on the ethereum (ropsten test) network")
 	print()
-	args = sys.argv[1:]
+	args = [a for a in sys.argv[1:] if not a.startswith("--bot=")]
+	bots = [from_name(a[len("--bot="):]) for a in sys.argv[1:] if a.startswith("--bot=")]
 	connect_info = args[0].split(':')
 	host = connect_info[0]
 	port = int(connect_info[1])
-	w3 = Web3(HTTPProvider(args[1]))
+	w3 = shared_web3(args[1])
 	priv = args[2]
 	randomness = ''.join([random.choice(string.ascii_letters+string.digits) for _ in range(25)]).encode()
 	print(f"... attempting to connect to {host} on port {port} ...")
-	runclient(priv, w3, randomness, host, port)
\ No newline at end of file
+	runclient(priv, w3, randomness, host, port, bots[-1] if bots else None)
\ No newline at end of file
@@ -1,23 +1,35 @@
 from twisted.internet import reactor
-from basicpokerp2p import PlayerFactory
-from web3 import Web3, HTTPProvider
-import sys, string, random
+from basicpokerp2p import PlayerFactory, load_domain_separator
+from web3 import Web3
+from rpc import shared_web3
+from metrics import export_from_env
+from strategy import from_name
+from functools import partial
+import sys
 
-def runserver(priv, w3, randomness, buy_in, duration, join_duration, dispute_duration, my_port):
-    f = PlayerFactory(priv, w3, randomness, buy_in, duration, join_duration, dispute_duration)
+def runserver(priv, w3, buy_in, duration, join_duration, dispute_duration, my_port, max_tables=None, new_strategy=None):
+    load_domain_separator(w3)
+    f = PlayerFactory(priv, w3, buy_in, duration, join_duration, dispute_duration, new_strategy=new_strategy, max_tables=max_tables)
     reactor.listenTCP(my_port, f)
+    export_from_env()
     reactor.run()
 
 if __name__ == "__main__":
-	if len(sys.argv) < 5:
-		raise ValueError("Must provide command line arguments: <port> <infura url> <private key> <buy in amount (in ether)>")
+	if len([a for a in sys.argv if not a.startswith("--")]) < 5:
+		raise ValueError("Must provide command line arguments: <port> <infura url> <private key> <buy in amount (in ether)> [duration] [join duration] [dispute duration] [max tables] [--bot=<name>[:<hands>]]")
 	print()
 	print("Welcome to pokerP2P (beta)")
 	print("peer to peer one card poker on the ethereum (ropsten test) network")
 	print()
-	args = sys.argv[1:]
+	args = [a for a in sys.argv[1:] if not a.startswith("--bot=")]
+	bots = [a[len("--bot="):] for a in sys.argv[1:] if a.startswith("--bot=")]
+	new_strategy = None
+	if bots:
+		# Checked now, then every table gets its own bot.
+		from_name(bots[-1])
+		new_strategy = partial(from_name, bots[-1])
 	port = int(args[0])
-	w3 = Web3(HTTPProvider(args[1]))
+	w3 = shared_web3(args[1])
 	priv = args[2]
 	buy_in = int(float(args[3])*Web3.toWei(1, 'ether'))
 	duration = 3600
@@ -29,9 +41,11 @@ if __name__ == "__main__":
 		join_duration = int(args[5])
 	if len(args) > 6:
 		dispute_duration = int(args[6])
-	randomness = ''.join([random.choice(string.ascii_letters+string.digits) for _ in range(25)]).encode()
+	max_tables = None
+	if len(args) > 7:
+		max_tables = int(args[7])
 	print("... waiting for incoming connections ...")
-	runserver(priv, w3, randomness, buy_in, duration, join_duration, dispute_duration, port)
+	runserver(priv, w3, buy_in, duration, join_duration, dispute_duration, port, max_tables, new_strategy)
 
 	
 
@@ -0,0 +1,187 @@
+from web3 import Web3, HTTPProvider
+from web3.middleware import simple_cache_middleware
+from web3._utils.request import make_post_request
+from web3._utils.abi import map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from eth_abi import decode_abi
+from eth_utils import to_bytes, function_abi_to_4byte_selector
+from collections import OrderedDict
+from metrics import rpc_metrics_middleware, count
+import json, threading, requests
+
+# Shared node access. shared_web3(url) hands out one Web3 per node url, on a provider that keeps
+# a single pool of keep-alive connections for every thread and with a read-through cache for
+# eth_call results that cannot change. JSON-RPC batching sends many reads to the node in one HTTP
+# round trip; providers that cannot take a batch (IPC, websocket, eth-tester) get the same
+# requests one at a time, so callers never need to care which one they have.
+
+class RPCError(Exception):
+    pass
+
+class PooledHTTPProvider(HTTPProvider):
+    # web3 keeps one requests.Session per thread, so every reactor pool thread opens its own
+    # connections; this provider shares one session and connection pool between all of them.
+    def __init__(self, endpoint_uri, pool_size=10, timeout=30, request_kwargs=None):
+        super().__init__(endpoint_uri, request_kwargs=request_kwargs)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, data):
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.post(self.endpoint_uri, data=data, **kwargs)
+        response.raise_for_status()
+        return response.content
+
+    def make_request(self, method, params):
+        return self.decode_rpc_response(self.post(self.encode_rpc_request(method, params)))
+
+class CallCache:
+    # Thread safe LRU of eth_call responses.
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+MOVING_BLOCK_TAGS = ('latest', 'pending', 'safe', 'finalized')
+
+# Views of the HeadsUpTables and HighCardGameState contracts whose result only depends on their
+# arguments (pure functions are picked up from the abi).
+DETERMINISTIC_CALLS = ('getTableID', 'DOMAIN_SEPARATOR', 'isValidStateTransition', 'isValidStateFastForward', 'isValidHandResult', 'initialEncodedState', 'foldAction', 'callAction', 'raiseAction', 'revealAction', 'commitAction', 'noDispute', 'malformedDispute', 'unresponsiveDispute')
+
+def deterministic_selectors(*abis):
+    selectors = set()
+    for abi in abis:
+        for f in abi:
+            if f.get('type') == 'function' and (f.get('stateMutability') == 'pure' or f.get('name') in DETERMINISTIC_CALLS):
+                selectors.add('0x' + function_abi_to_4byte_selector(f).hex())
+    return selectors
+
+def call_cache_key(transaction, block_identifier, selectors):
+    # Calls pinned to a block never change, whatever they call. Calls against a moving tag are only
+    # cached for the deterministic functions in `selectors`, and then for any block.
+    to = (transaction.get('to') or '').lower()
+    data = transaction.get('data') or ''
+    data = data if isinstance(data, str) else '0x' + bytes(data).hex()
+    tag = block_identifier if isinstance(block_identifier, str) else str(block_identifier)
+    if tag not in MOVING_BLOCK_TAGS:
+        return (to, data, (transaction.get('from') or '').lower(), tag)
+    if data[:10].lower() in selectors:
+        return (to, data)
+    return None
+
+def call_cache_middleware(cache, selectors):
+    def middleware(make_request, w3):
+        def middleware_fn(method, params):
+            if method != 'eth_call':
+                return make_request(method, params)
+            key = call_cache_key(params[0], params[1] if len(params) > 1 else 'latest', selectors)
+            if key is None:
+                return make_request(method, params)
+            response = cache.get(key)
+            if response is None:
+                response = make_request(method, params)
+                if 'result' in response and 'error' not in response:
+                    cache.put(key, response)
+            return dict(response)
+        return middleware_fn
+    return middleware
+
+_web3s = {}
+_web3s_lock = threading.Lock()
+
+def shared_web3(url, pool_size=10, cache_size=4096):
+    # One Web3 per node url for the whole process.
+    from contract_control import HEADSUP_ABI, POKER_ABI
+    with _web3s_lock:
+        if url not in _web3s:
+            w3 = Web3(PooledHTTPProvider(url, pool_size=pool_size))
+            w3.call_cache = CallCache(cache_size)
+            w3.middleware_onion.add(call_cache_middleware(w3.call_cache, deterministic_selectors(HEADSUP_ABI, POKER_ABI)), 'call_cache')
+            w3.middleware_onion.add(simple_cache_middleware, 'simple_cache')
+            # Innermost, so cache hits are not counted as node requests.
+            w3.middleware_onion.inject(rpc_metrics_middleware(), 'rpc_metrics', layer=0)
+            _web3s[url] = w3
+        return _web3s[url]
+
+def batch_request(w3, requests, batch_size=500):
+    # `requests` is a list of (method, params). Returns the raw results in order, with an RPCError
+    # in place of each request the node answered with an error.
+    provider = w3.provider
+    if not isinstance(provider, HTTPProvider):
+        results = []
+        for method, params in requests:
+            try:
+                results.append(w3.manager.request_blocking(method, params))
+            except Exception as e:
+                results.append(RPCError(str(e)))
+        return results
+    results = []
+    for start in range(0, len(requests), batch_size):
+        chunk = requests[start:start+batch_size]
+        payload = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i} for i, (method, params) in enumerate(chunk)]
+        data = json.dumps(payload).encode()
+        # Batches go around the middlewares, so they are counted here.
+        count('rpc_batches')
+        count('rpc_batched_requests', len(chunk))
+        if isinstance(provider, PooledHTTPProvider):
+            raw = provider.post(data)
+        else:
+            raw = make_post_request(provider.endpoint_uri, data, **provider.get_request_kwargs())
+        responses = json.loads(raw)
+        if not isinstance(responses, list):
+            # The node refused the whole batch.
+            raise RPCError(str(responses.get('error', responses)))
+        by_id = {r.get('id'): r for r in responses}
+        for i in range(len(chunk)):
+            response = by_id.get(i)
+            if response is None:
+                results.append(RPCError("no response"))
+            elif 'error' in response:
+                results.append(RPCError(str(response['error'])))
+            else:
+                results.append(response['result'])
+    return results
+
+def batch_calls(w3, calls, block='latest', batch_size=500):
+    # `calls` are bound contract functions (contract.functions.f(*args)). Returns what .call()
+    # would for each of them, or an RPCError for calls that reverted or failed.
+    requests = [('eth_call', [{'to': fn.address, 'data': fn._encode_transaction_data()}, block]) for fn in calls]
+    results = []
+    for fn, result in zip(calls, batch_request(w3, requests, batch_size)):
+        if isinstance(result, RPCError):
+            results.append(result)
+            continue
+        raw = to_bytes(hexstr=result) if isinstance(result, str) else bytes(result)
+        types = [output['type'] for output in fn.abi['outputs']]
+        if len(raw) == 0 and len(types) > 0:
+            results.append(RPCError("empty result (no contract at this address?)"))
+            continue
+        try:
+            values = map_abi_data(BASE_RETURN_NORMALIZERS, types, decode_abi(types, raw))
+        except Exception as e:
+            results.append(RPCError(f"could not decode {fn.fn_name} result: {e}"))
+            continue
+        results.append(values[0] if len(values) == 1 else list(values))
+    return results
@@ -1,114 +1,315 @@
-import os, time, json, binascii
-from web3 import Web3, HTTPProvider
-from contract_control import HeadsUpContract
+import os, time, json, binascii, heapq
+from web3 import Web3
+from eth_utils import function_abi_to_4byte_selector, to_bytes
+from contract_control import HeadsUpContract, HEADSUP_ABI, table_id
+from journal import load_game
+from highcard_state import State
+from rpc import RPCError, batch_calls, shared_web3
 from eth_abi import encode_abi, decode_abi
 import sys
 
 gamedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gamestate")
+CONTRACT_ADDRESS = "0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb"
 
-def run_settlement(filename, w3, priv):
-	fpath = os.path.join(gamedir, filename)
-	with open(fpath, "r") as f:
-		data = f.read()
-	gamefile = json.loads(data)
-	now = time.time()
-	basics = gamefile['game']
-	unfinished = gamefile['unfinished']
-	c = HeadsUpContract(priv, w3, contract_address="0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb", players=basics['players'])
-	c.sessionID = binascii.unhexlify(basics['sessionID'])
-	while True:
-		try:
-			final_state = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], binascii.unhexlify(gamefile['states'][-1]['state']))
-			sdata = c.contract.functions.getTableSettlement(c.tableID).call()
-			print("table is already in settlement")
-			if sdata[1] == c.account.address:
-				print("you proposed settlement")
-				if time.time() > sdata[2]:
-					tx = c.claim_expired_settlement(c.tableID, 3000000)
-					print("cashed out:", binascii.hexlify(tx))
-					return
-				else:
-					pass
+# HeadsUpTables emits no events, so the watcher follows new blocks and looks at the transactions
+# sent to the contract instead. These calls name the table in their first argument(s).
+TABLE_ID_CALLS = ('proposeSettlement', 'claimExpiredSettlement', 'claimExpiredTable')
+PARTICIPANTS_CALLS = ('openTable', 'joinTable')
+SELECTORS = {function_abi_to_4byte_selector(f): f['name'] for f in HEADSUP_ABI if f['type'] == 'function' and f['name'] in TABLE_ID_CALLS+PARTICIPANTS_CALLS}
+
+def dispute_data(encoded_state, sig):
+	v = sig[0]
+	r = sig[1].to_bytes((sig[1].bit_length()+7)//8, 'big')
+	s = sig[2].to_bytes((sig[2].bit_length()+7)//8, 'big')
+	return encode_abi(('bytes', 'uint8', 'bytes32', 'bytes32'), (encoded_state, v, r, s))
+
+class TableSettlement:
+	# Cash out of one saved game (a gamestate/*.pkr journal). check() acts on the table's reads()
+	# and returns the chain time at which the table must be looked at again (None if only a
+	# transaction on the table can change anything); it sets `done` when finished, and `settled`
+	# as well once the table was seen open and then closed, when the journal is no longer needed.
+	# A journal without signed states is a table that was opened but never played: all that can be
+	# done for it is to claim the buy in back once the table has expired.
+	def __init__(self, fpath, w3, priv, contract_address=CONTRACT_ADDRESS):
+		self.fpath = fpath
+		self.w3 = w3
+		gamefile = load_game(fpath)
+		self.basics = gamefile['game']
+		self.states = gamefile['states']
+		self.unfinished = gamefile['unfinished']
+		self.final_state = None
+		# The table overview comes with the batched reads instead of a call per table here.
+		self.c = HeadsUpContract(priv, w3, contract_address=contract_address, players=self.basics['players'], load_overview=False)
+		self.c.sessionID = binascii.unhexlify(self.basics['sessionID'])
+		self.done = False
+		self.settled = False
+		self.seen_active = False
+
+	def last_state(self):
+		if self.final_state is None and len(self.states) > 0:
+			self.final_state = State.from_hex(self.states[-1]['state'])
+		return self.final_state
+
+	def reads(self):
+		functions = self.c.contract.functions
+		tableID = self.c.tableID
+		return [functions.activeTable(tableID), functions.getTableOverview(tableID), self.c.function("getTableSettlement")(tableID), functions.getTableState(tableID)]
+
+	def check(self, now, results=None):
+		c = self.c
+		if results is None:
+			results = batch_calls(self.w3, self.reads())
+		active, overview, sdata, table_state = results
+		if isinstance(active, RPCError):
+			raise active
+		if not active:
+			if self.seen_active:
+				print(os.path.basename(self.fpath), "table is closed, eth should be cashed out.")
+				self.done = True
+				self.settled = True
+				return None
+			# The open or join transaction may still be pending; it is seen when it lands.
+			expiration = self.basics['start_time'] + self.basics['duration']
+			if expiration + 300 < now:
+				print(os.path.basename(self.fpath), "table is not open and has expired, nothing to cash out.")
+				self.done = True
+				return None
+			return expiration + 300
+		self.seen_active = True
+		if not isinstance(overview, RPCError):
+			c.set_overview(overview)
+		if isinstance(sdata, RPCError):
+			# getTableSettlement reverts while the table is not in settlement.
+			return self.propose(now)
+		print("table is already in settlement")
+		if sdata[1] == c.account.address:
+			print("you proposed settlement")
+			return self.claim_when_due(sdata, now)
+		print("other player proposed settlement")
+		if isinstance(table_state, RPCError):
+			raise table_state
+		current_state = State.decode(table_state)
+		final_state = self.last_state()
+		if final_state is not None and ((current_state.hand < final_state.hand) or ((current_state.hand==final_state.hand) and (current_state.round < final_state.round))):
+			print("your final state is more up to date... updating settlement proposal")
+			return self.propose(now)
+		if current_state.action == 4:
+			print("their state is valid")
+			return self.claim_when_due(sdata, now)
+		if sdata[0] == 1:
+			halfsigned = decode_abi(('bytes', 'uint8', 'bytes32', 'bytes32'), sdata[3])
+			state = State.decode(halfsigned[0])
+			print(f"continue playing where game left off (or you will have to surrender the hand with {state.pot/Web3.toWei(1, 'ether')} in the pot")
+			self.done = True
+			return None
+		return None
+
+	def claim_when_due(self, sdata, now):
+		if now <= sdata[2]:
+			return sdata[2]
+		tx = self.c.claim_expired_settlement(self.c.tableID, 3000000)
+		print("cashing out:", binascii.hexlify(tx))
+		return None
+
+	def propose(self, now):
+		c = self.c
+		basics = self.basics
+		expiration = basics['start_time'] + basics['duration']
+		if expiration + 300 < now:
+			print("WARNING: it is too late to cash out based on a new state (the table expired)")
+			print("attemting to cash out initial buy in")
+			tx = c.claim_expired_table(c.tableID, 3000000)
+			print("cash out tx:", binascii.hexlify(tx))
+			return None
+		elif expiration < now:
+			print("WARNING: it is very likely too late to cash out based on a new state (the table expired)")
+		elif expiration < now + 300:
+			print("WARNING: it is possibly too late to cash out based on a new state (if the table has expired)")
+		states = self.states
+		if len(states) == 0:
+			print("no signed states to settle with, waiting for the table to expire to claim the buy in back")
+			return expiration + 300
+		final_state = self.last_state()
+		if final_state.action == 4:
+			tx = c.propose_settlement(states[-1]["signatures"], final_state.encoded, 6000000)
+		elif self.unfinished != '':
+			dispute = dispute_data(binascii.unhexlify(self.unfinished['state']), self.unfinished['signature'])
+			tx = c.propose_settlement(states[-1]["signatures"], final_state.encoded, 6000000, dispute_type=1, dispute_data=dispute)
+		else:
+			second_to_last = State.from_hex(states[-2]["state"])
+			second_to_last_sigs = states[-2]["signatures"]
+			if final_state.actor == c.account.address:
+				half_state = final_state
+				half_state_sig = states[-1]['signatures'][c.account.address]
 			else:
-				print("other player proposed settlement")
-				s = c.contract.functions.getTableState(c.tableID).call()
-				current_state = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], s)
-				if ((current_state[0] < final_state[0]) or ((current_state[0]==final_state[0]) and (current_state[1][0] < final_state[1][0]))):
-					print("your final state is more up to date... updating settlement proposal")
-					raise ValueError
-				elif current_state[1][1] == 4:
-					print("their state is valid")
-					if time.time() > sdata[2]:
-						tx = c.claim_expired_settlement(c.tableID, 3000000)
-						print("cashed out:", binascii.hexlify(tx))
-						return
-					else:
-						pass
-				elif sdata[0] == 1:
-					halfsigned = decode_abi(('bytes', 'uint8', 'bytes32', 'bytes32'), sdata[3])
-					state = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], halfsigned[0])
-					print(f"continue playing where game left off (or you will have to surrender the hand with {state[2][2]/Web3.toWei(1, 'ether')} in the pot")
-					return
-			print()
-			print("continuing to monitor the table...")
-			print()
-			time.sleep(10)
-		except:
+				half_state = second_to_last
+				half_state_sig = states[-2]['signatures'][c.account.address]
+				second_to_last = State.from_hex(states[-3]["state"])
+				second_to_last_sigs = states[-3]["signatures"]
+			dispute = dispute_data(half_state.encoded, half_state_sig)
+			tx = c.propose_settlement(second_to_last_sigs, second_to_last.encoded, 6000000, dispute_type=1, dispute_data=dispute)
+		print("settlement proposed. see here:", binascii.hexlify(tx))
+		# Past this point only the expired table claim is left if the proposal never lands.
+		return expiration + 300
+
+class SettlementWatcher:
+	# Settles any number of tables from one process. New blocks come from a block filter; a
+	# transaction to the contract that names a watched table triggers a check of that table, and
+	# deadlines (settlement redeem times, table expiration) are kept in a heap against chain time.
+	def __init__(self, w3, tables, poll_interval=2, retry_delay=60, max_idle=3600, remove_done=False):
+		self.w3 = w3
+		self.poll_interval = poll_interval
+		self.retry_delay = retry_delay
+		self.max_idle = max_idle
+		self.remove_done = remove_done
+		self.tables = {}
+		for t in tables:
+			self.tables.setdefault(t.c.tableID, []).append(t)
+		self.contract_address = tables[0].c.contract.address if tables else None
+		self.domain_separator = tables[0].c.domain_separator if tables else None
+		self.deadlines = []
+		self.due = {}
+		self.now = 0
+		self.last_block = None
+
+	def table_of(self, tx_input):
+		data = to_bytes(hexstr=tx_input) if isinstance(tx_input, str) else bytes(tx_input)
+		name = SELECTORS.get(data[:4])
+		if name in TABLE_ID_CALLS and len(data) >= 36:
+			return data[4:36]
+		if name in PARTICIPANTS_CALLS and len(data) >= 68:
+			participants = [Web3.toChecksumAddress(data[4+32*i+12:4+32*(i+1)]) for i in range(2)]
+			try:
+				return table_id(self.domain_separator, participants[0], participants[1])
+			except ValueError:
+				return None
+		return None
+
+	def process_block(self, block):
+		if self.last_block is not None and block['number'] <= self.last_block:
+			return
+		self.last_block = block['number']
+		self.now = max(self.now, block['timestamp'])
+		touched = set()
+		for tx in block['transactions']:
+			if tx['to'] == self.contract_address:
+				tableID = self.table_of(tx['input'] if 'input' in tx else tx['data'])
+				if tableID in self.tables:
+					touched.add(tableID)
+		if len(touched) > 0:
+			self.check(touched)
+
+	def catch_up(self):
+		# Block range backfill, for when the node has forgotten our filter.
+		head = self.w3.eth.blockNumber
+		for number in range(self.last_block+1, head+1):
+			self.process_block(self.w3.eth.getBlock(number, True))
+
+	def check(self, tableIDs):
+		# All reads for the tables go to the node as one batch, then each table acts on its own.
+		watches = [t for tableID in tableIDs for t in self.tables.get(tableID, [])]
+		reads = [t.reads() for t in watches]
+		try:
+			results = batch_calls(self.w3, [fn for r in reads for fn in r])
+		except Exception as e:
+			results = [e]*sum(len(r) for r in reads)
+		deadlines = {}
+		offset = 0
+		for t, r in zip(watches, reads):
+			tableID = t.c.tableID
+			try:
+				due = t.check(self.now, results[offset:offset+len(r)])
+			except Exception as e:
+				print(f"{os.path.basename(t.fpath)}: {e!r}, retrying in {self.retry_delay} seconds")
+				due = self.now + self.retry_delay
+			offset += len(r)
+			if t.done:
+				self.tables[tableID].remove(t)
+				# Only a table seen open and then closed; the signed states are kept otherwise.
+				if self.remove_done and t.settled:
+					os.remove(t.fpath)
+				continue
+			if due is None:
+				due = self.now + self.max_idle
+			elif due < self.now:
+				due = self.now + self.retry_delay
+			due = min(due, self.now + self.max_idle)
+			deadlines[tableID] = min(due, deadlines.get(tableID, due))
+		for tableID in set(t.c.tableID for t in watches):
+			if len(self.tables.get(tableID, [])) == 0:
+				self.tables.pop(tableID, None)
+				self.due.pop(tableID, None)
+			elif tableID in deadlines:
+				self.due[tableID] = deadlines[tableID]
+				heapq.heappush(self.deadlines, (deadlines[tableID], tableID))
+
+	def fire_deadlines(self):
+		due = set()
+		while self.deadlines and self.deadlines[0][0] < self.now:
+			deadline, tableID = heapq.heappop(self.deadlines)
+			# Entries superseded by a later check are skipped.
+			if self.due.get(tableID) == deadline:
+				due.add(tableID)
+		if len(due) > 0:
+			self.check(due)
+
+	def start(self):
+		head = self.w3.eth.getBlock('latest')
+		self.last_block = head['number']
+		self.now = head['timestamp']
+		self.check(list(self.tables))
+
+	def run(self):
+		block_filter = self.w3.eth.filter('latest')
+		self.start()
+		while len(self.tables) > 0:
 			try:
-				if basics['start_time'] + basics['duration'] + 300 < time.time():
-					print("WARNING: it is too late to cash out based on a new state (the table expired)")
-					print("attemting to cash out initial buy in")
-					tx = c.claim_expired_table(c.tableID, 3000000)
-					print("cash out tx:", binascii.hexlify(tx))
-					return
-				elif basics['start_time'] + basics['duration'] < time.time():
-					print("WARNING: it is very likely too late to cash out based on a new state (the table expired)")
-				elif basics['start_time'] + basics['duration'] < time.time() + 300:
-					print("WARNING: it is possibly too late to cash out based on a new state (if the table has expired)")
-				final_state = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], binascii.unhexlify(gamefile['states'][-1]['state']))
-				tx = None
-				if final_state[1][1] == 4:
-					tx = c.propose_settlement(gamefile['states'][-1]["signatures"], binascii.unhexlify(gamefile['states'][-1]["state"]), 6000000)
-				elif unfinished != '':
-					sig = unfinished['signature']
-					v = sig[0]
-					r = sig[1].to_bytes((sig[1].bit_length()+7)//8, 'big')
-					s = sig[2].to_bytes((sig[2].bit_length()+7)//8, 'big')
-					dispute = encode_abi(('bytes', 'uint8', 'bytes32', 'bytes32'), (binascii.unhexlify(unfinished['state']), v, r, s))
-					tx = c.propose_settlement(gamefile['states'][-1]["signatures"], binascii.unhexlify(gamefile['states'][-1]["state"]), 6000000, dispute_type=1, dispute_data=dispute)
-				else:
-					second_to_last = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], binascii.unhexlify(gamefile['states'][-2]["state"]))
-					second_to_last_sigs = gamefile['states'][-2]["signatures"]
-					if final_state[-1][0] == c.account.address:
-						half_state = final_state
-						half_state_sig = gamefile['states'][-1]['signatures'][c.account.address]
-					else:
-						half_state = second_to_last
-						half_state_sig = gamefile['states'][-2]['signatures'][c.account.address]
-						second_to_last = decode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], binascii.unhexlify(gamefile['states'][-3]["state"]))
-						second_to_last_sigs = gamefile['states'][-3]["signatures"]
-					encoded = encode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], half_state)
-					sig = half_state_sig
-					v = sig[0]
-					r = sig[1].to_bytes((sig[1].bit_length()+7)//8, 'big')
-					s = sig[2].to_bytes((sig[2].bit_length()+7)//8, 'big')
-					dispute = encode_abi(('bytes', 'uint8', 'bytes32', 'bytes32'), (encoded, v, r, s))
-					encoded = encode_abi(['uint', 'uint8[2]','uint256[4]', 'uint256[8]', 'address[2]'], second_to_last)
-					tx = c.propose_settlement(second_to_last_sigs, encoded, 6000000, dispute_type=1, dispute_data=dispute)		
-				if tx == None:
-					raise ValueError
-				print("settlement proposed. see here:", binascii.hexlify(tx))
-			except:
-				print()
-				print("continuing to monitor the table...")
-				print()
-				time.sleep(10)
+				hashes = block_filter.get_new_entries()
+			except ValueError:
+				block_filter = self.w3.eth.filter('latest')
+				hashes = []
+				self.catch_up()
+			for h in hashes:
+				self.process_block(self.w3.eth.getBlock(h, True))
+			self.fire_deadlines()
+			if len(self.tables) > 0:
+				time.sleep(self.poll_interval)
+
+def run_settlement(filename, w3, priv):
+	SettlementWatcher(w3, [TableSettlement(os.path.join(gamedir, filename), w3, priv)], remove_done=True).run()
+
+def load_gamedir(w3, priv):
+	tables = []
+	for name in sorted(os.listdir(gamedir)):
+		if not name.endswith(".pkr"):
+			continue
+		try:
+			tables.append(TableSettlement(os.path.join(gamedir, name), w3, priv))
+		except Exception as e:
+			print(f"skipping {name}: {e!r}")
+	return tables
+
+def watch_gamedir(w3, priv):
+	tables = load_gamedir(w3, priv)
+	print(f"watching {len(tables)} tables")
+	SettlementWatcher(w3, tables, remove_done=True).run()
+
+def sweep_gamedir(w3, priv):
+	# One pass over every saved game: a single batch of reads, then whatever claims and proposals
+	# are due right now (sent back to back, nonces are handed out locally).
+	tables = load_gamedir(w3, priv)
+	watcher = SettlementWatcher(w3, tables, remove_done=True)
+	watcher.start()
+	print(f"{len(watcher.tables)} of {len(tables)} tables still need attention")
 
 if __name__ == "__main__":
 	args = sys.argv[1:]
 	filename = args[0]
-	w3 = Web3(HTTPProvider(args[1]))
+	w3 = shared_web3(args[1])
 	priv = args[2]
-	run_settlement(filename, w3, priv)
-	os.remove(os.path.join(gamedir, filename))
-	
\ No newline at end of file
+	if filename == "watch":
+		watch_gamedir(w3, priv)
+	elif filename == "sweep":
+		sweep_gamedir(w3, priv)
+	else:
+		run_settlement(filename, w3, priv)
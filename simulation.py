@@ -0,0 +1,417 @@
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+from web3 import Web3
+from web3.providers import BaseProvider
+from eth_abi import encode_abi
+from eth_utils import keccak
+from basicpokerp2p import Player, PlayerFactory, ether
+from contract_control import CHAIN_ID, HeadsUpContract, domain_separator, HighCardPokerContract, recover_signer, table_transaction_hash
+from highcard_state import State, empty_address
+from strategy import Bot, BOTS, FOLD, CALL, RAISE
+from collections import Counter
+import sys, os, time, json, random, string, shutil, tempfile, contextlib, tracemalloc
+
+# Headless bot-vs-bot runs of the whole Player protocol, for measuring it. One host factory plays
+# `tables` client Players over loopback TCP, with moves from seeded ScriptedStrategy bots and no
+# waiting on block times. chain="evm" compiles the bundled contracts (needs py-solc-x and network
+# access for solc 0.5.0 the first time) and deploys them to a local eth-tester chain (needs
+# eth-tester), chain="stub" checks and records the table transactions in memory without any chain
+# or node, and chain="auto" falls back to the stub when the contracts cannot be deployed. The twisted reactor can only be run once,
+# so run_simulation can only be called once per process. With `drop_after` the first client's
+# connection is cut after it has sent that many messages, and it reconnects and resumes the game
+# from its journal.
+
+CONTRACTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "contracts")
+
+class ScriptedStrategy(Bot):
+    # Plays `hands` hands. Moves come from `script`, a list of (action, raise in big blinds) that
+    # is repeated, or are drawn from a seeded random generator.
+    def __init__(self, hands, seed=None, script=None):
+        super().__init__(hands, seed)
+        self.script = script
+        self.step = 0
+
+    def choose_action(self, player, view):
+        if self.script:
+            action, blinds = self.script[self.step % len(self.script)]
+            self.step += 1
+        else:
+            action, blinds = self.rng.choice((FOLD, CALL, CALL, RAISE)), self.rng.randint(1, 3)
+        return action, blinds*view.big_blind
+
+class SimulationStats:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.hands = 0
+        self.message_latency = []
+        self.hand_latency = []
+        self.rpcs = Counter()
+
+    def message_handled(self, result, received):
+        self.message_latency.append(time.perf_counter()-received)
+        return result
+
+def rpc_counter(stats):
+    def middleware(make_request, w3):
+        def middleware_fn(method, params):
+            stats.rpcs[method] += 1
+            return make_request(method, params)
+        return middleware_fn
+    return middleware
+
+def percentiles(samples, qs=(0.5, 0.9, 0.99)):
+    if len(samples) == 0:
+        return {f"p{int(q*100)}": None for q in qs}
+    ordered = sorted(samples)
+    return {f"p{int(q*100)}": 1000*ordered[min(len(ordered)-1, int(round(q*(len(ordered)-1))))] for q in qs}
+
+class StubLedger:
+    # What the table contract would hold, for runs without the compiled contracts.
+    def __init__(self):
+        self.tables = {}
+        self.settlements = {}
+        self.txs = 0
+
+    def tx(self):
+        self.txs += 1
+        return keccak(self.txs.to_bytes(32, 'big'))
+
+class StubTableContract(HeadsUpContract):
+    # HeadsUpContract whose transactions are checked and recorded in a StubLedger instead of being
+    # sent; the signatures are verified the way the contract would.
+    def __init__(self, ledger, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ledger = ledger
+
+    @property
+    def domain_separator(self):
+        return domain_separator(self.chain_id, self.contract.address)
+
+    def check_signatures(self, addr2sig, participants, tx_data):
+        txhash = table_transaction_hash(self.tableID, self.sessionID, tx_data)
+        for participant in participants:
+            if recover_signer(txhash, addr2sig[participant]) != participant:
+                raise ValueError(f"bad signature from {participant}")
+
+    def open_table_tx(self, addr2sig, participants, buyIn, duration, join_duration, dispute_duration, sessionID, gas):
+        open_data = encode_abi(('uint256', 'uint256', 'uint256', 'uint256', 'uint256'), (buyIn, buyIn//100, duration, join_duration, dispute_duration))
+        self.sessionID = sessionID
+        self.check_signatures(addr2sig, participants, open_data)
+        self.ledger.tables[self.tableID] = [participants, [buyIn, 0]]
+        self.players = participants
+        self.buy_in_amnt = buyIn
+        return self.ledger.tx()
+
+    def join_table_tx(self, participants, buyIn, sessionID, gas):
+        table = self.ledger.tables.get(self.tableID)
+        if table is None or table[0] != participants:
+            raise ValueError("no such table")
+        table[1][1] = buyIn
+        self.players = participants
+        self.buy_in_amnt = buyIn
+        self.sessionID = sessionID
+        return self.ledger.tx()
+
+    def table_overview(self):
+        if self.tableID not in self.ledger.tables:
+            raise ValueError("table is not open")
+        return self.ledger.tables[self.tableID]
+
+    def propose_settlement(self, addr2sig, last_state, gas, dispute_type=0, dispute_data=b''):
+        self.check_signatures(addr2sig, self.players, last_state)
+        self.ledger.settlements[self.tableID] = State.decode(last_state)
+        return self.ledger.tx()
+
+    def claim_expired_settlement(self, tableID, gas):
+        if tableID not in self.ledger.settlements:
+            raise ValueError("table is not in settlement")
+        return self.ledger.tx()
+
+    def claim_expired_table(self, tableID, gas):
+        return self.ledger.tx()
+
+class SimPlayer(Player):
+    # Player wired to a Simulation: chain calls run inline (eth-tester is in process and not
+    # thread safe), sleeps move chain time instead of waiting, and traffic is counted.
+    simulation = None
+
+    def __init__(self, priv, *args, **kwargs):
+        super().__init__(priv, *args, **kwargs)
+        self.priv = priv
+        self.simulation.contracts(self, priv)
+        self.hand_clock = None
+        self.cut_after = None
+        self.cut = False
+
+    def chain(self, f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+    def sleep(self, seconds):
+        self.simulation.advance(seconds)
+        return defer.succeed(None)
+
+    def sendString(self, data):
+        if self.cut_after is not None:
+            self.cut_after -= 1
+            if self.cut_after == 0:
+                self.cut = True
+                self.simulation.drops += 1
+                self.transport.abortConnection()
+                return
+        stats = self.simulation.stats
+        stats.messages += 1
+        stats.bytes += len(data)
+        super().sendString(data)
+
+    def stringReceived(self, payload):
+        received = time.perf_counter()
+        super().stringReceived(payload)
+        self.events.addCallback(self.simulation.stats.message_handled, received)
+
+    def connectionLost(self, reason):
+        super().connectionLost(reason)
+        if self.cut:
+            reactor.callLater(0.2, self.simulation.reconnect, self)
+
+    def start_journal(self):
+        super().start_journal()
+        self.hand_clock = time.perf_counter()
+
+    def restore_game(self, path, saved):
+        super().restore_game(path, saved)
+        self.hand_clock = time.perf_counter()
+
+    def record_signed_state(self, state, signatures):
+        super().record_signed_state(state, signatures)
+        # Every hand ends in one commit state recorded by both players; count it on the client side.
+        if self.client and state.action == 4:
+            now = time.perf_counter()
+            stats = self.simulation.stats
+            stats.hands += 1
+            stats.hand_latency.append(now-self.hand_clock)
+            self.hand_clock = now
+
+class Simulation:
+    def __init__(self, hands=20, tables=1, seed=1, chain="auto", buy_in=ether, pipeline=True, hands_per_deck=26, bundle=True, bot=None, drop_after=None, timeout=600):
+        self.hands = hands
+        self.tables = tables
+        self.seed = seed
+        self.mode = chain
+        self.buy_in = buy_in
+        self.pipeline = pipeline
+        self.bundle = bundle
+        self.bot = bot
+        self.drop_after = drop_after
+        self.drops = 0
+        self.hands_per_deck = hands_per_deck
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.stats = SimulationStats()
+        self.ledger = StubLedger()
+        # The stub makes no node requests; deploy() swaps in the eth-tester chain.
+        self.w3 = Web3(BaseProvider())
+        self.chain_id = CHAIN_ID
+        self.headsup_address = None
+        self.headsup_abi = None
+        self.poker_address = None
+        self.poker_abi = None
+        self.players = []
+        self.port = None
+        self.timed_out = False
+
+    def key(self):
+        return '0x' + bytes(self.rng.getrandbits(8) for _ in range(32)).hex()
+
+    def randomness(self):
+        return ''.join(self.rng.choice(string.ascii_letters+string.digits) for _ in range(25)).encode()
+
+    def deploy(self):
+        # HighCardGameState (and the MentalPoker it reads the deck from), then the table contract.
+        import solcx
+        from web3 import EthereumTesterProvider
+        from highcard_state import deploy_local_rules
+        w3 = self.w3 = Web3(EthereumTesterProvider())
+        self.chain_id = w3.eth.chain_id
+        rules = deploy_local_rules(w3, CONTRACTS_DIR)
+        compiled = solcx.compile_files([os.path.join(CONTRACTS_DIR, "HeadsUpPoker.sol")], output_values=["abi", "bin"], solc_version="0.5.0")
+        headsup = [v for k,v in compiled.items() if k.split(':')[-1] == "HeadsUpTables"][0]
+        tx = w3.eth.contract(abi=headsup["abi"], bytecode=headsup["bin"]).constructor(rules.address, 10**8, self.chain_id).transact({'gas': 8000000})
+        self.headsup_address = w3.eth.waitForTransactionReceipt(tx).contractAddress
+        self.poker_address = rules.address
+        # The players talk to these contracts through the ABIs they were compiled with.
+        self.headsup_abi = headsup["abi"]
+        self.poker_abi = rules.abi
+
+    def fund(self, address, amount):
+        tx = self.w3.eth.sendTransaction({'from': self.w3.eth.accounts[0], 'to': address, 'value': amount})
+        self.w3.eth.waitForTransactionReceipt(tx)
+
+    def contracts(self, player, priv):
+        if self.mode == "evm":
+            player.table_contract = HeadsUpContract(priv, self.w3, contract_address=self.headsup_address, abi=self.headsup_abi, nonces=player.table_contract.nonces)
+            player.poker_contract = HighCardPokerContract(self.w3, contract_address=self.poker_address, abi=self.poker_abi)
+        else:
+            player.table_contract = StubTableContract(self.ledger, priv, self.w3, contract_address=player.table_contract.contract.address, chain_id=self.chain_id, nonces=player.table_contract.nonces)
+
+    def advance(self, seconds):
+        if self.mode == "evm":
+            self.w3.testing.timeTravel(self.w3.eth.getBlock('latest')['timestamp'] + int(seconds))
+            self.w3.testing.mine()
+
+    def setup(self):
+        if self.mode in ("auto", "evm"):
+            try:
+                self.deploy()
+                self.mode = "evm"
+            except Exception as e:
+                if self.mode == "evm":
+                    raise
+                print(f"could not deploy the contracts ({e!r}), using the in-memory table contract", file=sys.stderr)
+                self.mode = "stub"
+        host_key = self.key()
+        client_keys = [self.key() for _ in range(self.tables)]
+        if self.mode == "evm":
+            stake = (self.buy_in + self.buy_in//100 + ether)
+            self.fund(self.w3.eth.account.privateKeyToAccount(host_key).address, self.tables*stake)
+            for key in client_keys:
+                self.fund(self.w3.eth.account.privateKeyToAccount(key).address, stake)
+        self.w3.middleware_onion.add(rpc_counter(self.stats), 'rpc_counter')
+        simulation = self
+
+        class Bound(SimPlayer):
+            pass
+        Bound.simulation = simulation
+
+        class Host(PlayerFactory):
+            protocol = Bound
+            def buildProtocol(self, addr):
+                protocol = super().buildProtocol(addr)
+                if protocol is not None:
+                    simulation.players.append(protocol)
+                return protocol
+
+        self.factory = Host(host_key, self.w3, self.buy_in, 3600, 600, 600, lambda: self.strategy(None, self.seed))
+        # Both ends of a table name their journal after the session, so the clients keep theirs apart.
+        client_dir = os.path.join(SimPlayer.gamedir, "clients")
+        os.mkdir(client_dir)
+        for key in client_keys:
+            self.players.append(Bound(key, self.w3, self.randomness(), 0, 0, 0, 0, True, self.strategy(self.hands, self.rng.getrandbits(32)), pipeline=self.pipeline, hands_per_deck=self.hands_per_deck, bundle=self.bundle))
+            self.players[-1].gamedir = client_dir
+        if self.drop_after is not None:
+            self.players[0].cut_after = self.drop_after
+
+    def strategy(self, hands, seed):
+        # Seeded random moves, or one of the built in bots (strategy.BOTS) when `bot` names one.
+        if self.bot is None:
+            return ScriptedStrategy(hands, seed)
+        return BOTS[self.bot](hands, seed)
+
+    def connect(self, client):
+        connectProtocol(TCP4ClientEndpoint(reactor, '127.0.0.1', self.port.getHost().port), client)
+
+    def reconnect(self, dropped):
+        # A new connection for the same player; it finds its saved game and resumes it.
+        client = type(dropped)(dropped.priv, self.w3, self.randomness(), 0, 0, 0, 0, True, dropped.strategy, pipeline=self.pipeline, hands_per_deck=self.hands_per_deck, bundle=self.bundle)
+        client.gamedir = dropped.gamedir
+        self.players.append(client)
+        self.connect(client)
+
+    def settled_tables(self):
+        # Tables whose final state reached the table contract: paid out, or waiting out the dispute
+        # period of a settlement.
+        tables = {p.table_contract.tableID for p in self.players if p.table_contract.tableID is not None}
+        if self.mode != "evm":
+            return len(tables & set(self.ledger.settlements))
+        c = self.players[0].table_contract
+        settled = 0
+        for tableID in tables:
+            active = c.contract.functions.activeTable(tableID).call()
+            settled += not active or c.function("getTableSettlement")(tableID).call()[1] != empty_address
+        return settled
+
+    def finished(self):
+        # A table is over once either side has closed it; the other side may still be waiting on a
+        # settlement that is not coming, so the connections are dropped here.
+        live = [p for p in self.players if p.transport is not None and p.transport.connected]
+        for p in live:
+            if p.state == "CLOSED":
+                p.transport.loseConnection()
+        return len(self.players) == 2*(self.tables+self.drops) and len(live) == 0
+
+    def poll(self):
+        if self.finished():
+            reactor.stop()
+        else:
+            reactor.callLater(0.05, self.poll)
+
+    def stop(self):
+        if reactor.running:
+            self.timed_out = True
+            reactor.stop()
+
+    def run(self):
+        journals = tempfile.mkdtemp(prefix="simulation-")
+        SimPlayer.gamedir = journals
+        try:
+            self.setup()
+            self.port = reactor.listenTCP(0, self.factory, interface='127.0.0.1')
+            self.stats.rpcs.clear()
+            started = time.perf_counter()
+            for client in self.players[:self.tables]:
+                self.connect(client)
+            reactor.callLater(0.05, self.poll)
+            reactor.callLater(self.timeout, self.stop)
+            # The players narrate every move; none of that is wanted here.
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                reactor.run()
+            elapsed = time.perf_counter()-started
+        finally:
+            shutil.rmtree(journals, ignore_errors=True)
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        stats = self.stats
+        hands = max(stats.hands, 1)
+        rpcs = dict(stats.rpcs)
+        return {
+            'chain': self.mode,
+            'tables': self.tables,
+            'hands': stats.hands,
+            'completed': not self.timed_out,
+            'drops': self.drops,
+            'seconds': elapsed,
+            'hands_per_second': stats.hands/elapsed,
+            'messages_per_hand': stats.messages/hands,
+            'bytes_per_hand': stats.bytes/hands,
+            'rpcs_per_hand': sum(rpcs.values())/hands,
+            'rpcs': rpcs,
+            'settlements': self.settled_tables(),
+            'message_latency_ms': percentiles(stats.message_latency),
+            'hand_latency_ms': percentiles(stats.hand_latency),
+            # Only when run under `python -X tracemalloc` (see benchmark.py).
+            'peak_traced_kb': tracemalloc.get_traced_memory()[1]/1024 if tracemalloc.is_tracing() else None,
+        }
+
+def run_simulation(hands=20, tables=1, seed=1, chain="auto", **kwargs):
+    return Simulation(hands, tables, seed, chain, **kwargs).run()
+
+def print_report(report):
+    print(f"{report['hands']} hands on {report['tables']} tables ({report['chain']} chain), {report['settlements']} settled, in {report['seconds']:.2f}s{'' if report['completed'] else ' (timed out)'}{', resumed after a drop' if report['drops'] else ''}")
+    print(f"hands/s: {report['hands_per_second']:.2f}  messages/hand: {report['messages_per_hand']:.1f}  bytes/hand: {report['bytes_per_hand']:.0f}  rpcs/hand: {report['rpcs_per_hand']:.2f}")
+    for name in ('message_latency_ms', 'hand_latency_ms'):
+        print(name+":", "  ".join(f"{q} {v:.2f}" if v is not None else f"{q} -" for q, v in report[name].items()))
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    hands = int(args[0]) if len(args) > 0 else 20
+    tables = int(args[1]) if len(args) > 1 else 1
+    seed = int(args[2]) if len(args) > 2 else 1
+    chain = args[3] if len(args) > 3 else "auto"
+    bots = [a[len("--bot="):] for a in sys.argv[1:] if a.startswith("--bot=")]
+    drops = [int(a[len("--drop="):]) for a in sys.argv[1:] if a.startswith("--drop=")]
+    report = run_simulation(hands, tables, seed, chain, bundle="--no-bundle" not in sys.argv, bot=bots[-1] if bots else None, drop_after=drops[-1] if drops else None)
+    if "--json" in sys.argv:
+        print(json.dumps(report))
+    else:
+        print_report(report)
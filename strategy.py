@@ -0,0 +1,157 @@
+from twisted.internet import defer, threads
+from collections import namedtuple
+from highcard_state import card_rank
+from web3 import Web3
+import random
+
+# A Strategy makes every decision a Player needs during a session. Each method may return
+# a plain value or a Deferred, so decisions can come from a human, a bot or a remote service
+# without ever blocking the reactor. choose_action gets a TableView and returns (action, raise),
+# the raise in wei on top of calling; the bots below need no stdin and can be picked by name
+# with from_name (poker_server.py and poker_client.py take --bot=<name>[:<hands>]).
+
+FOLD = 0
+CALL = 1
+RAISE = 2
+ether = Web3.toWei(1, 'ether')
+
+# What a player knows when it is its turn, amounts in wei. opponent_action is the action type
+# the opponent just made (None on the first move of a hand).
+class TableView(namedtuple('TableView', ['hand', 'round', 'card', 'stack', 'opponent_stack', 'pot', 'to_call', 'big_blind', 'opponent_action'])):
+    __slots__ = ()
+
+    @property
+    def strength(self):
+        # 0 for a deuce up to 12 for an ace; suits only break ties between equal ranks.
+        return card_rank[self.card]//4
+
+    @property
+    def max_raise(self):
+        # The most that can be raised: our stack after calling, or the opponent's if smaller.
+        return max(0, min(self.stack-self.to_call, self.opponent_stack))
+
+    def can_raise(self):
+        return self.max_raise > 0
+
+    def raise_by(self, amount):
+        # A legal raise as close to `amount` as possible: at least the big blind, or all in when
+        # less than that is left (the Player caps a raise at the opponent's stack).
+        all_in = self.stack-self.to_call
+        if all_in <= self.big_blind:
+            return RAISE, all_in
+        return RAISE, min(max(amount, self.big_blind), all_in)
+
+class Strategy:
+    def accept_table(self, player, opponent, buy_in, duration, dispute_duration):
+        return True
+
+    def confirm(self, player, prompt):
+        return True
+
+    def choose_action(self, player, view):
+        raise NotImplementedError
+
+    def continue_playing(self, player, state):
+        return True
+
+class ConsoleStrategy(Strategy):
+    def __init__(self, max_mistakes=8):
+        self.max_mistakes = max_mistakes
+
+    def ask(self, prompt):
+        return threads.deferToThread(input, prompt)
+
+    @defer.inlineCallbacks
+    def accept_table(self, player, opponent, buy_in, duration, dispute_duration):
+        print(f"{opponent} wants to open a table with you. buy in: {buy_in/ether} eth; duration: {duration}; dispute duration: {dispute_duration}")
+        i = yield self.ask("press enter to accept invitation (type `exit` to reject)")
+        return i != "exit"
+
+    @defer.inlineCallbacks
+    def confirm(self, player, prompt):
+        i = yield self.ask(prompt)
+        return i != "exit"
+
+    @defer.inlineCallbacks
+    def choose_action(self, player, view):
+        for _ in range(self.max_mistakes):
+            action_type = yield self.ask("[fold=0, call=1, raise=2]: ")
+            if action_type == "0":
+                return FOLD, 0
+            elif action_type == "1":
+                return CALL, 0
+            elif action_type == "2":
+                raise_str = yield self.ask(f"call {view.to_call/ether} and raise ({view.big_blind/ether} min):")
+                try:
+                    return RAISE, Web3.toWei(float(raise_str), 'ether')
+                except ValueError:
+                    print("invalid raise amount entered")
+            else:
+                print("bad input try again!")
+        raise ValueError("too many mistakes")
+
+    @defer.inlineCallbacks
+    def continue_playing(self, player, state):
+        for _ in range(self.max_mistakes):
+            action_type = yield self.ask("[continue playing=1, cash out=2]:")
+            if action_type == "1":
+                return True
+            elif action_type == "2":
+                return False
+            print("invalid input try again.")
+        raise ValueError("too many mistakes")
+
+class Bot(Strategy):
+    # Base for the built in bots: accepts every table, plays `hands` hands (forever when None)
+    # and then cashes out.
+    def __init__(self, hands=None, seed=None):
+        self.hands = hands
+        self.rng = random.Random(seed)
+        self.played = 0
+
+    def continue_playing(self, player, state):
+        self.played += 1
+        return self.hands is None or self.played < self.hands
+
+class CallingBot(Bot):
+    # Never folds and never raises, so every hand that is not folded goes to a showdown.
+    def choose_action(self, player, view):
+        return CALL, 0
+
+class RandomBot(Bot):
+    def choose_action(self, player, view):
+        action = self.rng.choice((FOLD, CALL, CALL, RAISE))
+        if action == RAISE and view.can_raise():
+            return view.raise_by(self.rng.randint(1, 3)*view.big_blind)
+        if action == FOLD and view.to_call == 0:
+            return CALL, 0
+        return (CALL, 0) if action == RAISE else (action, 0)
+
+class HighCardBot(Bot):
+    # Plays its card: raises half the pot with a strong one (or as an occasional bluff), calls
+    # with a middling one or when calling is free, folds the rest. It never raises a raise and
+    # only calls one with a strong card, so two of these do not go all in every hand.
+    def __init__(self, hands=None, seed=None, raise_from=9, call_from=5, bluff=0.05):
+        super().__init__(hands, seed)
+        self.raise_from = raise_from
+        self.call_from = call_from
+        self.bluff = bluff
+
+    def choose_action(self, player, view):
+        strength = view.strength
+        if view.opponent_action == RAISE:
+            return (CALL, 0) if strength >= self.raise_from else (FOLD, 0)
+        if (strength >= self.raise_from or self.rng.random() < self.bluff) and view.can_raise():
+            return view.raise_by(view.pot//2)
+        if strength >= self.call_from or view.to_call == 0:
+            return CALL, 0
+        return FOLD, 0
+
+BOTS = {'call': CallingBot, 'random': RandomBot, 'highcard': HighCardBot}
+
+def from_name(spec, seed=None):
+    # "<bot>" or "<bot>:<hands>", e.g. "highcard:1000".
+    name, _, hands = spec.partition(':')
+    if name not in BOTS:
+        raise ValueError(f"unknown bot {name}, pick one of {', '.join(BOTS)}")
+    return BOTS[name](int(hands) if hands else None, seed)
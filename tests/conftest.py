@@ -0,0 +1,23 @@
+import os, sys
+
+# The modules live at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture(scope="session")
+def solc():
+    # The checks against the compiled contracts need solc 0.5.0, which py-solc-x downloads the first
+    # time. They are skipped where it cannot be had, unless POKER_REQUIRE_SOLC is set, as in CI.
+    def unavailable(reason):
+        if os.environ.get("POKER_REQUIRE_SOLC"):
+            pytest.fail(reason)
+        pytest.skip(reason)
+    try:
+        import solcx, eth_tester
+    except ImportError as e:
+        unavailable(f"missing test dependency: {e}")
+    try:
+        solcx.install_solc("0.5.0")
+    except Exception as e:
+        unavailable(f"cannot install solc 0.5.0: {e!r}")
@@ -0,0 +1,155 @@
+from contract_control import HeadsUpContract, NonceManager, contract_domain_separator, domain_separator
+from eth_account import Account
+import pytest
+
+ADDRESS = "0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb"
+
+class Call:
+    def __init__(self, result):
+        self.result = result
+
+    def call(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+class Functions:
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def DOMAIN_SEPARATOR(self):
+        self.calls += 1
+        return Call(self.result)
+
+class Contract:
+    def __init__(self, result):
+        self.address = ADDRESS
+        self.functions = Functions(result)
+
+def test_domain_separator_read_from_contract():
+    deployed = domain_separator(1, ADDRESS)
+    contract = Contract(deployed)
+    eth = object()
+    assert contract_domain_separator(eth, contract) == deployed
+    assert contract_domain_separator(eth, contract) == deployed
+    assert contract.functions.calls == 1
+
+def test_domain_separator_unreadable():
+    contract = Contract(ConnectionError("node is down"))
+    eth = object()
+    with pytest.raises(RuntimeError):
+        contract_domain_separator(eth, contract)
+    contract.functions.result = domain_separator(5, ADDRESS)
+    assert contract_domain_separator(eth, contract) == domain_separator(5, ADDRESS)
+    assert contract.functions.calls == 2
+
+class Eth:
+    def __init__(self, pending):
+        self.pending = pending
+        self.reads = 0
+
+    def getTransactionCount(self, address, block):
+        self.reads += 1
+        return self.pending
+
+def test_nonces_refill_gaps():
+    eth = Eth(7)
+    nonces = NonceManager(eth, ADDRESS)
+    first, second, third = nonces.allocate(), nonces.allocate(), nonces.allocate()
+    assert (first, second, third) == (7, 8, 9)
+    nonces.release(second)
+    nonces.sent(third)
+    # Nothing is broadcast with 7 yet, so the node would still say 8 or less.
+    eth.pending = 8
+    assert nonces.allocate() == 8
+    assert nonces.allocate() == 10
+    assert eth.reads == 1
+
+def test_nonces_roll_back_top():
+    nonces = NonceManager(Eth(0), ADDRESS)
+    allocated = [nonces.allocate() for _ in range(3)]
+    nonces.release(allocated[1])
+    nonces.release(allocated[2])
+    assert nonces.allocate() == 1
+    assert nonces.allocate() == 2
+    assert nonces.released == set()
+
+def test_nonces_resync_waits_for_outstanding():
+    eth = Eth(0)
+    nonces = NonceManager(eth, ADDRESS)
+    sending = nonces.allocate()
+    nonces.resync()
+    assert nonces.allocate() == 1
+    nonces.sent(sending)
+    nonces.sent(1)
+    eth.pending = 5
+    assert nonces.allocate() == 5
+    assert eth.reads == 2
+
+class Node(Eth):
+    # Just enough of eth for HeadsUpContract._send_tx.
+    def __init__(self, chain_id):
+        super().__init__(0)
+        self.chain_id = chain_id
+        self.chain_reads = 0
+        self.sent = []
+        self.fail = None
+
+    @property
+    def chainId(self):
+        self.chain_reads += 1
+        return self.chain_id
+
+    def sendRawTransaction(self, raw):
+        if self.fail is not None:
+            raise self.fail
+        self.sent.append(raw)
+        return len(self.sent)
+
+class Function:
+    fn_name = "claimExpiredTable"
+
+    def buildTransaction(self, tx):
+        return dict(tx, to=ADDRESS, data="0x")
+
+class Prices:
+    def gas_price(self):
+        return 1
+
+def contract_on(node):
+    account = Account.from_key(b"\x01"*32)
+    c = HeadsUpContract.__new__(HeadsUpContract)
+    c.eth, c.account, c.chain_id = node, account, None
+    c.nonces, c.gas_prices = NonceManager(node, account.address), Prices()
+    return c
+
+def test_transactions_signed_for_node_chain():
+    node = Node(1337)
+    c = contract_on(node)
+    c._send_tx(Function(), 50000)
+    c._send_tx(Function(), 50000)
+    assert node.chain_reads == 1
+    assert [Account.recover_transaction(raw) for raw in node.sent] == [c.account.address]*2
+    assert c.nonces.allocate() == 2
+
+def test_failed_send_frees_nonce():
+    node = Node(1)
+    c = contract_on(node)
+    node.fail = ValueError("insufficient funds")
+    with pytest.raises(ValueError):
+        c._send_tx(Function(), 50000)
+    assert c.nonces.allocate() == 0
+
+def test_claim_names():
+    # The table contract as compiled from contracts/HeadsUpPoker.sol.
+    from contract_control import load_abi, CLAIM_NAMES
+    from web3 import Web3
+    from web3.providers import BaseProvider
+    abi = [dict(f, name=CLAIM_NAMES.get(f.get("name"), f.get("name"))) for f in load_abi("headsup.abi")]
+    c = HeadsUpContract(b"\x01"*32, Web3(BaseProvider()), contract_address=ADDRESS, abi=abi, chain_id=3)
+    assert c.function("proposeSettlement").fn_name == "proposeClaim"
+    assert c.function("getTableSettlement").fn_name == "getTableClaim"
+    assert c.function("getTableOverview").fn_name == "getTableOverview"
+    c = HeadsUpContract(b"\x01"*32, Web3(BaseProvider()), contract_address=ADDRESS, chain_id=3)
+    assert c.function("proposeSettlement").fn_name == "proposeSettlement"
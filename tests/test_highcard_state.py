@@ -0,0 +1,107 @@
+import copy, os, random
+import pytest
+from eth_utils import to_checksum_address
+
+import highcard_state
+
+CONTRACTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "contracts")
+
+@pytest.fixture(scope="module")
+def local_rules(solc):
+    from web3 import Web3, EthereumTesterProvider
+    return highcard_state.deploy_local_rules(Web3(EthereumTesterProvider()), CONTRACTS_DIR)
+
+def test_differential_check(local_rules):
+    checked, mismatches = highcard_state.differential_check(local_rules, iterations=300, seed=1)
+    assert checked >= 300
+    assert mismatches == []
+
+SMALL_BLIND = 10**16
+
+PLAYERS = [to_checksum_address("0x" + "%040x" % (i*0x1111111111)) for i in (3, 7)]
+
+def start():
+    return [0, [0, highcard_state.COMMIT], [100*SMALL_BLIND, 100*SMALL_BLIND, 0, 0], [0]*8, [highcard_state.empty_address]*2]
+
+def hands(count, seed=1):
+    rng = random.Random(seed)
+    last = start()
+    for _ in range(count):
+        hand = highcard_state.generate_hand(rng, last, PLAYERS, SMALL_BLIND)
+        yield PLAYERS, last, hand
+        last = hand[-1]
+        if min(last[2][:2]) < 3*SMALL_BLIND:
+            last = start()
+
+def encode(state):
+    return highcard_state.State.from_abi(state).encoded
+
+def valid(old, new, players):
+    return highcard_state.is_valid_state_transition(encode(old), encode(new), players, SMALL_BLIND)
+
+def test_generated_hands_are_valid():
+    for players, last, hand in hands(50):
+        previous = last
+        for state in hand:
+            assert valid(previous, state, players)
+            assert highcard_state.is_valid_state_fast_forward(encode(previous), encode(state), players, SMALL_BLIND)
+            previous = state
+
+def test_fast_forward_over_a_hand():
+    for players, last, hand in hands(20):
+        if len(hand) > 2:
+            assert highcard_state.is_valid_state_fast_forward(encode(hand[0]), encode(hand[-1]), players, SMALL_BLIND)
+            assert not highcard_state.is_valid_state_fast_forward(encode(hand[-1]), encode(hand[0]), players, SMALL_BLIND)
+
+def changed(state, field, index, value):
+    state = copy.deepcopy(state)
+    if index is None:
+        state[field] = value
+    else:
+        state[field][index] = value
+    return state
+
+def test_invalid_transitions():
+    players, last, hand = next(hands(1, seed=3))
+    old, new = hand[0], hand[1]
+    assert valid(old, new, players)
+    # Same actor twice, skipped round, wrong hand, money appearing from nowhere, an outsider.
+    assert not valid(old, changed(new, 4, 0, old[4][0]), players)
+    assert not valid(old, changed(new, 1, 0, new[1][0]+1), players)
+    assert not valid(old, changed(new, 0, None, new[0]+1), players)
+    assert not valid(old, changed(new, 2, 0, new[2][0]+SMALL_BLIND), players)
+    assert not valid(old, changed(new, 4, 0, to_checksum_address("0x" + "ab"*20)), players)
+    assert not highcard_state.is_valid_state_transition(encode(old), encode(new)[:-1], players, SMALL_BLIND)
+
+def test_hand_result():
+    showdowns = [(players, h) for players, _, h in hands(40, seed=5) if h[-2][1][1] == highcard_state.REVEAL]
+    players, hand = showdowns[0]
+    commit = highcard_state.State.from_abi(hand[-1])
+    ck = commit.cards_keys
+    winner = players.index(commit.winner)
+    args = ((ck[0], ck[4]), (ck[1], ck[5]), (ck[2], ck[6]), (ck[3], ck[7]))
+    assert highcard_state.is_valid_hand_result(*args, winner)
+    assert not highcard_state.is_valid_hand_result(*args, 1-winner)
+
+def test_state_round_trip():
+    players, last, hand = next(hands(1))
+    for values in hand:
+        state = highcard_state.State.from_abi(values)
+        assert highcard_state.State.decode(state.encoded) == state
+        assert highcard_state.State.from_hex(state.hex).as_abi() == state.as_abi()
+        assert state.encoded == highcard_state._encode(values)
+
+def test_reveal_card():
+    from deck import NEW_DECK, multiply, point_bytes, point_xy, reveal
+    k1, k2 = 0x1234567, 0xabcdef987
+    masked = multiply(multiply(NEW_DECK[17], k1), k2)
+    assert highcard_state.reveal_card(*point_xy(masked), k1, k2) == highcard_state.cards[17]
+    assert reveal(masked, [k1, k2]) == highcard_state.cards[17]
+    # Off the curve the contract's two multiplications are followed step by step.
+    x, y = 5, 11
+    assert not highcard_state.is_on_curve(x, y)
+    x1, y1 = highcard_state.point_multiply(x, y, highcard_state.inv_mod(k1, highcard_state.ORDER))
+    x2, _ = highcard_state.point_multiply(x1, y1, highcard_state.inv_mod(k2, highcard_state.ORDER))
+    assert highcard_state.reveal_card(x, y, k1, k2) == highcard_state.encoded_cards.get(x2)
+    with pytest.raises(ValueError):
+        reveal(point_bytes(x, y), [k1, k2])
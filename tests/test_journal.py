@@ -0,0 +1,95 @@
+import json
+import pytest
+
+from journal import GameJournal, load_game
+
+GAME = {'sessionID': 'ab'*32, 'start_time': 1, 'duration': 3600, 'dispute_duration': 600, 'buy_in': 100}
+
+def signed(i):
+    return {'state': '%064x' % i, 'signatures': {}}
+
+def test_resume_after_torn_tail(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    journal = GameJournal(path)
+    journal.write_game(GAME)
+    journal.append_state(signed(1))
+    journal.close()
+    with open(path, "a") as f:
+        f.write(json.dumps({'state': signed(2)})[:20])
+    saved = load_game(path)
+    assert saved['states'] == [signed(1)]
+
+    resumed = GameJournal(path)
+    resumed.load(saved)
+    resumed.append_state(signed(3))
+    resumed.close()
+    saved = load_game(path)
+    assert saved['game'] == GAME
+    assert saved['states'] == [signed(1), signed(3)]
+
+def test_resume_old_backup(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    with open(path, "w") as f:
+        f.write(json.dumps({'game': GAME, 'states': [signed(1)], 'unfinished': ''}))
+    saved = load_game(path)
+    resumed = GameJournal(path)
+    resumed.load(saved)
+    resumed.append_state(signed(2))
+    resumed.close()
+    assert load_game(path)['states'] == [signed(1), signed(2)]
+
+def test_append_and_load(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    journal = GameJournal(path)
+    journal.write_game(GAME)
+    journal.set_deck({'start': 0, 'deck': [], 'keys': []})
+    journal.append_state(signed(1))
+    journal.set_unfinished({'state': '%064x' % 2, 'signature': [27, 1, 2]})
+    journal.close()
+    saved = load_game(path)
+    assert saved == {'game': GAME, 'states': [signed(1)], 'unfinished': {'state': '%064x' % 2, 'signature': [27, 1, 2]}, 'deck': {'start': 0, 'deck': [], 'keys': []}, 'closed': False}
+    journal.append_state(signed(2))
+    journal.mark_closed()
+    journal.close()
+    saved = load_game(path)
+    assert saved['unfinished'] == ''
+    assert saved['closed']
+
+def test_checkpoints_keep_recent_states(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    journal = GameJournal(path, keep=3, compact_every=4)
+    journal.write_game(GAME)
+    for i in range(1, 11):
+        journal.append_state(signed(i), checkpoint=i % 5 == 0)
+    journal.close()
+    # The checkpoint at 10 keeps the two states before it; the file was compacted there.
+    assert journal.states == [signed(8), signed(9), signed(10)]
+    saved = load_game(path)
+    assert saved['game'] == GAME
+    assert saved['states'] == journal.states
+    with open(path) as f:
+        assert len(f.read().splitlines()) == 4
+
+def test_compaction_without_checkpoints(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    journal = GameJournal(path, compact_every=2)
+    journal.write_game(GAME)
+    for i in range(9):
+        journal.append_state(signed(i))
+    journal.close()
+    assert journal.appended == 1
+    assert load_game(path)['states'] == [signed(i) for i in range(9)]
+
+def test_torn_tail_is_ignored(tmp_path):
+    path = str(tmp_path / "game.pkr")
+    journal = GameJournal(path)
+    journal.write_game(GAME)
+    journal.append_state(signed(1))
+    journal.close()
+    with open(path, "a") as f:
+        f.write('{"state": {"sta')
+    assert load_game(path)['states'] == [signed(1)]
+    with open(path, "a") as f:
+        f.write('\n{"state": 1}\n')
+    with pytest.raises(ValueError):
+        load_game(path)
@@ -0,0 +1,108 @@
+import os
+import pytest
+from eth_account import Account
+from web3 import Web3
+from web3.providers import BaseProvider
+
+import settlement
+import contract_control
+from journal import GameJournal
+from rpc import RPCError
+
+KEY = '0x' + '11'*32
+OPPONENT = Web3.toChecksumAddress('0x' + 'ee'*20)
+PLAYERS = sorted([Account.from_key(KEY).address, OPPONENT], key=lambda a: int(a, 16))
+START = 1000
+DURATION = 3600
+EXPIRED = START + DURATION + 300
+
+@pytest.fixture
+def w3(monkeypatch):
+    # No node: the contract's domain separator is computed locally, and the table reads are
+    # answered by the tests.
+    monkeypatch.setattr(contract_control, "contract_domain_separator", lambda eth, contract: contract_control.domain_separator(3, contract.address))
+    return Web3(BaseProvider())
+
+def journal(tmp_path, name="game.pkr"):
+    path = str(tmp_path / name)
+    game = GameJournal(path)
+    game.write_game({'players': PLAYERS, 'start_time': START, 'buy_in': 10**18, 'duration': DURATION, 'dispute_duration': 600, 'sessionID': 'ab'*32})
+    game.close()
+    return path
+
+def reads(active, settling=None, state=None):
+    return [active, [PLAYERS, [10**18, 10**18]], settling if settling is not None else RPCError("not in settlement"), state if state is not None else RPCError("no state")]
+
+class Claims:
+    def __init__(self, table):
+        self.tables = []
+        table.c.claim_expired_table = self.claim
+
+    def claim(self, tableID, gas):
+        self.tables.append(tableID)
+        return b'\x01'*32
+
+def test_table_of(w3, tmp_path):
+    table = settlement.TableSettlement(journal(tmp_path), w3, KEY)
+    watcher = settlement.SettlementWatcher(w3, [table])
+    contract = table.c.contract
+    tableID = table.c.tableID
+    opened = contract.encodeABI(fn_name='openTable', args=[PLAYERS, b'', [27, 27], [b'\x01'*32]*2, [b'\x02'*32]*2, b'\x03'*32])
+    assert watcher.table_of(opened) == tableID
+    assert watcher.table_of(contract.encodeABI(fn_name='joinTable', args=[PLAYERS])) == tableID
+    assert watcher.table_of(contract.encodeABI(fn_name='joinTable', args=[PLAYERS[::-1]])) is None
+    assert watcher.table_of(contract.encodeABI(fn_name='claimExpiredTable', args=[tableID])) == tableID
+    assert watcher.table_of(bytes.fromhex(contract.encodeABI(fn_name='claimExpiredSettlement', args=[tableID])[2:])) == tableID
+    assert watcher.table_of('0x12345678' + '00'*32) is None
+    assert watcher.table_of('0x') is None
+
+def test_unplayed_table_is_claimed_after_expiry(w3, tmp_path, monkeypatch):
+    path = journal(tmp_path)
+    table = settlement.TableSettlement(path, w3, KEY)
+    claims = Claims(table)
+    answers = [reads(True)]
+    monkeypatch.setattr(settlement, 'batch_calls', lambda w3, calls: answers[-1])
+    watcher = settlement.SettlementWatcher(w3, [table], max_idle=10**6, remove_done=True)
+    watcher.now = START + 10
+    watcher.check([table.c.tableID])
+    assert watcher.due[table.c.tableID] == EXPIRED
+    watcher.now = EXPIRED
+    watcher.fire_deadlines()
+    assert claims.tables == []
+    watcher.now = EXPIRED + 1
+    watcher.fire_deadlines()
+    assert claims.tables == [table.c.tableID]
+    # The claim lands; the table was seen open, so its journal goes.
+    answers.append(reads(False))
+    watcher.check([table.c.tableID])
+    assert table.done and table.settled
+    assert watcher.tables == {}
+    assert not os.path.exists(path)
+
+def test_pending_table_keeps_its_journal(w3, tmp_path, monkeypatch):
+    path = journal(tmp_path)
+    table = settlement.TableSettlement(path, w3, KEY)
+    monkeypatch.setattr(settlement, 'batch_calls', lambda w3, calls: reads(False))
+    watcher = settlement.SettlementWatcher(w3, [table], max_idle=10**6, remove_done=True)
+    watcher.now = START + 10
+    watcher.check([table.c.tableID])
+    assert not table.done
+    assert watcher.due[table.c.tableID] == EXPIRED
+    watcher.now = EXPIRED + 1
+    watcher.fire_deadlines()
+    assert table.done and not table.settled
+    assert os.path.exists(path)
+
+def test_superseded_deadlines_are_skipped(w3, tmp_path, monkeypatch):
+    table = settlement.TableSettlement(journal(tmp_path), w3, KEY)
+    checked = []
+    monkeypatch.setattr(settlement.SettlementWatcher, 'check', lambda self, tableIDs: checked.append(set(tableIDs)))
+    watcher = settlement.SettlementWatcher(w3, [table])
+    tableID = table.c.tableID
+    for deadline in (50, 100):
+        watcher.due[tableID] = deadline
+        watcher.deadlines.append((deadline, tableID))
+    watcher.now = 200
+    watcher.fire_deadlines()
+    assert checked == [{tableID}]
+    assert watcher.deadlines == []
@@ -0,0 +1,21 @@
+import json, os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def simulate(*args):
+    # The reactor only runs once per process, so every simulation gets its own.
+    out = subprocess.run([sys.executable, os.path.join(ROOT, "simulation.py"), *args, "--json"], cwd=ROOT, stdout=subprocess.PIPE, check=True, timeout=600)
+    return json.loads(out.stdout.decode().splitlines()[-1])
+
+def test_stub_tables_settle():
+    report = simulate("6", "2", "1", "stub")
+    assert report["completed"]
+    assert report["hands"] == 12
+    assert report["settlements"] == 2
+
+def test_evm_tables_settle(solc):
+    report = simulate("4", "1", "1", "evm")
+    assert report["chain"] == "evm"
+    assert report["completed"]
+    assert report["hands"] == 4
+    assert report["settlements"] == 1
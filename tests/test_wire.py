@@ -0,0 +1,40 @@
+import os
+import pytest
+
+from wire import WIRE_VERSION, encode_message, decode_message
+
+ADDRESS = "0x5fB5EDF7255e8CF168a41AD67472a76bb8304acb"
+STATE = os.urandom(17*32).hex()
+
+def sig(prefix=''):
+    keys = ('v', 'r', 's') if prefix == '' else (prefix+'_v', prefix+'_r', prefix+'_s')
+    return dict(zip(keys, (28, int.from_bytes(os.urandom(32), 'big'), int.from_bytes(os.urandom(32), 'big'))))
+
+MESSAGES = [
+    {'msgtype': 'hello', 'version': WIRE_VERSION, 'address': ADDRESS, 'sessionID': 'abcdefghijklmnopqrstuvwxy'},
+    {'msgtype': 'hello', 'version': WIRE_VERSION, 'address': ADDRESS, 'sessionID': 'abc', 'buyin': 10**18, 'duration': 3600, 'join_duration': 600, 'dispute_duration': 600, 'pipeline': 1, 'hands_per_deck': 26, 'bundle': 1},
+    dict({'msgtype': 'create'}, **sig()),
+    {'msgtype': 'join', 'tx': os.urandom(32).hex(), 'buyin': 10**18},
+    {'msgtype': 'shuffle', 'round': 1, 'deck': [os.urandom(64) for _ in range(52)]},
+    {'msgtype': 'shuffle', 'round': 2, 'deck': [os.urandom(64) for _ in range(52)], 'key': 12345, 'hand': 3},
+    dict({'msgtype': 'hand', 'type': 1, 'previous_state': STATE, 'next_state': STATE}, **sig('next')),
+    dict({'msgtype': 'hand', 'type': 2, 'previous_state': STATE, 'next_state': STATE, 'chain': [(STATE, [27, 1, 2]), (STATE, [28, 3, 4])]}, **sig('next'), **sig('prev')),
+    dict({'msgtype': 'handover', 'previous_state': STATE, 'stop': 0, 'tx': '', 'key': 7}, **sig('prev')),
+    {'msgtype': 'resume', 'sessionID': os.urandom(32).hex(), 'deck': os.urandom(32).hex()},
+    dict({'msgtype': 'resume', 'sessionID': os.urandom(32).hex(), 'deck': os.urandom(32).hex(), 'state': STATE, 'next_state': STATE}, **sig('first'), **sig('second'), **sig('next')),
+]
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=[m['msgtype'] for m in MESSAGES])
+def test_round_trip(msg):
+    assert decode_message(encode_message(msg)) == msg
+
+def test_rejects_damaged_frames():
+    frame = encode_message(MESSAGES[6])
+    with pytest.raises(ValueError):
+        decode_message(frame[:-1])
+    with pytest.raises(ValueError):
+        decode_message(frame + b'\x00')
+    with pytest.raises(ValueError):
+        decode_message(b'\xff' + frame[1:])
+    with pytest.raises(ValueError):
+        encode_message({'msgtype': 'shuffle', 'round': 1, 'deck': [b'short']})
@@ -0,0 +1,156 @@
+from eth_utils import to_checksum_address
+import binascii, struct
+
+# Binary encoding of the peer to peer messages. Every message is sent as one length prefixed
+# frame (see Player, an Int32StringReceiver); the frame payload is a message type byte followed
+# by the fields of that message type in a fixed order. Handlers keep working with the same dicts
+# as before: states and transaction hashes are hex strings in the dict but travel as raw bytes,
+# deck points are raw 64 byte x||y strings, signatures travel as fixed 65 byte r||s||v fields.
+# A STATES field is a list of (state hex, [v, r, s]) pairs, each a length prefixed state and a
+# signature.
+
+WIRE_VERSION = 5
+MAX_FRAME_LENGTH = 1 << 20
+
+U8 = 'u8'
+U256 = 'u256'
+ADDRESS = 'address'
+TEXT = 'text'
+HEX = 'hex'
+POINTS = 'points'
+SIG = 'sig'
+STATES = 'states'
+
+POINT_LENGTH = 64
+SIG_LENGTH = 65
+
+# msgtype -> (type byte, required fields, optional fields). A SIG field named `x` maps to the
+# dict keys x_v, x_r, x_s (or v, r, s when the name is empty).
+SCHEMAS = {
+    'hello': (1, [('version', U8), ('address', ADDRESS), ('sessionID', TEXT)], [('buyin', U256), ('duration', U256), ('join_duration', U256), ('dispute_duration', U256), ('pipeline', U8), ('hands_per_deck', U8), ('bundle', U8)]),
+    'create': (2, [('', SIG)], []),
+    'join': (3, [('tx', HEX), ('buyin', U256)], []),
+    'shuffle': (4, [('round', U8), ('deck', POINTS)], [('key', U256), ('hand', U256)]),
+    'hand': (5, [('type', U8), ('previous_state', HEX), ('next_state', HEX), ('next', SIG)], [('prev', SIG), ('chain', STATES)]),
+    'handover': (6, [('previous_state', HEX), ('prev', SIG), ('stop', U8), ('tx', HEX)], [('key', U256)]),
+    'resume': (7, [('sessionID', HEX), ('deck', HEX)], [('state', HEX), ('first', SIG), ('second', SIG), ('next_state', HEX), ('next', SIG)]),
+}
+MSGTYPES = {code: msgtype for msgtype, (code, _, _) in SCHEMAS.items()}
+
+def sig_keys(name):
+    if name == '':
+        return 'v', 'r', 's'
+    return name+'_v', name+'_r', name+'_s'
+
+def has_field(msg, name, kind):
+    if kind == SIG:
+        return all(k in msg for k in sig_keys(name))
+    return name in msg
+
+def encode_sig(v, r, s):
+    return r.to_bytes(32, 'big') + s.to_bytes(32, 'big') + bytes([v])
+
+def decode_sig(raw):
+    return [raw[64], int.from_bytes(raw[:32], 'big'), int.from_bytes(raw[32:64], 'big')]
+
+def encode_field(kind, name, msg):
+    if kind == SIG:
+        return encode_sig(*(msg[k] for k in sig_keys(name)))
+    value = msg[name]
+    if kind == U8:
+        return bytes([value])
+    if kind == U256:
+        return value.to_bytes(32, 'big')
+    if kind == ADDRESS:
+        return binascii.unhexlify(value[2:])
+    if kind == TEXT:
+        raw = value.encode()
+        return struct.pack('>H', len(raw)) + raw
+    if kind == HEX:
+        raw = binascii.unhexlify(value)
+        return struct.pack('>I', len(raw)) + raw
+    if kind == POINTS:
+        raw = b''.join(value)
+        if len(raw) != POINT_LENGTH*len(value):
+            raise ValueError("deck points must be 64 bytes each")
+        return struct.pack('>H', len(value)) + raw
+    if kind == STATES:
+        out = [struct.pack('>H', len(value))]
+        for state, sig in value:
+            raw = binascii.unhexlify(state)
+            out += [struct.pack('>I', len(raw)), raw, encode_sig(*sig)]
+        return b''.join(out)
+    raise ValueError(f"unknown field kind {kind}")
+
+def take(payload, offset, length):
+    if offset+length > len(payload):
+        raise ValueError("truncated message")
+    return payload[offset:offset+length], offset+length
+
+def decode_field(kind, name, payload, offset, msg):
+    if kind == SIG:
+        raw, offset = take(payload, offset, SIG_LENGTH)
+        for key, value in zip(sig_keys(name), decode_sig(raw)):
+            msg[key] = value
+        return offset
+    if kind == U8:
+        raw, offset = take(payload, offset, 1)
+        msg[name] = raw[0]
+    elif kind == U256:
+        raw, offset = take(payload, offset, 32)
+        msg[name] = int.from_bytes(raw, 'big')
+    elif kind == ADDRESS:
+        raw, offset = take(payload, offset, 20)
+        msg[name] = to_checksum_address(raw)
+    elif kind == TEXT:
+        raw, offset = take(payload, offset, 2)
+        raw, offset = take(payload, offset, struct.unpack('>H', raw)[0])
+        msg[name] = raw.decode()
+    elif kind == HEX:
+        raw, offset = take(payload, offset, 4)
+        raw, offset = take(payload, offset, struct.unpack('>I', raw)[0])
+        msg[name] = binascii.hexlify(raw).decode()
+    elif kind == POINTS:
+        raw, offset = take(payload, offset, 2)
+        raw, offset = take(payload, offset, POINT_LENGTH*struct.unpack('>H', raw)[0])
+        msg[name] = [raw[i:i+POINT_LENGTH] for i in range(0, len(raw), POINT_LENGTH)]
+    elif kind == STATES:
+        raw, offset = take(payload, offset, 2)
+        value = []
+        for _ in range(struct.unpack('>H', raw)[0]):
+            raw, offset = take(payload, offset, 4)
+            state, offset = take(payload, offset, struct.unpack('>I', raw)[0])
+            raw, offset = take(payload, offset, SIG_LENGTH)
+            value.append((binascii.hexlify(state).decode(), decode_sig(raw)))
+        msg[name] = value
+    else:
+        raise ValueError(f"unknown field kind {kind}")
+    return offset
+
+def encode_message(msg):
+    if msg['msgtype'] not in SCHEMAS:
+        raise ValueError(f"unknown message type {msg['msgtype']}")
+    code, required, optional = SCHEMAS[msg['msgtype']]
+    present = [has_field(msg, name, kind) for name, kind in optional]
+    flags = sum(1 << i for i, p in enumerate(present) if p)
+    out = [bytes([code, flags])]
+    out += [encode_field(kind, name, msg) for name, kind in required]
+    out += [encode_field(kind, name, msg) for (name, kind), p in zip(optional, present) if p]
+    return b''.join(out)
+
+def decode_message(payload):
+    if len(payload) < 2 or payload[0] not in MSGTYPES:
+        raise ValueError("unreadable message")
+    msgtype = MSGTYPES[payload[0]]
+    flags = payload[1]
+    _, required, optional = SCHEMAS[msgtype]
+    msg = {'msgtype': msgtype}
+    offset = 2
+    for name, kind in required:
+        offset = decode_field(kind, name, payload, offset, msg)
+    for i, (name, kind) in enumerate(optional):
+        if flags & (1 << i):
+            offset = decode_field(kind, name, payload, offset, msg)
+    if offset != len(payload):
+        raise ValueError("trailing bytes in message")
+    return msg